@@ -0,0 +1,55 @@
+from db.sessesion import Db
+from sqlmodel import text
+import asyncio
+import json
+import sys
+
+# THE LOOKUPS OF THE gis TRIGGER FUNCTIONS, new.geom REPLACED BY A SAMPLE POINT OR LINE
+POINT = "ST_GeomFromText('POINT(0 0)', 4326)"
+LINE = "ST_GeomFromText('LINESTRING(0 0, 0.001 0.001)', 4326)"
+TRIGGER_QUERIES = {
+    "update_vill_mun": f"SELECT f.village, f.municipality FROM gis.franchise_area AS f WHERE ST_INTERSECTS(f.geom, {POINT}) LIMIT 1",
+    "update_franchise_area_id": f"SELECT f.id FROM gis.franchise_area AS f WHERE ST_INTERSECTS(f.geom, {POINT}) LIMIT 1",
+    "update_nodes_substation_id": f"SELECT s.id FROM gis.substation AS s WHERE ST_INTERSECTS(s.geom, {POINT}) LIMIT 1",
+    "update_primary_line (start)": f"SELECT n.node_name FROM gis.nodes AS n WHERE ST_INTERSECTS(n.geom, ST_STARTPOINT({LINE})) LIMIT 1",
+    "update_primary_line (end)": f"SELECT n.node_name FROM gis.nodes AS n WHERE ST_INTERSECTS(n.geom, ST_ENDPOINT({LINE}))",
+    "line_bushing_update (primary line)": f"SELECT pl.id FROM gis.primary_lines AS pl WHERE ST_INTERSECTS(ST_ENDPOINT(pl.geom), ST_STARTPOINT({LINE})) LIMIT 1",
+    "line_bushing_update (transformer)": f"SELECT dt.transformer_id FROM gis.distribution_transformer AS dt WHERE ST_INTERSECTS(dt.geom, ST_STARTPOINT({LINE})) LIMIT 1",
+    "line_bushing_update (line bushing)": f"SELECT lb.primary_line_id FROM gis.line_bushing AS lb WHERE ST_INTERSECTS(ST_ENDPOINT(lb.geom), ST_STARTPOINT({LINE})) LIMIT 1",
+    "line_bushing_update (node)": f"SELECT n.node_name FROM gis.nodes AS n WHERE ST_INTERSECTS(n.geom, ST_ENDPOINT({LINE})) LIMIT 1",
+    "line_bushing_after_update": "SELECT dt.id FROM gis.distribution_transformer AS dt WHERE dt.transformer_id = 'T-0'",
+    "pl_update_node_substation_id": "SELECT n.id FROM gis.nodes AS n WHERE n.id = 0",
+    "node_is_active (nodes)": "SELECT n.id FROM gis.nodes AS n WHERE n.substation_id = 0",
+    "node_is_active (primary_lines)": "SELECT pl.id FROM gis.primary_lines AS pl WHERE pl.substation_id = 0",
+    "node_is_active (distribution_transformer)": "SELECT dt.id FROM gis.distribution_transformer AS dt WHERE dt.substation_id = 0",
+}
+
+
+def seq_scans(plan:dict) -> list[str]:
+    '''Tables read with a sequential scan anywhere in the plan'''
+    found = [plan["Relation Name"]] if plan["Node Type"] == "Seq Scan" else []
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child))
+    return found
+
+async def check_indexes() -> bool:
+    '''EXPLAIN every trigger lookup with seq scans disabled, a seq scan left in the plan means no index can serve it'''
+    db_session = Db()
+    failed = False
+    async with db_session.supa_engine.begin() as conn:
+        await conn.execute(text("SET LOCAL enable_seqscan = off"))
+        for name, query in TRIGGER_QUERIES.items():
+            result = await conn.execute(text(f"EXPLAIN (FORMAT JSON) {query}"))
+            plan = result.scalar()
+            plan = json.loads(plan) if isinstance(plan, str) else plan
+            tables = seq_scans(plan[0]["Plan"])
+            if tables:
+                failed = True
+                print(f"SEQ SCAN   {name}: {', '.join(tables)}")
+            else:
+                print(f"INDEX      {name}")
+    await db_session.supa_engine.dispose()
+    return not failed
+
+if __name__ =="__main__":
+    sys.exit(0 if asyncio.run(check_indexes()) else 1)
@@ -1,5 +1,7 @@
 from sqlmodel import Field, SQLModel, Text, Integer, Column, Float, MetaData, Numeric
+from sqlalchemy import DateTime, func
 from typing import Optional
+from datetime import datetime
 from geoalchemy2 import Geometry
 
 local_metadata = MetaData(schema="gis")
@@ -99,4 +101,12 @@ class localLineBushing(SQLModel, table=True):
     length_meters: Optional[float] = Field(sa_column=Column(name="length_meters", type_=Numeric(10, 4)))
     village: Optional[str] = Field(sa_column=Column(name="village" , type_=Text))
     municipality: Optional[str] = Field(sa_column=Column(name="municipality", type_=Text))
-    
+
+# HASH OF EVERY ROW AS IT WAS LAST SENT BY /bulk/sync, PER LAYER AND KEY
+class localSyncState(SQLModel, table=True):
+    __tablename__:str = "sync_state"
+    metadata = local_metadata
+    layer: str = Field(sa_column=Column(name="layer", type_=Text, primary_key=True))
+    key: str = Field(sa_column=Column(name="key", type_=Text, primary_key=True))
+    row_hash: str = Field(sa_column=Column(name="row_hash", type_=Text, nullable=False))
+    synced_at: Optional[datetime] = Field(default=None, sa_column=Column(name="synced_at", type_=DateTime(timezone=True), nullable=False, server_default=func.now()))
@@ -1,38 +1,142 @@
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
 from sqlmodel import SQLModel, text
+from contextlib import AsyncExitStack
 from . import supa_model
+import logging
 import os
 from dotenv import load_dotenv
 
-class Db:
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+def env_int(name:str, default:int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+def env_bool(name:str, default:bool) -> bool:
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# /mapdata, THE SNAPSHOTS AND THE LAYER STORE READ THE feature_json COLUMN KEPT BY THE TRIGGERS OF create.py
+PUBLISHED_LAYERS = env_bool("PUBLISHEDLAYERS", False)
+
+# CONNECTION URLS
+def local_url() -> str:
+    LOCAL_DBNAME = os.getenv("LOCALDBNAME")
+    LOCAL_USERNAME= os.getenv("LOCALUSER")
+    LOCAL_PASSWORD= os.getenv("LOCALPASSWORD")
+    HOST_LOCAL= os.getenv("HOSTLOCAL")
+    LOCAL_PORT = os.getenv("LOCALPORT")
+    return f"postgresql+asyncpg://{LOCAL_USERNAME}:{LOCAL_PASSWORD}@{HOST_LOCAL}:{LOCAL_PORT}/{LOCAL_DBNAME}"
+
+def supa_url() -> str:
+    SUPA_DBNAME = os.getenv("SUPADBNAME")
+    SUPA_USER = os.getenv("SUPAUSER")
+    SUPA_PORT = os.getenv("SUPAPORT")
+    SUPA_HOST = os.getenv("SUPAHOST")
+    SUPA_PASSWORD = os.getenv("SUPAPASSWORD")
+    return f"postgresql+asyncpg://{SUPA_USER}:{SUPA_PASSWORD}@{SUPA_HOST}:{SUPA_PORT}/{SUPA_DBNAME}"
+
+# POOL SETTINGS, READ FROM <PREFIX>POOLSIZE, <PREFIX>MAXOVERFLOW ... E.G SUPAPOOLSIZE
+def pool_options(prefix:str) -> dict:
+    return dict(
+        pool_size = env_int(f"{prefix}POOLSIZE", 5),
+        max_overflow = env_int(f"{prefix}MAXOVERFLOW", 10),
+        pool_timeout = env_int(f"{prefix}POOLTIMEOUT", 30),
+        pool_recycle = env_int(f"{prefix}POOLRECYCLE", 1800),
+        pool_pre_ping = env_bool(f"{prefix}POOLPREPING", True),
+    )
+
+
+class EngineRegistry:
+    '''Process wide engines. Each engine and its pool is created once and shared by every request'''
     def __init__(self):
-        load_dotenv()
+        self.engines: dict[str, AsyncEngine] = {}
+        self.warmup: dict[str, int] = {}
+
+    def register(self, name:str, url:str, warmup:int = 0, **options) -> AsyncEngine:
+        if name not in self.engines:
+            self.engines[name] = create_async_engine(url, **options)
+            self.warmup[name] = warmup
+        return self.engines[name]
+
+    def configure(self):
+        self.register("local", local_url(), warmup=env_int("LOCALPOOLWARMUP", 0), **pool_options("LOCAL"))
+        self.register("supa", supa_url(), warmup=env_int("SUPAPOOLWARMUP", 1), **pool_options("SUPA"))
+
+    def get(self, name:str) -> AsyncEngine:
+        if name not in self.engines:
+            self.configure()
+        return self.engines[name]
+
+    @property
+    def local_engine(self) -> AsyncEngine:
+        return self.get("local")
+
+    @property
+    def supa_engine(self) -> AsyncEngine:
+        return self.get("supa")
+
+    async def warm_up(self, name:str):
+        # HOLD ALL CONNECTIONS AT ONCE SO THE POOL ACTUALLY OPENS <WARMUP> OF THEM
+        engine = self.engines[name]
+        async with AsyncExitStack() as stack:
+            for _ in range(self.warmup[name]):
+                conn = await stack.enter_async_context(engine.connect())
+                await conn.execute(text("SELECT 1"))
+
+    async def start(self):
+        self.configure()
+        for name in self.engines:
+            try:
+                await self.warm_up(name)
+            except Exception as exc:
+                logger.warning("POOL WARM UP FAILED FOR %s: %s", name, exc)
+
+    async def dispose(self):
+        for engine in self.engines.values():
+            await engine.dispose()
+        self.engines.clear()
+        self.warmup.clear()
+
+    def stats(self) -> dict:
+        stats = {}
+        for name, engine in self.engines.items():
+            pool = engine.sync_engine.pool
+            stats[name] = dict(
+                size = pool.size(),
+                checked_in = pool.checkedin(),
+                checked_out = pool.checkedout(),
+                overflow = pool.overflow(),
+                warmup = self.warmup[name],
+                status = pool.status(),
+            )
+        return stats
+
+engine_registry = EngineRegistry()
+
+
+class Db:
+    def __init__(self, registry:EngineRegistry = engine_registry):
         # LOCAL DATABASE
-        LOCAL_DBNAME = os.getenv("LOCALDBNAME")
-        LOCAL_USERNAME= os.getenv("LOCALUSER")
-        LOCAL_PASSWORD= os.getenv("LOCALPASSWORD")
-        HOST_LOCAL= os.getenv("HOSTLOCAL")
-        LOCAL_PORT = os.getenv("LOCALPORT")
-        self.local_engine = create_async_engine(f"postgresql+asyncpg://{LOCAL_USERNAME}:{LOCAL_PASSWORD}@{HOST_LOCAL}:{LOCAL_PORT}/{LOCAL_DBNAME}")
-        
+        self.local_engine = registry.local_engine
         # SUPABASE
-        SUPA_DBNAME = os.getenv("SUPADBNAME")
-        SUPA_USER = os.getenv("SUPAUSER")
-        SUPA_PORT = os.getenv("SUPAPORT")
-        SUPA_HOST = os.getenv("SUPAHOST")
-        SUPA_PASSWORD = os.getenv("SUPAPASSWORD")
-        self.supa_engine = create_async_engine(f"postgresql+asyncpg://{SUPA_USER}:{SUPA_PASSWORD}@{SUPA_HOST}:{SUPA_PORT}/{SUPA_DBNAME}")
-        
+        self.supa_engine = registry.supa_engine
+
     async def create_local_table(self):
        async with self.local_engine.begin() as conn:
            await conn.run_sync(SQLModel.metadata.create_all)
-           
+
     async def create_supa_table(self):
         async with self.supa_engine.begin() as conn:
             await conn.execute(text("CREATE SCHEMA IF NOT EXISTS gis;"))
             await conn.run_sync(supa_model.supa_meta_data.create_all)
             for functrig in [
+                supa_model.trigger_indexes,
                 supa_model.update_village_municipality,
                 supa_model.trigger_village_municipality,
                 supa_model.is_node_active,
@@ -49,9 +153,22 @@ class Db:
                 supa_model.line_bushing_update,
                 supa_model.line_bushing_trigger,
                 supa_model.line_bushing_after_update,
-                supa_model.line_bushing_after_trigger
-                
+                supa_model.line_bushing_after_trigger,
+                supa_model.notify_change,
+                supa_model.notify_change_trigger,
+                supa_model.rollup_apply,
+                supa_model.rollup_primary_lines,
+                supa_model.rollup_distribution_transformer,
+                supa_model.rollup_transformer_type,
+                supa_model.rollup_rebuild,
+                supa_model.rollup_truncate,
+                supa_model.rollup_triggers
+
             ]:
                await conn.execute(functrig)
-            
-   
\ No newline at end of file
+            # OPTIONAL PRE-RENDERED Feature TEXT OF THE /mapdata LAYERS
+            for table in supa_model.FEATURE_PROPERTIES:
+                for ddl in (supa_model.publish_layer(table) if PUBLISHED_LAYERS else supa_model.unpublish_layer(table)):
+                    await conn.execute(ddl)
+
+
@@ -1,7 +1,9 @@
 from sqlmodel import Field, Text, SQLModel, Integer, Boolean, Column, MetaData, Float, Numeric, ForeignKey, DDL, Table, Relationship, Computed
-from sqlalchemy import events, event
+from sqlalchemy import events, event, DateTime
 from geoalchemy2 import Geometry
 from typing import Optional, List
+from datetime import datetime
+import re
 
 
 # RE-STRUCTURING AND RE-MODELING GIS DATA BASE FOR ELECTRICAL DISTRIBUTION SYSTEM
@@ -82,31 +84,19 @@ update_village_municipality = DDL("""
 # TRIGGER FOR FRANCHISE AREA
 trigger_update_franchise_area_id = DDL(
     """
-    DO $$
-    BEGIN
-    IF NOT EXISTS(
-        SELECT 1 FROM pg_trigger WHERE tgname = 'update_franchise_area_id'
-    )THEN
-    CREATE TRIGGER update_franchise_area_id
-    BEFORE INSERT OR UPDATE on gis.substation
+    CREATE OR REPLACE TRIGGER update_franchise_area_id
+    BEFORE INSERT OR UPDATE OF geom ON gis.substation
     FOR EACH ROW EXECUTE FUNCTION gis.update_franchise_area_id();
-    END IF;
-    END $$;
     """
 )
 
 #  TIGGER
 trigger_village_municipality = DDL(
-   """
-   DO $$
-   BEGIN IF NOT EXISTS(
-       SELECT 1 FROM pg_trigger WHERE tgname = 'update_village_mun'
-   ) THEN 
-    CREATE TRIGGER update_village_mun
-    BEFORE INSERT OR UPDATE ON gis.substation
+    """
+    CREATE OR REPLACE TRIGGER update_village_mun
+    BEFORE INSERT OR UPDATE OF geom ON gis.substation
     FOR EACH ROW EXECUTE FUNCTION gis.update_vill_mun();
-    END IF;
-    END $$"""
+    """
 )
 
 
@@ -117,17 +107,20 @@ is_node_active = DDL(
     CREATE OR REPLACE FUNCTION gis.node_is_active()
     RETURNS TRIGGER AS $$
     BEGIN
+    IF TG_OP = 'UPDATE' AND new.isactive IS NOT DISTINCT FROM old.isactive THEN
+        RETURN NULL;
+    END IF;
     UPDATE gis.nodes as n
     SET isactive = new.isactive
-    WHERE n.substation_id = new.id;
+    WHERE n.substation_id = new.id AND n.isactive IS DISTINCT FROM new.isactive;
 
     UPDATE gis.primary_lines as pl
     SET isactive = new.isactive
-    where pl.substation_id = new.id;
+    where pl.substation_id = new.id AND pl.isactive IS DISTINCT FROM new.isactive;
     
     UPDATE gis.distribution_transformer as dt
     set isactive = new.isactive
-    where dt.substation_id = new.id;
+    where dt.substation_id = new.id AND dt.isactive IS DISTINCT FROM new.isactive;
 
     RETURN NULL;
     END;
@@ -136,19 +129,14 @@ is_node_active = DDL(
 )
 
 # AFTER INSERT AND UPDATE TO THE NODES IT WILL EXECUTE A FUNCTION
+# UPDATE OF isactive, ONLY A STATUS CHANGE CASCADES. THE SPATIAL BEFORE TRIGGERS BELOW ARE UPDATE OF geom,
+# SO THE CASCADED isactive UPDATES (AND THE substation_id WRITES OF THE TRACE) DO NOT REDO THEIR LOOKUPS
 node_status_update_trigger = DDL(
-    '''
-    DO $$
-    BEGIN 
-    IF NOT EXISTS(
-        SELECT 1 FROM pg_trigger WHERE tgname = 'node_is_active'
-    ) THEN
-    CREATE TRIGGER node_is_active
-    AFTER INSERT OR UPDATE ON gis.substation
+    """
+    CREATE OR REPLACE TRIGGER node_is_active
+    AFTER INSERT OR UPDATE OF isactive ON gis.substation
     FOR EACH ROW EXECUTE FUNCTION gis.node_is_active();
-    END IF;
-    END $$ 
-    '''
+    """
 )
     
 # ----------------------------------------------------------------------------------------------------------------------------------------- 
@@ -160,7 +148,7 @@ class Nodes(SQLModel, table=True):
     metadata = supa_meta_data
     id: Optional[int] = Field(default=None,sa_column=Column(name="id",unique=True,primary_key=True, type_=Integer))
     geom: Optional[str] = Field(default=None, sa_column=Column(name="geom", type_=Geometry("POINT", 4326), index=True))
-    substation_id: Optional[int] = Field(default=None, sa_column=Column(ForeignKey("gis.substation.id"), name="substation_id", type_=Integer))
+    substation_id: Optional[int] = Field(default=None, sa_column=Column(ForeignKey("gis.substation.id"), name="substation_id", type_=Integer, index=True))
     node_name: Optional[str] = Field(default=None, sa_column=Column(name="node_name", type_=Text, unique=True))
     description: Optional[str] = Field(default=None, sa_column=Column(name="description", type_=Text))
     nominal_voltage_kv: Optional[float] = Field(default=None, sa_column=Column(name="nominal_voltage_kv", type_=Numeric(10,2)))
@@ -201,34 +189,19 @@ nodes_substation_function = DDL(
 # TRIGGER FOR UPDATING SUBSTATION_ID OF GIS.NODES
 nodes_substation_id_trigger = DDL(
     """
-    DO
-    $$
-    BEGIN
-        IF NOT EXISTS(
-            SELECT 1 FROM pg_trigger where tgname = 'update_nodes_substation_id'
-        ) THEN
-        CREATE TRIGGER update_nodes_substation_id
-        BEFORE INSERT OR UPDATE ON gis.nodes
-        FOR EACH ROW EXECUTE FUNCTION gis.update_nodes_substation_id();
-        END IF;
-    END $$;
+    CREATE OR REPLACE TRIGGER update_nodes_substation_id
+    BEFORE INSERT OR UPDATE OF geom, description ON gis.nodes
+    FOR EACH ROW EXECUTE FUNCTION gis.update_nodes_substation_id();
     """
 )
 
 # TRIGGER THAT CAST BEFORE INSERT OR UPDATE ON NODES TABLE
 nodes_trigger = DDL(
-    '''
-    DO $$
-    BEGIN
-    IF NOT EXISTS(
-        SELECT 1 FROM pg_trigger where tgname = 'update_nodes'
-    ) THEN
-    CREATE TRIGGER update_nodes
-    BEFORE INSERT OR UPDATE ON gis.nodes
+    """
+    CREATE OR REPLACE TRIGGER update_nodes
+    BEFORE INSERT OR UPDATE OF geom ON gis.nodes
     FOR EACH ROW EXECUTE FUNCTION gis.update_vill_mun();
-    END IF;
-    END $$;
-    '''
+    """
 )
 
 # -----------------------------------------------------------------------------------------------------------------------------------------
@@ -238,7 +211,7 @@ class PrimaryLines(SQLModel, table=True):
     metadata = supa_meta_data
     id: Optional[int] = Field(default=None,sa_column=Column(name="id", type_=Integer, primary_key=True))
     node_id: Optional[int] = Field(default=None, sa_column=Column(ForeignKey("nodes.id"), name="node_id", type_=Integer))
-    substation_id: Optional[int] = Field(default=None, sa_column=Column(name="substation_id", type_=Integer))
+    substation_id: Optional[int] = Field(default=None, sa_column=Column(name="substation_id", type_=Integer, index=True))
     geom: Optional[str] = Field(default=None, sa_column=Column(name="geom",type_=Geometry("LINESTRING", 4326), index=True))
     line_id: Optional[str] = Field(default=None, sa_column=Column(name="line_id", type_=Text, unique=True))
     from_node: Optional[str] = Field(default=None, sa_column=Column(name="from_node", type_=Text))
@@ -295,17 +268,9 @@ update_primary_line= DDL(
 # TIGGER BEFORE INSERT OR UPDATE
 update_primary_line_trigger = DDL(
     """
-    DO
-    $$
-    BEGIN
-        IF NOT EXISTS(
-            SELECT 1 FROM pg_trigger WHERE tgname = 'primary_line_update'
-        )THEN
-        CREATE TRIGGER primary_line_update
-        BEFORE INSERT OR UPDATE ON gis.primary_lines
-        FOR EACH ROW EXECUTE FUNCTION gis.update_primary_line();
-        END IF;
-    END $$;
+    CREATE OR REPLACE TRIGGER primary_line_update
+    BEFORE INSERT OR UPDATE OF geom ON gis.primary_lines
+    FOR EACH ROW EXECUTE FUNCTION gis.update_primary_line();
     """
 )
 
@@ -314,10 +279,14 @@ update_node_substation_id = DDL(
     CREATE OR REPLACE FUNCTION gis.pl_update_node_substation_id()
     RETURNS TRIGGER AS $$
     BEGIN
+        IF TG_OP = 'UPDATE' AND (new.substation_id, new.node_id) IS NOT DISTINCT FROM (old.substation_id, old.node_id) THEN
+            RETURN NULL;
+        END IF;
         UPDATE gis.nodes as n
         SET substation_id = new.substation_id
         WHERE n.id = NEW.node_id
-        AND n.description ILIKE '%%PRIMARY%%';
+        AND n.description ILIKE '%%PRIMARY%%'
+        AND n.substation_id IS DISTINCT FROM new.substation_id;
     RETURN NULL;
     END;
     $$ LANGUAGE plpgsql;
@@ -347,7 +316,7 @@ class DistributionTransformer(SQLModel, table=True):
     metadata = supa_meta_data
     id: Optional[int] = Field(sa_column=Column(name="id",primary_key=True,type_=Integer))
     geom: Optional[str] = Field(sa_column=Column(name="geom", type_=Geometry("POINT",4326), index=True))
-    substation_id: Optional[int] = Field(sa_column=Column(name="substation_id", type_=Integer))
+    substation_id: Optional[int] = Field(sa_column=Column(name="substation_id", type_=Integer, index=True))
     line_bushing_id: Optional[int] = Field(sa_column=Column(ForeignKey("line_bushing.id"),name="line_bushing_id",type_=Integer))
     transformer_id: Optional[str] = Field(sa_column=Column(name="transformer_id", type_=Text, unique=True))
     from_primary_node: Optional[str] = Field(sa_column=Column(name="from_primary_node", type_=Text))
@@ -494,18 +463,9 @@ line_bushing_update = DDL(
 
 line_bushing_trigger = DDL(
     """
-    DO
-    $$
-    BEGIN
-    IF NOT EXISTS(
-        SELECT 1 FROM pg_trigger 
-        where tgname = 'line_bushing_trigger'
-    ) THEN
-    CREATE TRIGGER line_bushing_trigger
-    Before insert or update on gis.line_bushing
-    FOR EACH row execute function gis.line_bushing_update();
-    END IF;
-    END $$;
+    CREATE OR REPLACE TRIGGER line_bushing_trigger
+    BEFORE INSERT OR UPDATE OF geom ON gis.line_bushing
+    FOR EACH ROW EXECUTE FUNCTION gis.line_bushing_update();
     """
 )
 
@@ -516,6 +476,9 @@ line_bushing_after_update = DDL(
     RETURNS TRIGGER AS 
     $$
     BEGIN 
+    IF TG_OP = 'UPDATE' AND new.* IS NOT DISTINCT FROM old.* THEN
+        RETURN NEW;
+    END IF;
     if new.description ilike '%%Primary%%' THEN
     UPDATE gis.distribution_transformer as dt
     set 
@@ -556,3 +519,368 @@ line_bushing_after_trigger  = DDL(
     """
 )
 
+
+# -----------------------------------------------------------------------------------------------------------------------------------------
+# LOAD FLOW RESULTS, ONE ROW PER PRIMARY LINE OF THE LAST SOLVE (services/load_flow.py)
+class LoadFlowResult(SQLModel, table=True):
+    __tablename__:str = "load_flow"
+    metadata = supa_meta_data
+    primary_line_id: Optional[int] = Field(default=None, sa_column=Column(name="primary_line_id", type_=Integer, primary_key=True, autoincrement=False))
+    substation_id: Optional[int] = Field(default=None, sa_column=Column(name="substation_id", type_=Integer, index=True))
+    to_node: Optional[str] = Field(default=None, sa_column=Column(name="to_node", type_=Text))
+    voltage_pu: Optional[float] = Field(default=None, sa_column=Column(name="voltage_pu", type_=Float))
+    voltage_kv: Optional[float] = Field(default=None, sa_column=Column(name="voltage_kv", type_=Float))
+    current_a: Optional[float] = Field(default=None, sa_column=Column(name="current_a", type_=Float))
+    loss_kw: Optional[float] = Field(default=None, sa_column=Column(name="loss_kw", type_=Float))
+    load_kva: Optional[float] = Field(default=None, sa_column=Column(name="load_kva", type_=Float))
+    solved_at: Optional[datetime] = Field(default=None, sa_column=Column(name="solved_at", type_=DateTime(timezone=True)))
+
+
+# -----------------------------------------------------------------------------------------------------------------------------------------
+# ROLLUPS, km OF PRIMARY LINE, TRANSFORMER COUNT AND INSTALLED kVA PER SUBSTATION, VILLAGE, MUNICIPALITY AND THE WHOLE NETWORK
+# scope IS total, substation (name IS THE id), village (municipality IS ITS MUNICIPALITY) OR municipality, '' IS UNASSIGNED
+class NetworkRollup(SQLModel, table=True):
+    __tablename__:str = "network_rollup"
+    metadata = supa_meta_data
+    scope: str = Field(sa_column=Column(name="scope", type_=Text, primary_key=True))
+    name: str = Field(sa_column=Column(name="name", type_=Text, primary_key=True))
+    municipality: str = Field(sa_column=Column(name="municipality", type_=Text, primary_key=True))
+    line_meters: float = Field(default=0, sa_column=Column(name="line_meters", type_=Numeric, nullable=False, server_default="0"))
+    lines: int = Field(default=0, sa_column=Column(name="lines", type_=Integer, nullable=False, server_default="0"))
+    transformers: int = Field(default=0, sa_column=Column(name="transformers", type_=Integer, nullable=False, server_default="0"))
+    kva: float = Field(default=0, sa_column=Column(name="kva", type_=Numeric, nullable=False, server_default="0"))
+
+# ADDS THE DELTAS OF ONE STATEMENT, ONE ROW PER CHANGED LINE OR TRANSFORMER (NEGATIVE FOR THE OLD VALUES)
+# ONE UPSERT IN KEY ORDER, CONCURRENT WRITERS LOCK THE ROLLUP ROWS IN THE SAME ORDER
+rollup_apply = DDL(
+    """
+    CREATE OR REPLACE FUNCTION gis.rollup_apply(substation_ids int[], villages text[], municipalities text[],
+                                                meter_deltas numeric[], line_deltas int[], transformer_deltas int[], kva_deltas numeric[])
+    RETURNS void AS $$
+    BEGIN
+    INSERT INTO gis.network_rollup AS r (scope, name, municipality, line_meters, lines, transformers, kva)
+    SELECT k.scope, k.name, k.municipality, sum(d.meters), sum(d.lines), sum(d.transformers), sum(d.kva)
+    FROM unnest(substation_ids, villages, municipalities, meter_deltas, line_deltas, transformer_deltas, kva_deltas)
+        AS d(substation_id, village, municipality, meters, lines, transformers, kva)
+    CROSS JOIN LATERAL (VALUES
+        ('total', '', ''),
+        ('substation', COALESCE(d.substation_id::text, ''), ''),
+        ('village', COALESCE(d.village, ''), COALESCE(d.municipality, '')),
+        ('municipality', COALESCE(d.municipality, ''), '')
+    ) AS k(scope, name, municipality)
+    GROUP BY k.scope, k.name, k.municipality
+    HAVING sum(d.meters) <> 0 OR sum(d.lines) <> 0 OR sum(d.transformers) <> 0 OR sum(d.kva) <> 0
+    ORDER BY k.scope, k.name, k.municipality
+    ON CONFLICT (scope, name, municipality) DO UPDATE SET
+        line_meters = r.line_meters + excluded.line_meters,
+        lines = r.lines + excluded.lines,
+        transformers = r.transformers + excluded.transformers,
+        kva = r.kva + excluded.kva;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+# STATEMENT LEVEL, THE OLD AND NEW ROWS OF THE WHOLE STATEMENT ARE SUMMED, ROWS THAT DID NOT MOVE CANCEL OUT
+rollup_primary_lines = DDL(
+    """
+    CREATE OR REPLACE FUNCTION gis.rollup_primary_lines()
+    RETURNS TRIGGER AS $$
+    BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM gis.rollup_apply(array_agg(substation_id), array_agg(village), array_agg(municipality),
+                                 array_agg(COALESCE(length_meters, 0)), array_agg(1), array_agg(0), array_agg(0::numeric))
+        FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM gis.rollup_apply(array_agg(substation_id), array_agg(village), array_agg(municipality),
+                                 array_agg(-COALESCE(length_meters, 0)), array_agg(-1), array_agg(0), array_agg(0::numeric))
+        FROM old_rows;
+    ELSE
+        PERFORM gis.rollup_apply(array_agg(d.substation_id), array_agg(d.village), array_agg(d.municipality),
+                                 array_agg(d.meters), array_agg(d.lines), array_agg(0), array_agg(0::numeric))
+        FROM (
+            SELECT substation_id, village, municipality, COALESCE(length_meters, 0) AS meters, 1 AS lines FROM new_rows
+            UNION ALL
+            SELECT substation_id, village, municipality, -COALESCE(length_meters, 0), -1 FROM old_rows
+        ) AS d;
+    END IF;
+    RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+# kVA IS THE CURRENT transformer_type.kva_rating, gis.rollup_transformer_type() MOVES IT WHEN A RATING CHANGES
+rollup_distribution_transformer = DDL(
+    """
+    CREATE OR REPLACE FUNCTION gis.rollup_distribution_transformer()
+    RETURNS TRIGGER AS $$
+    BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM gis.rollup_apply(array_agg(d.substation_id), array_agg(d.village), array_agg(d.municipality),
+                                 array_agg(0::numeric), array_agg(0), array_agg(1), array_agg(COALESCE(tt.kva_rating, 0)))
+        FROM new_rows AS d LEFT JOIN gis.transformer_type AS tt ON tt.name = d.transformer_type;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM gis.rollup_apply(array_agg(d.substation_id), array_agg(d.village), array_agg(d.municipality),
+                                 array_agg(0::numeric), array_agg(0), array_agg(-1), array_agg(-COALESCE(tt.kva_rating, 0)))
+        FROM old_rows AS d LEFT JOIN gis.transformer_type AS tt ON tt.name = d.transformer_type;
+    ELSE
+        PERFORM gis.rollup_apply(array_agg(d.substation_id), array_agg(d.village), array_agg(d.municipality),
+                                 array_agg(0::numeric), array_agg(0), array_agg(d.transformers), array_agg(d.kva))
+        FROM (
+            SELECT n.substation_id, n.village, n.municipality, 1 AS transformers, COALESCE(tt.kva_rating, 0) AS kva
+            FROM new_rows AS n LEFT JOIN gis.transformer_type AS tt ON tt.name = n.transformer_type
+            UNION ALL
+            SELECT o.substation_id, o.village, o.municipality, -1, -COALESCE(tt.kva_rating, 0)
+            FROM old_rows AS o LEFT JOIN gis.transformer_type AS tt ON tt.name = o.transformer_type
+        ) AS d;
+    END IF;
+    RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+rollup_transformer_type = DDL(
+    """
+    CREATE OR REPLACE FUNCTION gis.rollup_transformer_type()
+    RETURNS TRIGGER AS $$
+    BEGIN
+    PERFORM gis.rollup_apply(array_agg(dt.substation_id), array_agg(dt.village), array_agg(dt.municipality),
+                             array_agg(0::numeric), array_agg(0), array_agg(0),
+                             array_agg(COALESCE(n.kva_rating, 0) - COALESCE(o.kva_rating, 0)))
+    FROM old_rows AS o
+    JOIN new_rows AS n ON n.id = o.id
+    JOIN gis.distribution_transformer AS dt ON dt.transformer_type = o.name
+    WHERE n.kva_rating IS DISTINCT FROM o.kva_rating;
+    RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+# FULL RECOMPUTE, FILLS AN EXISTING DATABASE AND FOLLOWS THE BULK LOAD (ITS TRIGGERS ARE OFF)
+# THE SHARE LOCKS HOLD OFF WRITERS UNTIL THE COMMIT SO NO DELTA IS LOST OR COUNTED TWICE
+rollup_rebuild = DDL(
+    """
+    CREATE OR REPLACE FUNCTION gis.rollup_rebuild()
+    RETURNS void AS $$
+    BEGIN
+    LOCK TABLE gis.primary_lines, gis.distribution_transformer, gis.transformer_type IN SHARE MODE;
+    DELETE FROM gis.network_rollup;
+    PERFORM gis.rollup_apply(array_agg(d.substation_id), array_agg(d.village), array_agg(d.municipality),
+                             array_agg(d.meters), array_agg(d.lines), array_agg(d.transformers), array_agg(d.kva))
+    FROM (
+        SELECT substation_id, village, municipality, COALESCE(length_meters, 0) AS meters, 1 AS lines,
+               0 AS transformers, 0::numeric AS kva
+        FROM gis.primary_lines
+        UNION ALL
+        SELECT dt.substation_id, dt.village, dt.municipality, 0, 0, 1, COALESCE(tt.kva_rating, 0)
+        FROM gis.distribution_transformer AS dt
+        LEFT JOIN gis.transformer_type AS tt ON tt.name = dt.transformer_type
+    ) AS d;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+# TRANSITION TABLES NEED ONE TRIGGER PER EVENT, TRUNCATE RECOMPUTES
+rollup_triggers = DDL(
+    """
+    DO
+    $$
+    DECLARE tbl text;
+    BEGIN
+    FOREACH tbl IN ARRAY ARRAY['primary_lines', 'distribution_transformer']
+    LOOP
+        EXECUTE format('CREATE OR REPLACE TRIGGER %%I AFTER INSERT ON gis.%%I REFERENCING NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION gis.%%I()', 'rollup_insert_' || tbl, tbl, 'rollup_' || tbl);
+        EXECUTE format('CREATE OR REPLACE TRIGGER %%I AFTER UPDATE ON gis.%%I REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION gis.%%I()', 'rollup_update_' || tbl, tbl, 'rollup_' || tbl);
+        EXECUTE format('CREATE OR REPLACE TRIGGER %%I AFTER DELETE ON gis.%%I REFERENCING OLD TABLE AS old_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION gis.%%I()', 'rollup_delete_' || tbl, tbl, 'rollup_' || tbl);
+        EXECUTE format('CREATE OR REPLACE TRIGGER %%I AFTER TRUNCATE ON gis.%%I
+                        FOR EACH STATEMENT EXECUTE FUNCTION gis.rollup_truncate()', 'rollup_truncate_' || tbl, tbl);
+    END LOOP;
+    CREATE OR REPLACE TRIGGER rollup_update_transformer_type
+    AFTER UPDATE ON gis.transformer_type REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION gis.rollup_transformer_type();
+    -- FILLS THE ROLLUPS OF AN EXISTING DATABASE, create.py RUNS THIS IN ONE TRANSACTION WITH THE TRIGGERS
+    PERFORM gis.rollup_rebuild();
+    END $$;
+    """
+)
+
+rollup_truncate = DDL(
+    """
+    CREATE OR REPLACE FUNCTION gis.rollup_truncate()
+    RETURNS TRIGGER AS $$
+    BEGIN
+    PERFORM gis.rollup_rebuild();
+    RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+# -----------------------------------------------------------------------------------------------------------------------------------------
+# PUBLISHED LAYERS (PUBLISHEDLAYERS=true), EACH ROW OF THE /mapdata LAYERS KEEPS ITS GeoJSON Feature TEXT IN feature_json
+# THE PROPERTIES /mapdata EMITS PER LAYER, services/mapdata.py READS THEM FROM HERE
+# voltage_rating IS WRITTEN AS PYTHON WROTE float(voltage_rating), 69.0 NOT 69 OR 69.00, 13.2 WHEN EMPTY
+FEATURE_PROPERTIES = dict(
+    substation = """
+            t.generator_name AS substation_name,
+            t.description,
+            (CASE WHEN t.voltage_rating IS NULL THEN '13.2'
+                  WHEN t.voltage_rating = trunc(t.voltage_rating) THEN trunc(t.voltage_rating)::text || '.0'
+                  ELSE t.voltage_rating::float8::text END)::json AS voltage_rating,
+            t.isactive,
+            t.village,
+            t.municipality,
+            t.image""",
+    primary_lines = """
+            t.line_id AS primary_line_id,
+            t.from_node,
+            t.to_node,
+            t.isactive""",
+    distribution_transformer = """
+            t.transformer_id,
+            t.description,
+            t.transformer_type AS type,
+            t.village,
+            t.municipality,
+            t.image,
+            t.isactive""",
+)
+
+def feature_render_sql(table:str) -> str:
+    '''Feature text of the row t, the same JSON services/mapdata.feature_columns builds'''
+    return f"""(
+        SELECT row_to_json(f)::text FROM (
+            SELECT 'Feature' AS type, t.id, ST_AsGeoJSON(t.geom, 6)::json AS geometry,
+            (SELECT row_to_json(p) FROM (SELECT {FEATURE_PROPERTIES[table]}) AS p) AS properties
+        ) AS f)"""
+
+# ONLY ROWS WHOSE TEXT CHANGES ARE WRITTEN, ALSO RUN BY THE BULK LOAD (ITS TRIGGERS ARE OFF)
+def republish_sql(table:str) -> str:
+    return f"""
+        UPDATE gis.{table} AS u SET feature_json = r.feature_json
+        FROM (SELECT t.id, {feature_render_sql(table)} AS feature_json FROM gis.{table} AS t) AS r
+        WHERE u.id = r.id AND u.feature_json IS DISTINCT FROM r.feature_json"""
+
+def publish_layer(table:str) -> list[DDL]:
+    '''Column, trigger and backfill of one published layer'''
+    # ONLY AN UPDATE OF THE GEOMETRY OR A COLUMN IN THE PROPERTIES RENDERS AGAIN
+    columns = ", ".join(dict.fromkeys(["geom", *re.findall(r"\bt\.(\w+)", FEATURE_PROPERTIES[table])]))
+    return [
+        DDL(f"ALTER TABLE gis.{table} ADD COLUMN IF NOT EXISTS feature_json text"),
+        DDL(f"""
+        CREATE OR REPLACE FUNCTION gis.publish_{table}()
+        RETURNS TRIGGER AS $$
+        BEGIN
+        new.feature_json:= (SELECT {feature_render_sql(table)} FROM (SELECT new.*) AS t);
+        RETURN new;
+        END;
+        $$ LANGUAGE plpgsql;
+        """),
+        # BEFORE TRIGGERS RUN IN NAME ORDER, zz_ RENDERS AFTER THE TRIGGERS THAT SET village, municipality, from_node ..
+        DDL(f"""
+        CREATE OR REPLACE TRIGGER zz_publish_{table}
+        BEFORE INSERT OR UPDATE OF {columns} ON gis.{table}
+        FOR EACH ROW EXECUTE FUNCTION gis.publish_{table}()
+        """),
+        # THE BACKFILL ONLY WRITES feature_json, NO gis_changes NOTIFY OR ROLLUP DELTA PER ROW
+        # REPLICA MODE FOR THE BACKFILL ONLY, LIKE THE BULK LOAD: NO ACCESS EXCLUSIVE LOCK AND A TRIGGER
+        # DISABLED BY HAND STAYS DISABLED. create_supa_table RUNS IN ONE TRANSACTION, SET LOCAL ENDS WITH IT
+        DDL("SET LOCAL session_replication_role = replica"),
+        DDL(republish_sql(table)),
+        DDL("SET LOCAL session_replication_role = DEFAULT"),
+    ]
+
+# WITH PUBLISHEDLAYERS OFF THE COLUMN IS DROPPED, NO STALE TEXT IS LEFT BEHIND
+def unpublish_layer(table:str) -> list[DDL]:
+    return [
+        DDL(f"DROP TRIGGER IF EXISTS zz_publish_{table} ON gis.{table}"),
+        DDL(f"ALTER TABLE gis.{table} DROP COLUMN IF EXISTS feature_json"),
+    ]
+
+# -----------------------------------------------------------------------------------------------------------------------------------------
+# INDEXES FOR THE TRIGGER LOOKUPS, SAME NAME AS THE GEOALCHEMY2 GIST INDEX SO A DATABASE CREATED WITH IT GETS NO COPY
+# THE ST_STARTPOINT / ST_ENDPOINT EXPRESSION INDEXES ARE USED WHEN THE QUERY HAS THE SAME EXPRESSION, E.G ST_INTERSECTS(ST_ENDPOINT(pl.geom), ..)
+trigger_indexes = DDL(
+    """
+    DO $$
+    BEGIN
+    CREATE INDEX IF NOT EXISTS idx_franchise_area_geom ON gis.franchise_area USING gist (geom);
+    CREATE INDEX IF NOT EXISTS idx_primary_lines_startpoint ON gis.primary_lines USING gist (ST_STARTPOINT(geom));
+    CREATE INDEX IF NOT EXISTS idx_primary_lines_endpoint ON gis.primary_lines USING gist (ST_ENDPOINT(geom));
+    CREATE INDEX IF NOT EXISTS idx_line_bushing_startpoint ON gis.line_bushing USING gist (ST_STARTPOINT(geom));
+    CREATE INDEX IF NOT EXISTS idx_line_bushing_endpoint ON gis.line_bushing USING gist (ST_ENDPOINT(geom));
+    -- gis.node_is_active() CASCADES BY substation_id
+    CREATE INDEX IF NOT EXISTS ix_gis_nodes_substation_id ON gis.nodes (substation_id);
+    CREATE INDEX IF NOT EXISTS ix_gis_primary_lines_substation_id ON gis.primary_lines (substation_id);
+    CREATE INDEX IF NOT EXISTS ix_gis_distribution_transformer_substation_id ON gis.distribution_transformer (substation_id);
+    END $$;
+    """
+)
+
+
+# -----------------------------------------------------------------------------------------------------------------------------------------
+# CHANGE FEED, EVERY ROW CHANGE ON THE MAP LAYERS IS SENT ON THE gis_changes CHANNEL AS
+# {"layer": "<table>", "op": "INSERT|UPDATE|DELETE", "id": <id>, "bbox": [xmin, ymin, xmax, ymax]}
+notify_change = DDL(
+    """
+    CREATE OR REPLACE FUNCTION gis.notify_change()
+    RETURNS TRIGGER AS $$
+    DECLARE row_id int;
+    DECLARE box box2d;
+    BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_id:= old.id;
+        box:= box2d(old.geom);
+    ELSIF TG_OP = 'UPDATE' THEN
+        row_id:= new.id;
+        box:= box2d(ST_COLLECT(COALESCE(old.geom, new.geom), COALESCE(new.geom, old.geom)));
+    ELSE
+        row_id:= new.id;
+        box:= box2d(new.geom);
+    END IF;
+    PERFORM pg_notify('gis_changes', json_build_object(
+        'layer', TG_TABLE_NAME,
+        'op', TG_OP,
+        'id', row_id,
+        'bbox', CASE WHEN box IS NULL THEN NULL
+                ELSE json_build_array(ST_XMIN(box), ST_YMIN(box), ST_XMAX(box), ST_YMAX(box)) END
+    )::text);
+    RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+# UPDATES THAT CHANGE NOTHING ARE NOT SENT
+notify_change_trigger = DDL(
+    """
+    DO
+    $$
+    DECLARE tbl text;
+    BEGIN
+    FOREACH tbl IN ARRAY ARRAY['substation', 'nodes', 'primary_lines', 'distribution_transformer', 'line_bushing']
+    LOOP
+        IF NOT EXISTS(
+            SELECT 1 FROM pg_trigger WHERE tgname = 'notify_change_' || tbl
+        ) THEN
+        EXECUTE format('CREATE TRIGGER %%I AFTER INSERT OR DELETE ON gis.%%I
+                        FOR EACH ROW EXECUTE FUNCTION gis.notify_change()', 'notify_change_' || tbl, tbl);
+        END IF;
+        IF NOT EXISTS(
+            SELECT 1 FROM pg_trigger WHERE tgname = 'notify_update_' || tbl
+        ) THEN
+        EXECUTE format('CREATE TRIGGER %%I AFTER UPDATE ON gis.%%I
+                        FOR EACH ROW WHEN (old.* IS DISTINCT FROM new.*)
+                        EXECUTE FUNCTION gis.notify_change()', 'notify_update_' || tbl, tbl);
+        END IF;
+    END LOOP;
+    END $$;
+    """
+)
@@ -0,0 +1,96 @@
+from typing import Callable, Optional
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# PATH OF THE SQLITE FILE, NEXT TO token.json BY DEFAULT
+MANIFEST_PATH = os.getenv("UPLOADMANIFEST", "upload_manifest.sqlite3")
+
+
+class UploadManifest:
+    '''Uploaded files by (target, asset): path, size, mtime, sha256 and the url they were uploaded to.
+    An unchanged file is never uploaded again, its url is reused. Safe to call from the upload threads'''
+    def __init__(self, path:str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection: Optional[sqlite3.Connection] = None
+        self.reused = 0
+        self.uploaded = 0
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS manifest (
+                    target TEXT NOT NULL,
+                    asset TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    uploaded_at REAL NOT NULL,
+                    PRIMARY KEY (target, asset)
+                )""")
+            self.connection.commit()
+        return self.connection
+
+    def entry(self, target:str, asset:str) -> Optional[tuple]:
+        with self.lock:
+            return self.connect().execute(
+                "SELECT path, size, mtime_ns, sha256, url FROM manifest WHERE target = ? AND asset = ?",
+                (target, asset)).fetchone()
+
+    def record(self, target:str, asset:str, path:str, stat:os.stat_result, sha256:str, url:str):
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (target, asset, path, stat.st_size, stat.st_mtime_ns, sha256, url, time.time()))
+            connection.commit()
+
+    def count(self, counter:str):
+        # CALLED FROM THE UPLOAD THREADS
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @staticmethod
+    def sha256(path:str) -> str:
+        with open(path, "rb") as fs:
+            return hashlib.file_digest(fs, "sha256").hexdigest()
+
+    def cached(self, target:str, asset:str, path:str, upload:Callable[[], Optional[str]]) -> Optional[str]:
+        '''Url of the asset's file, upload() is only called when the file is new or its content changed'''
+        stat = os.stat(path)
+        entry = self.entry(target, asset)
+        if entry is not None:
+            old_path, size, mtime_ns, old_sha256, url = entry
+            # SAME FILE, SIZE AND MTIME, THE CONTENT IS NOT READ
+            if (old_path, size, mtime_ns) == (path, stat.st_size, stat.st_mtime_ns):
+                self.count("reused")
+                logger.debug("UPLOAD SKIPPED, UNCHANGED: %s", asset)
+                return url
+        sha256 = self.sha256(path)
+        if entry is not None and sha256 == old_sha256:
+            # TOUCHED OR MOVED BUT THE SAME PHOTO
+            self.record(target, asset, path, stat, sha256, url)
+            self.count("reused")
+            logger.debug("UPLOAD SKIPPED, SAME CONTENT: %s", asset)
+            return url
+        url = upload()
+        if url is not None:
+            self.record(target, asset, path, stat, sha256, url)
+        self.count("uploaded")
+        return url
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.connect().execute("SELECT count(*) FROM manifest").fetchone()[0]
+        return dict(path=self.path, entries=entries, reused=self.reused, uploaded=self.uploaded)
+
+upload_manifest = UploadManifest(MANIFEST_PATH)
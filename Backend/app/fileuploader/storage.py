@@ -0,0 +1,160 @@
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.http import MediaFileUpload
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+from dotenv import load_dotenv
+from .manifest import upload_manifest
+from .gd_uploader import GoogleFileUploader
+import httpx
+import mimetypes
+import os
+import shutil
+import threading
+
+load_dotenv()
+
+# STORAGE BACKEND OF EACH KIND OF ASSET: supabase, drive OR local
+# E.G SUBSTATIONSTORAGE=local TO SYNC OFFLINE OR TO BENCHMARK WITHOUT THE NETWORK
+STORAGE_DEFAULTS = dict(
+    substation = "supabase",
+    transformer = "drive",
+)
+
+
+class StorageBackend(ABC):
+    '''Long lived client of one storage, upload() is blocking and is called from the upload pool threads'''
+    target = "storage"
+
+    @abstractmethod
+    def upload(self, key:str, path:str) -> Optional[str]:
+        '''Store the file under key, returns its url'''
+
+    def upload_cached(self, key:str, path:str) -> Optional[str]:
+        # SKIPS THE UPLOAD WHEN THE FILE DID NOT CHANGE SINCE IT WAS LAST UPLOADED
+        return upload_manifest.cached(self.target, key, path, lambda: self.upload(key, path))
+
+    def close(self):
+        pass
+
+
+class LocalStorage(StorageBackend):
+    '''Copies the files to a directory, the url is STORAGEURL/<key> or a file:// url'''
+    def __init__(self, root:str, base_url:Optional[str] = None):
+        self.root = Path(root)
+        self.base_url = base_url.rstrip("/") if base_url else None
+        self.target = f"local:{self.root.resolve()}"
+
+    def upload(self, key:str, path:str) -> Optional[str]:
+        destination = (self.root / key).resolve()
+        # AN ABSOLUTE KEY OR ONE WITH .. WOULD WRITE OUTSIDE THE ROOT (OR OVER THE SOURCE FILE)
+        if not destination.is_relative_to(self.root.resolve()):
+            raise ValueError(f"storage key {key} is outside {self.root}")
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(path, destination)
+        return f"{self.base_url}/{key}" if self.base_url else destination.as_uri()
+
+
+class SupabaseStorage(StorageBackend):
+    '''One HTTP/2 client for every upload, the connection is kept open and shared by the upload threads'''
+    def __init__(self, project_id:Optional[str], api_key:Optional[str], bucket:Optional[str]):
+        self.api_key = api_key
+        self.bucket = bucket
+        self.project_url = f"https://{project_id}.storage.supabase.co"
+        self.target = f"supabase:{bucket}"
+        self.client = httpx.Client(
+            base_url = self.project_url,
+            http2 = True,
+            headers = {"Authorization": f"Bearer {api_key}", "apikey": api_key or ""},
+            timeout = httpx.Timeout(60, connect=10),
+        )
+
+    def upload(self, key:str, path:str) -> Optional[str]:
+        if not self.api_key or not self.bucket:
+            raise RuntimeError("SUPABASEAPIKEY and BUCKETNAME have to be set")
+        with open(path, "rb") as fs:
+            response = self.client.post(
+                f"/storage/v1/object/{self.bucket}/{key}",
+                content = fs.read(),
+                headers = {
+                    "x-upsert": "true",
+                    "content-type": mimetypes.guess_type(path)[0] or "image/jpeg",
+                    "cache-control": "3600",
+                },
+            )
+        response.raise_for_status()
+        return f"{self.project_url}/storage/v1/object/public/{self.bucket}/{key}"
+
+    def close(self):
+        self.client.close()
+
+
+class DriveStorage(StorageBackend):
+    '''Authenticates once, the drive service is built once per upload thread (it is not thread safe)'''
+    SCOPES = ["https://www.googleapis.com/auth/drive"]
+
+    def __init__(self, folder_id:str):
+        self.folder_id = folder_id
+        self.target = f"drive:{folder_id}"
+        self.credentials: Optional[Credentials] = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def authenticate(self) -> Credentials:
+        # token.json IS READ ONCE, THEN ONLY REFRESHED WHEN IT EXPIRES
+        with self.lock:
+            if self.credentials is None or not self.credentials.valid:
+                self.credentials = GoogleFileUploader().authenticate()
+            return self.credentials
+
+    def service(self):
+        creds = self.authenticate()
+        if getattr(self.local, "creds", None) is not creds:
+            self.local.service = build("drive", "v3", credentials=creds, cache_discovery=False)
+            self.local.creds = creds
+        return self.local.service
+
+    def upload(self, key:str, path:str) -> Optional[str]:
+        media = MediaFileUpload(path, mimetype=mimetypes.guess_type(path)[0] or "image/jpeg")
+        file = (
+            self.service().files()
+            .create(body={"name": key, "parents": [self.folder_id]}, media_body=media, fields="id")
+            .execute()
+        )
+        return f"https://drive.google.com/thumbnail?id={file.get('id')}&sz=w500"
+
+
+def create_backend(name:str) -> StorageBackend:
+    if name == "local":
+        return LocalStorage(os.getenv("STORAGEROOT", "uploads"), os.getenv("STORAGEURL"))
+    if name == "supabase":
+        return SupabaseStorage(os.getenv("PROJECTID"), os.getenv("SUPABASEAPIKEY"), os.getenv("BUCKETNAME"))
+    if name == "drive":
+        return DriveStorage(os.getenv("DRIVEFOLDERID", "1g8nMDoKE-HGCxl1QolkKXQUOD_EepGit"))
+    raise ValueError(f"unknown storage backend {name}")
+
+
+class StorageRegistry:
+    '''One backend per kind of asset, created on first use and shared by every request'''
+    def __init__(self):
+        self.backends: dict[str, StorageBackend] = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind:str) -> StorageBackend:
+        with self.lock:
+            if kind not in self.backends:
+                name = os.getenv(f"{kind.upper()}STORAGE", STORAGE_DEFAULTS[kind])
+                self.backends[kind] = create_backend(name)
+            return self.backends[kind]
+
+    def close(self):
+        with self.lock:
+            for backend in self.backends.values():
+                backend.close()
+            self.backends.clear()
+
+    def stats(self) -> dict:
+        return {kind: backend.target for kind, backend in self.backends.items()}
+
+storage_registry = StorageRegistry()
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Callable, NamedTuple, Optional
+from ..db.sessesion import env_int
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# THREADS UPLOADING AT THE SAME TIME, THE TUS AND DRIVE CLIENTS ARE BLOCKING
+UPLOAD_WORKERS = env_int("UPLOADWORKERS", 4)
+
+class UploadResult(NamedTuple):
+    asset: str
+    url: Optional[str]
+    error: Optional[str]
+    seconds: float
+    # THE ASSET HAD NOTHING TO UPLOAD
+    skipped: bool = False
+
+
+class UploadPool:
+    '''Blocking uploads run on a bounded thread pool so the event loop keeps serving /mapdata and the websockets'''
+    def __init__(self, workers:int):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+        self.pending = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.recent_failures: deque[UploadResult] = deque(maxlen=100)
+
+    @staticmethod
+    def run(job:Callable[[], Optional[str]]) -> tuple[Optional[str], Optional[str], float]:
+        started = time.perf_counter()
+        try:
+            return job(), None, time.perf_counter() - started
+        except Exception as exc:
+            return None, f"{type(exc).__name__}: {exc}", time.perf_counter() - started
+
+    async def upload(self, asset:str, job:Optional[Callable[[], Optional[str]]]) -> UploadResult:
+        '''Run job() on the pool, job returns the url of the uploaded file. None means the asset has nothing to upload'''
+        if job is None:
+            return UploadResult(asset, None, None, 0.0, skipped=True)
+        self.pending += 1
+        try:
+            url, error, seconds = await asyncio.get_running_loop().run_in_executor(self.executor, self.run, job)
+        finally:
+            self.pending -= 1
+        result = UploadResult(asset, url, error, round(seconds, 3))
+        if error is None:
+            self.uploaded += 1
+            logger.debug("UPLOADED: %s (%ss)", asset, result.seconds)
+        else:
+            self.failed += 1
+            self.recent_failures.append(result)
+            logger.warning("UPLOAD FAILED: %s %s", asset, error)
+        return result
+
+    async def upload_all(self, jobs:list[tuple[str, Optional[Callable[[], Optional[str]]]]]) -> list[UploadResult]:
+        '''(asset, job) pairs, results come back in the same order'''
+        return await asyncio.gather(*(self.upload(asset, job) for asset, job in jobs))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return dict(
+            workers = self.workers,
+            pending = self.pending,
+            uploaded = self.uploaded,
+            failed = self.failed,
+            recent_failures = [result._asdict() for result in self.recent_failures],
+        )
+
+upload_pool = UploadPool(UPLOAD_WORKERS)
+
+
+def upload_report(results:list[UploadResult]) -> dict:
+    '''Per asset outcome returned by the sync routes'''
+    attempted = [result for result in results if not result.skipped]
+    return dict(
+        uploaded = sum(1 for result in attempted if result.error is None),
+        failed = [dict(asset=result.asset, error=result.error) for result in attempted if result.error is not None],
+    )
@@ -1,8 +1,34 @@
 from fastapi import FastAPI
+from contextlib import asynccontextmanager
 from .routes.update_supabase import router
-from .routes.map_router import map_router
+from .routes.map_router import map_router, publish_changes
+from .routes.monitor_router import monitor_router
+from .routes.tile_router import tile_router
+from .routes.network_router import network_router
+from .routes.stats_router import stats_router
+from .db.sessesion import engine_registry
+from .services.listener import change_listener
+from .services.layer_store import layer_store
+from .fileuploader.upload_pool import upload_pool
+from .fileuploader.storage import storage_registry
 from fastapi.middleware.cors import CORSMiddleware
-app = FastAPI()
+
+
+# CREATE THE ENGINES ONCE PER PROCESS AND CLOSE THEIR POOLS ON SHUTDOWN
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    await engine_registry.start()
+    # OPTIONAL IN-MEMORY COPY OF THE MAP LAYERS (LAYERSTORE=true)
+    await layer_store.start()
+    # ONE LISTEN CONNECTION PER WORKER FOR THE gis_changes FEED
+    await change_listener.start(publish_changes)
+    yield
+    await change_listener.stop()
+    upload_pool.shutdown()
+    storage_registry.close()
+    await engine_registry.dispose()
+
+app = FastAPI(lifespan=lifespan)
 
 
 app.add_middleware(
@@ -15,3 +41,7 @@ app.add_middleware(
 
 app.include_router(router)
 app.include_router(map_router)
+app.include_router(monitor_router)
+app.include_router(tile_router)
+app.include_router(network_router)
+app.include_router(stats_router)
@@ -1,19 +1,28 @@
-from fastapi import APIRouter, Depends, WebSocket, Form, WebSocketDisconnect
+from fastapi import APIRouter, Depends, WebSocket, Form, WebSocketDisconnect, WebSocketException, status, Request, Response
 from fastapi.exceptions import HTTPException
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel import select, asc
-from ..db.sessesion import Db
+from ..db.sessesion import engine_registry
 from ..db.supa_model import PrimaryLines, Substation, DistributionTransformer
 from geoalchemy2 import functions
 from geojson import Point, FeatureCollection, Feature, loads, load
 from ..sockets.ws import ConnectionManager
+from ..services.changes import substation_changed, rows_changed
+from ..services.listener import change_listener
+from ..services.snapshot import snapshot_cache, etag_matches
+from ..services.viewport import Viewport, parse_viewport
+from ..services.mapdata import build_mapdata
+from ..services.layer_store import layer_store, nearest_features, STORE_LAYERS
+from ..services.deltas import layers_json, substation_changes, feature_changes, RESYNC_REQUIRED
+from ..services.subscriptions import parse_subscription
+from typing import Optional
 import asyncio
 import json
 
 map_router = APIRouter()
 # ASYNC FUNCTION TO YIEL SESSION
 async def get_suppasession():
-    async with AsyncSession(Db().supa_engine) as session:
+    async with AsyncSession(engine_registry.supa_engine) as session:
         yield session
 
 supasessionDep = Depends(get_suppasession)
@@ -21,121 +30,148 @@ supasessionDep = Depends(get_suppasession)
 # WEB SOCKET MANAGER
 manager = ConnectionManager()
 
-async def get_mapdata(supassession:AsyncSession):
-    # SUBSTATION DATA
-    substation_data = await supassession.exec(
-        select(
-            Substation.id,
-            functions.ST_AsGeoJSON(Substation.geom).label("geometry"),
-            Substation.generator_name,
-            Substation.description,
-            Substation.voltage_rating,
-            Substation.isactive,
-            Substation.village,
-            Substation.municipality,
-            Substation.image
-        ).order_by(asc(Substation.id))
-    )
-    
-    sub_feat = {
-        "substation": [
-            Feature(
-                id= substation_id,
-                geometry= loads (geometry),
-                properties=dict(
-                    substation_name = generator_name,
-                    description = description,
-                    voltage_rating = float(voltage_rating) if voltage_rating is not None else 13.2,
-                    isactive = isactive,
-                    village = village,
-                    municipality = municipality,
-                    image = image
-                )
-            ) for 
-            substation_id, 
-            geometry, 
-            generator_name,
-            description,
-            voltage_rating, 
-            isactive,
-            village, 
-            municipality,
-            image
-            in substation_data
-        ]
-    }
-  
-    # PRIMARY LINE DATA
-    primary_line_data = await supassession.exec(
-        select(
-            PrimaryLines.id,
-            functions.ST_AsGeoJSON(PrimaryLines.geom).label("geometry"),
-            PrimaryLines.line_id,
-            PrimaryLines.from_node,
-            PrimaryLines.to_node,
-            PrimaryLines.isactive
-            ).order_by(asc(PrimaryLines.id)))
-    
-    pl_feat = {"primary_lines":[
-        Feature(
-            id = pl_id,
-            geometry = loads(geometry),
-            properties = dict(
-                primary_line_id = line_id,
-                from_node = from_node,
-                to_node = to_node,
-                isactive = isactive
-            )) for pl_id, geometry,line_id, from_node, to_node, isactive in primary_line_data]}
-    
-    # TRANSFORMER DATA
-    transformer_data = await supassession.exec(select(DistributionTransformer.id,
-                                                      functions.ST_AsGeoJSON(DistributionTransformer.geom).label("geometry"),
-                                                      DistributionTransformer.transformer_id,
-                                                      DistributionTransformer.description,
-                                                      DistributionTransformer.transformer_type,
-                                                      DistributionTransformer.village,
-                                                      DistributionTransformer.municipality,
-                                                      DistributionTransformer.image,
-                                                      DistributionTransformer.isactive
-                                                      ))
-    transformer_feat = {
-        "distribtion_transformer":
-        [
-          Feature(
-              geometry=loads(dt_geom),
-              id= dt_id,
-              properties=dict(
-                  transformer_id = dt_name,
-                  description = dt_descripiton,
-                  type = dt_transformer_type,
-                  village = dt_village,
-                  municipality = dt_municipality,
-                  image = dt_image,
-                  isactive = dt_isactive
-              )
-              ) for dt_id, dt_geom , dt_name, dt_descripiton, dt_transformer_type, dt_village, dt_municipality, dt_image, dt_isactive in transformer_data
-        ]
-    }
-    return FeatureCollection(features=[sub_feat,pl_feat, transformer_feat])
+# VIEWPORT QUERY PARAMETERS
+def viewport_params(bbox:Optional[str] = None, zoom:Optional[int] = None) -> Viewport:
+    try:
+        return parse_viewport(bbox, zoom)
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
+viewportDep = Depends(viewport_params)
+
+# CURRENT SNAPSHOT OF THE VIEWPORT, ONLY BUILT ONCE PER DATA VERSION
+# THE SESSION IS ONLY OPENED ON A CACHE MISS AND CLOSED RIGHT AFTER
+# WITH LAYERSTORE=true THE SNAPSHOT IS BUILT FROM THE IN-MEMORY LAYERS
+async def build_snapshot(viewport:Viewport) -> bytes:
+    if layer_store.loaded:
+        return await layer_store.build_mapdata(viewport)
+    async with AsyncSession(engine_registry.supa_engine) as supasession:
+        return await build_mapdata(supasession, viewport)
+
+async def get_snapshot(viewport:Viewport) -> tuple[str, bytes]:
+    return await snapshot_cache.get(viewport, lambda: build_snapshot(viewport))
+
+# PUSH CHANGES ONLY TO THE CONNECTIONS SUBSCRIBED TO THEM, None MEANS A BULK CHANGE EVERYONE RELOADS
+async def push_changes(changes:Optional[list]):
+    if changes is None:
+        routed = dict.fromkeys(manager.active_connections, [])
+    else:
+        routed = manager.route(changes)
+    version = snapshot_cache.version
+    full_groups: dict[Viewport, list[WebSocket]] = {}
+    shared_layers: dict[tuple, str] = {}
+    for websocket, client_changes in routed.items():
+        client = manager.clients.get(websocket)
+        if client is None:
+            continue
+        if not client.delta:
+            full_groups.setdefault(client.viewport, []).append(websocket)
+        elif changes is None:
+            manager.send(websocket, RESYNC_REQUIRED)
+        else:
+            # CLIENTS WITH THE SAME CHANGES SHARE ONE SERIALIZED PAYLOAD
+            key = tuple(id(change) for change in client_changes)
+            if key not in shared_layers:
+                shared_layers[key] = layers_json(client_changes)
+            manager.send_delta(websocket, version, shared_layers[key])
+    # ONE QUERY PER DISTINCT VIEWPORT, NOT PER CLIENT
+    for viewport, connections in full_groups.items():
+        _, feat = await get_snapshot(viewport)
+        await manager.broadcast(feat.decode(), connections)
+
+# CALLED BY THE CHANGE LISTENER WITH EVERY COALESCED gis_changes BATCH
+async def publish_changes(pending:dict):
+    rows_changed(pending)
+    if not manager.clients:
+        return
+    async with AsyncSession(engine_registry.supa_engine) as supasession:
+        changes = await feature_changes(supasession, pending)
+    await push_changes(changes)
 
 @map_router.get("/mapdata")
-async def get_data(session:AsyncSession = supasessionDep):
-    data = await get_mapdata(session)
-    return data
+async def get_data(request:Request, viewport:Viewport = viewportDep):
+    etag, data = await get_snapshot(viewport)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type="application/json", headers=headers)
+
+# FEATURES OF A LAYER NEAREST TO A POINT
+@map_router.get("/mapdata/nearest")
+async def get_nearest(lon:float, lat:float, layer:str = "substation", limit:int = 1):
+    if layer not in STORE_LAYERS:
+        raise HTTPException(status_code=404, detail=f"unknown layer {layer}")
+    if not 1 <= limit <= 100:
+        raise HTTPException(status_code=422, detail="limit must be between 1 and 100")
+    if layer_store.loaded:
+        features = await layer_store.nearest(layer, lon, lat, limit)
+    else:
+        async with AsyncSession(engine_registry.supa_engine) as supasession:
+            features = await nearest_features(supasession, layer, lon, lat, limit)
+    data = f'{{"type":"FeatureCollection","features":[{",".join(features)}]}}'
+    return Response(content=data, media_type="application/json")
 
 # REAL-TIME MAP WEBSOCKETE DATA
+# THE VIEWPORT IS SENT ON THE HANDSHAKE (/ws/mapdata?bbox=..&zoom=..)
+# AND CAN BE CHANGED LATER BY SENDING {"bbox": "..", "zoom": ..}
+# WITH delta=true UPDATES ARE SENT AS DELTAS, SEE services/deltas.py
+# layers, municipality, village AND substation_id (COMMA SEPARATED) LIMIT WHICH CHANGES ARE PUSHED,
+# {"type": "subscribe", "layers": [..], "municipality": [..], ..} REPLACES THE SUBSCRIPTION
+# CHANGES ARE PUSHED BY THE gis_changes LISTENER, THE SOCKET HOLDS NO DB SESSION
 @map_router.websocket("/ws/mapdata")
-async def get_latest_substation(websocket:WebSocket, supasession:AsyncSession = supasessionDep):
-    await manager.connect(websocket)
-    # INITIAL DATA 
-    feat = await get_mapdata(supasession)
-    await manager.broadcast_json(feat)
+async def get_latest_substation(websocket:WebSocket,
+                                bbox:Optional[str] = None,
+                                zoom:Optional[int] = None,
+                                delta:bool = False,
+                                layers:Optional[str] = None,
+                                municipality:Optional[str] = None,
+                                village:Optional[str] = None,
+                                substation_id:Optional[str] = None):
     try:
+        viewport = parse_viewport(bbox, zoom)
+        subscription = parse_subscription(layers, municipality, village, substation_id)
+    except ValueError as exc:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=str(exc))
+
+    async def send_snapshot():
+        version = snapshot_cache.version
+        _, feat = await get_snapshot(viewport)
+        manager.send_snapshot(websocket, version, feat)
+
+    await manager.connect(websocket, viewport, delta, subscription)
+    try:
+        # INITIAL DATA
+        await send_snapshot()
         while True:
-            await asyncio.sleep(1)
+            # A FRAME THAT IS NOT JSON IS AN ERROR FOR THAT MESSAGE, THE CONNECTION STAYS OPEN
+            try:
+                message = json.loads(await websocket.receive_text())
+            except ValueError as exc:
+                manager.send(websocket, json.dumps({"error": str(exc)}))
+                continue
+            if isinstance(message, dict) and message.get("type") == "resync":
+                await send_snapshot()
+                continue
+            if isinstance(message, dict) and message.get("type") == "subscribe":
+                try:
+                    manager.subscribe(websocket, parse_subscription(
+                        message.get("layers"), message.get("municipality"),
+                        message.get("village"), message.get("substation_id")))
+                except (ValueError, TypeError) as exc:
+                    manager.send(websocket, json.dumps({"error": str(exc)}))
+                continue
+            try:
+                viewport = parse_viewport(message.get("bbox"), message.get("zoom"))
+            except (ValueError, TypeError, AttributeError) as exc:
+                manager.send(websocket, json.dumps({"error": str(exc)}))
+                continue
+            manager.set_viewport(websocket, viewport)
+            await send_snapshot()
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
-   
+
 # UPDATE SUBSTATION AND BROADCAST THE CHANGE
 @map_router.post("/update/substation")
 async def update_substation(supassession:AsyncSession = supasessionDep,
@@ -147,11 +183,8 @@ async def update_substation(supassession:AsyncSession = supasessionDep,
     supassession.add(substation)
     await supassession.commit()
     await supassession.refresh(substation)
-    feat = await get_mapdata(supassession)
-    await manager.broadcast_json(feat)
-       
-         
-        
-
-
-    
+    await substation_changed(supassession, substation.id)
+    # THE NOTIFY FROM THE gis TRIGGERS REACHES EVERY WORKER, ONLY PUSH FROM HERE WITHOUT A LISTENER
+    if change_listener.running:
+        return
+    await push_changes(await substation_changes(supassession, substation.id))
@@ -0,0 +1,53 @@
+from fastapi import APIRouter
+from ..db.sessesion import engine_registry
+from ..services.tiles import tile_cache
+from ..services.snapshot import snapshot_cache
+from .map_router import manager
+from ..services.listener import change_listener
+from ..services.layer_store import layer_store
+from ..services.feeder_tree import feeder_index
+from ..fileuploader.upload_pool import upload_pool
+from ..fileuploader.manifest import upload_manifest
+from ..fileuploader.storage import storage_registry
+
+monitor_router = APIRouter()
+
+# CONNECTION POOL STATS PER ENGINE
+@monitor_router.get("/monitor/pools")
+async def get_pool_stats():
+    return engine_registry.stats()
+
+# VECTOR TILE CACHE STATS
+@monitor_router.get("/monitor/tiles")
+async def get_tile_stats():
+    return tile_cache.stats()
+
+# MAP SNAPSHOT CACHE STATS
+@monitor_router.get("/monitor/snapshots")
+async def get_snapshot_stats():
+    return snapshot_cache.stats()
+
+# WEBSOCKET QUEUE DEPTH AND DROPPED MESSAGES
+@monitor_router.get("/monitor/websockets")
+async def get_websocket_stats():
+    return manager.stats()
+
+# gis_changes LISTENER STATS
+@monitor_router.get("/monitor/listener")
+async def get_listener_stats():
+    return change_listener.stats()
+
+# IN-MEMORY LAYER STORE STATS
+@monitor_router.get("/monitor/layerstore")
+async def get_layer_store_stats():
+    return layer_store.stats()
+
+# FEEDER TREE OF /simulate/outage, SIZE AND LAST BUILD TIME
+@monitor_router.get("/monitor/feeders")
+async def get_feeder_stats():
+    return feeder_index.stats()
+
+# IMAGE UPLOAD POOL STATS AND THE LAST FAILED UPLOADS
+@monitor_router.get("/monitor/uploads")
+async def get_upload_stats():
+    return dict(upload_pool.stats(), manifest=upload_manifest.stats(), storage=storage_registry.stats())
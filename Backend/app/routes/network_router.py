@@ -0,0 +1,102 @@
+from fastapi import APIRouter, Response
+from fastapi.exceptions import HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel import select
+from ..db.supa_model import LoadFlowResult
+from ..db.sessesion import engine_registry
+from ..services.load_flow import run_load_flow
+from ..services.feeder_tree import feeder_index, trace_features, FeederTree, SUBSTATION, NODE, LINE, KIND_NAMES
+from typing import Optional
+import json
+import time
+
+network_router = APIRouter()
+
+def split_list(value:Optional[str]) -> list[str]:
+    return [item.strip() for item in value.split(",") if item.strip()] if value else []
+
+def split_ids(value:Optional[str], name:str) -> list[int]:
+    try:
+        return [int(item) for item in split_list(value)]
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"{name} must be comma separated ids")
+
+def find_vertices(tree:FeederTree, kind:int, keys:list, name:str) -> list[int]:
+    vertices = [tree.find(kind, key) for key in keys]
+    unknown = [str(key) for key, vertex in zip(keys, vertices) if vertex is None]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"unknown {name} {', '.join(unknown)}")
+    return vertices
+
+# WHAT LOSES POWER IF THE SUBSTATIONS (ids), NODES (node_name) AND PRIMARY LINES (ids) ARE OPENED
+# READ ONLY, ANSWERED FROM THE IN-MEMORY FEEDER TREE, NOTHING IS WRITTEN AND NO TRIGGER FIRES
+@network_router.get("/simulate/outage")
+async def simulate_outage(substations:Optional[str] = None,
+                          nodes:Optional[str] = None,
+                          primary_lines:Optional[str] = None):
+    substation_ids = split_ids(substations, "substations")
+    node_names = split_list(nodes)
+    line_ids = split_ids(primary_lines, "primary_lines")
+    if not (substation_ids or node_names or line_ids):
+        raise HTTPException(status_code=422, detail="open at least one of substations, nodes or primary_lines")
+    tree = await feeder_index.get()
+    started = time.perf_counter()
+    opened = (
+        find_vertices(tree, SUBSTATION, substation_ids, "substations")
+        + find_vertices(tree, NODE, node_names, "nodes")
+        + find_vertices(tree, LINE, line_ids, "primary_lines")
+    )
+    result = tree.outage(opened)
+    return dict(
+        opened = dict(substations=substation_ids, nodes=node_names, primary_lines=line_ids),
+        **result,
+        query_ms = round((time.perf_counter() - started) * 1000, 3),
+    )
+
+def trace_vertex(tree:FeederTree, layer:str, row_id:int) -> int:
+    if layer not in KIND_NAMES:
+        raise HTTPException(status_code=404, detail=f"unknown layer {layer}")
+    vertex = tree.index.get((KIND_NAMES.index(layer), row_id))
+    if vertex is None:
+        raise HTTPException(status_code=404, detail=f"unknown {layer} {row_id}")
+    return vertex
+
+async def trace_response(direction:str, layer:str, row_id:int, tree:FeederTree, vertices) -> Response:
+    async with AsyncSession(engine_registry.supa_engine) as supasession:
+        features = await trace_features(supasession, tree, vertices)
+    meta = dict(direction=direction, layer=layer, id=row_id, features=len(features))
+    data = f'{{"type":"FeatureCollection","trace":{json.dumps(meta)},"features":[{",".join(features)}]}}'
+    return Response(content=data, media_type="application/json")
+
+# GEOJSON OF layer/id AND EVERY FEATURE ON ITS WAY UP TO THE SUBSTATION FEEDING IT, IN THAT ORDER
+# EMPTY PATH ABOVE THE FEATURE WHEN NO SUBSTATION REACHES IT
+@network_router.get("/trace/upstream")
+async def trace_upstream(layer:str, id:int):
+    tree = await feeder_index.get()
+    vertex = trace_vertex(tree, layer, id)
+    return await trace_response("upstream", layer, id, tree, tree.upstream(vertex) if tree.energized(vertex) else [vertex])
+
+# GEOJSON OF layer/id AND EVERYTHING IT FEEDS, IN DFS ORDER
+# FEATURES NO SUBSTATION REACHES ARE NOT IN THE TREE, ONLY THE FEATURE ITSELF IS RETURNED
+@network_router.get("/trace/downstream")
+async def trace_downstream(layer:str, id:int):
+    tree = await feeder_index.get()
+    vertex = trace_vertex(tree, layer, id)
+    return await trace_response("downstream", layer, id, tree, tree.downstream([vertex]) if tree.energized(vertex) else [vertex])
+
+# BACKWARD/FORWARD SWEEP OVER EVERY ENERGIZED FEEDER, THE RESULT REPLACES gis.load_flow
+# RETURNS THE SUMMARY OF EACH FEEDER (LOAD, LOSSES, LOWEST VOLTAGE), SEE services/load_flow.py
+@network_router.put("/simulate/load_flow")
+async def simulate_load_flow():
+    async with AsyncSession(engine_registry.supa_engine) as supasession:
+        return await run_load_flow(supasession)
+
+# RESULT OF THE LAST SOLVE PER PRIMARY LINE, ONE SUBSTATION OR ALL
+@network_router.get("/simulate/load_flow")
+async def get_load_flow(substation_id:Optional[int] = None):
+    stmt = select(LoadFlowResult).order_by(LoadFlowResult.primary_line_id)
+    if substation_id is not None:
+        stmt = stmt.where(LoadFlowResult.substation_id == substation_id)
+    async with AsyncSession(engine_registry.supa_engine) as supasession:
+        rows = (await supasession.exec(stmt)).all()
+    return [row.model_dump() for row in rows]
@@ -0,0 +1,41 @@
+from fastapi import APIRouter
+from fastapi.exceptions import HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel import select, or_
+from ..db.sessesion import engine_registry
+from ..db.supa_model import NetworkRollup
+from typing import Optional
+
+stats_router = APIRouter()
+
+ROLLUP_SCOPES = ("total", "substation", "village", "municipality")
+
+def rollup_dict(row:NetworkRollup) -> dict:
+    return dict(
+        scope = row.scope,
+        name = row.name or None,
+        municipality = row.municipality or None,
+        primary_line_km = round(float(row.line_meters) / 1000, 3),
+        primary_lines = row.lines,
+        transformers = row.transformers,
+        kva = float(row.kva),
+    )
+
+# km OF PRIMARY LINE, TRANSFORMER COUNT AND INSTALLED kVA FROM gis.network_rollup, KEPT BY THE STATEMENT TRIGGERS
+# scope=total (DEFAULT) IS ONE ROW, substation / village / municipality ONE ROW PER NAME OR ONLY name (AND municipality FOR A VILLAGE)
+@stats_router.get("/stats")
+async def get_stats(scope:str = "total", name:Optional[str] = None, municipality:Optional[str] = None):
+    if scope not in ROLLUP_SCOPES:
+        raise HTTPException(status_code=422, detail=f"scope must be one of {', '.join(ROLLUP_SCOPES)}")
+    stmt = select(NetworkRollup).where(NetworkRollup.scope == scope)
+    if name is not None:
+        stmt = stmt.where(NetworkRollup.name == name)
+    if municipality is not None:
+        stmt = stmt.where(NetworkRollup.municipality == municipality)
+    # GROUPS WHOSE LAST LINE OR TRANSFORMER WAS REMOVED STAY AT 0
+    stmt = stmt.where(or_(NetworkRollup.lines != 0, NetworkRollup.transformers != 0, NetworkRollup.scope == "total"))
+    async with AsyncSession(engine_registry.supa_engine) as supasession:
+        rows = (await supasession.exec(stmt.order_by(NetworkRollup.name, NetworkRollup.municipality))).all()
+    if scope == "total":
+        return rollup_dict(rows[0] if rows else NetworkRollup(scope="total", name="", municipality=""))
+    return [rollup_dict(row) for row in rows]
@@ -0,0 +1,21 @@
+from fastapi import APIRouter, Response
+from fastapi.exceptions import HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..services.tiles import TILE_LAYERS, valid_tile, get_tile
+from .map_router import supasessionDep
+
+tile_router = APIRouter()
+
+# MAPBOX VECTOR TILES OF THE GIS LAYERS
+@tile_router.get("/tiles/{layer}/{z}/{x}/{y}.mvt")
+async def get_layer_tile(layer:str, z:int, x:int, y:int, session:AsyncSession = supasessionDep):
+    if layer not in TILE_LAYERS:
+        raise HTTPException(status_code=404, detail=f"Unknown layer {layer}")
+    if not valid_tile(z, x, y):
+        raise HTTPException(status_code=404, detail="Tile out of range")
+    tile = await get_tile(session, layer, z, x, y)
+    return Response(
+        content=tile,
+        media_type="application/vnd.mapbox-vector-tile",
+        headers={"Cache-Control": "public, max-age=60"}
+    )
@@ -1,8 +1,8 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse
 from sqlmodel import select, Text, cast, func, null, Integer, distinct, and_, distinct
 from sqlalchemy.dialects.postgresql import insert
-from ..db.sessesion import Db
+from ..db.sessesion import engine_registry
 from sqlmodel.ext.asyncio.session import AsyncSession
 from ..db.local_model import localFranchiseArea,localSubstation, localNodes, localPrimaryLine,localDistributionTransformer, localLineBushing
 from ..db.supa_model import FranchiseArea, Substation, Nodes, PrimaryLines, DistributionTransformer, TransformerType, LineBushing
@@ -11,106 +11,147 @@ from geoalchemy2.functions import ST_Intersects
 import geojson
 import base64
 import re
-from ..fileuploader.gd_uploader import SupaFileUploader, GoogleFileUploader
+from ..fileuploader.storage import storage_registry, StorageBackend
+from ..services.changes import layers_changed, transformer_types_changed, SUBSTATION_LAYERS, PRIMARY_LINE_LAYERS, LINE_BUSHING_LAYERS
+from ..services.bulk_sync import bulk_sync, BULK_LAYER_NAMES
+from ..services.topology import trace_substations
+from ..services.sync_stream import stream_rows, pipeline, unique_by, with_results
+from ..fileuploader.upload_pool import upload_pool, upload_report
+from functools import partial
+from typing import Optional
+import logging
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # SUPA ENGINE SESSION
 async def get_supa_session():
-    async with AsyncSession(Db().supa_engine) as supa_session:
+    async with AsyncSession(engine_registry.supa_engine) as supa_session:
         yield supa_session
 
 # LOCAL ENGINE SESSION
 async def get_local_session():
-    async with AsyncSession(Db().local_engine) as session:
+    async with AsyncSession(engine_registry.local_engine) as session:
         yield session
 
 supa_session_dep = Depends(get_supa_session)
 local_session_dep = Depends(get_local_session)
-file_uploader_dep = Depends(SupaFileUploader)
-google_file_uploader = Depends(GoogleFileUploader)
+# LONG LIVED STORAGE CLIENTS, SHARED BY EVERY SYNC REQUEST
+async def get_substation_storage():
+    return storage_registry.get("substation")
+
+async def get_transformer_storage():
+    return storage_registry.get("transformer")
+
+substation_storage_dep = Depends(get_substation_storage)
+transformer_storage_dep = Depends(get_transformer_storage)
 
 
 @router.put("/insert/franchise_area")
 async def insert_franchise_area(localsession:AsyncSession = local_session_dep, supasession:AsyncSession = supa_session_dep):
-    stmt = select(localFranchiseArea)
-    data = await localsession.scalars(stmt)
-    new_franchise_area = [FranchiseArea(geom=i.geom, village=i.village, municipality=i.municipality, powerstatus=i.status) for i in data]
-    supasession.add_all(new_franchise_area)
+    stmt = select(localFranchiseArea.geom, localFranchiseArea.village, localFranchiseArea.municipality, localFranchiseArea.status)
+    async def write(rows):
+        await supasession.exec(insert(FranchiseArea).values([
+            dict(geom=i.geom, village=i.village, municipality=i.municipality, powerstatus=i.status) for i in rows]))
+    await pipeline(stream_rows(localsession, stmt), write)
     await supasession.commit()
     return JSONResponse({"UPSERT STATUS": "Successful"})
 
+# BULK PATH FOR /upsert/substation, /upsert/Node, /upsert/primary_lines, /upsert/distribution_tranformer AND /upsert/line_bushing
+# THE /upsert/.. ROUTES ARE NOT INCREMENTAL, THEY RESEND EVERY ROW AND THE SPATIAL TRIGGERS FIRE ON EACH ONE
+# COPY THE LOCAL ROWS TO A STAGING TABLE AND MERGE EACH LAYER WITH ONE STATEMENT, IMAGES ARE NOT UPLOADED
+# layers IS COMMA SEPARATED, EVERY BULK LAYER WHEN MISSING
+# ONLY ROWS ADDED, CHANGED OR DELETED SINCE THE LAST SYNC ARE SENT, full=true SENDS EVERY ROW
+# triggers=false IS THE BULK LOAD MODE, ONE TRANSACTION WITH THE ROW TRIGGERS OFF AND THE DERIVED COLUMNS RECOMPUTED AT THE END
+@router.put("/bulk/sync")
+async def bulk_sync_layers(layers:Optional[str] = None,
+                           full:bool = False,
+                           triggers:bool = True,
+                           localsession:AsyncSession = local_session_dep,
+                           supasession:AsyncSession = supa_session_dep):
+    names = [name.strip() for name in layers.split(",") if name.strip()] if layers else BULK_LAYER_NAMES
+    unknown = [name for name in names if name not in BULK_LAYER_NAMES]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"unknown layers {', '.join(unknown)}")
+    report = await bulk_sync(localsession, supasession, names, incremental=not full, triggers=triggers)
+    return JSONResponse({"UPSERT STATUS": "Successful", "layers": report})
+
 @router.put("/upsert/substation")
 async def upsert_substation(localsession:AsyncSession = local_session_dep,
                             supasession:AsyncSession = supa_session_dep,
-                            fileupload:SupaFileUploader = file_uploader_dep):
-    select_stmt = select(localSubstation)
-    data  = await localsession.scalars(select_stmt)
-    for i in data:
-        with open(i.image, "rb") as fs:
-            uploadimage = fileupload.uploadFile(filename=i.generator_id, file=fs)
-    
-        publicl_url = fileupload.getPublicUlr(i.generator_id)
-        val = {
-            "geom": i.geom,
-            "generator_name": i.generator_id,
-            "phasing": i.phasing,
-            "description": i.description,
-            "voltage_rating": i.voltage_rating,
-            "village": i.village,
-            "municipality": i.municipality,
-            "image": publicl_url,
-            "isactive": True,
-        }
-        upsert_stmt = insert(Substation).values(val).on_conflict_do_update(index_elements=["generator_name"], set_={
-            "geom": i.geom,
-            "phasing": i.phasing,
-            "description": i.description,
-            "voltage_rating": i.voltage_rating,
-            "village": i.village,
-            "municipality": i.municipality,
-            "image": publicl_url,
+                            storage:StorageBackend = substation_storage_dep):
+    select_stmt = select(localSubstation.geom, localSubstation.generator_id, localSubstation.phasing,
+                         localSubstation.description, localSubstation.voltage_rating, localSubstation.village,
+                         localSubstation.municipality, localSubstation.image)
+    uploads = []
+    async def upload(rows):
+        return await upload_pool.upload_all([
+            (i.generator_id, partial(storage.upload_cached, i.generator_id, i.image)) for i in rows])
+    async def write(rows):
+        values = []
+        for i, uploaded in rows:
+            uploads.append(uploaded)
+            values.append({
+                "geom": i.geom,
+                "generator_name": i.generator_id,
+                "phasing": i.phasing,
+                "description": i.description,
+                "voltage_rating": i.voltage_rating,
+                "village": i.village,
+                "municipality": i.municipality,
+                "image": uploaded.url,
+                "isactive": True,
+            })
+        insert_stmt = insert(Substation).values(unique_by(values, "generator_name"))
+        upsert_stmt = insert_stmt.on_conflict_do_update(index_elements=["generator_name"], set_={
+            "geom": insert_stmt.excluded.geom,
+            "phasing": insert_stmt.excluded.phasing,
+            "description": insert_stmt.excluded.description,
+            "voltage_rating": insert_stmt.excluded.voltage_rating,
+            "village": insert_stmt.excluded.village,
+            "municipality": insert_stmt.excluded.municipality,
+            # A FAILED UPLOAD KEEPS THE IMAGE ALREADY ON SUPABASE
+            "image": func.coalesce(insert_stmt.excluded.image, Substation.image),
             "isactive": True,
         })
         await supasession.exec(upsert_stmt)
+    # THE IMAGES OF THE NEXT CHUNK UPLOAD WHILE THE CURRENT CHUNK IS UPSERTED
+    await pipeline(with_results(stream_rows(localsession, select_stmt), upload), write)
     await supasession.commit()
-    return JSONResponse({"UPSERT STATUS": "Successful"})
+    layers_changed(*SUBSTATION_LAYERS)
+    return JSONResponse({"UPSERT STATUS": "Successful", "uploads": upload_report(uploads)})
 
 @router.put("/upsert/Node")
 async def upsert_nodes(localsession:AsyncSession = local_session_dep, supasession:AsyncSession = supa_session_dep):
-    stmt = select(localNodes)
-    data = await localsession.scalars(stmt)
-    for i in data.fetchall():
-        values = {
+    stmt = select(localNodes.geom, localNodes.bus_id, localNodes.description, localNodes.nominal_voltage)
+    async def write(rows):
+        values = [{
             "geom": i.geom,
             "node_name": i.bus_id,
             "description": i.description,
             "nominal_voltage_kv": i.nominal_voltage,
             "isactive": True,
-            "remarks": None}
-        try:
-            insert_stmt = insert(Nodes).values(values)
-            upsert_stmt = insert_stmt.on_conflict_do_update(index_elements=["node_name"], 
-                                                            set_={
-                                                                "geom": insert_stmt.excluded.geom,
-                                                                "description": insert_stmt.excluded.description,
-                                                                "nominal_voltage_kv": insert_stmt.excluded.nominal_voltage_kv,
-                                                                "isactive": insert_stmt.excluded.isactive,
-                                                                "remarks": insert_stmt.excluded.remarks})
-        except Exception:
-            print(Exception)                                                                               
+            "remarks": None} for i in rows]
+        insert_stmt = insert(Nodes).values(unique_by(values, "node_name"))
+        upsert_stmt = insert_stmt.on_conflict_do_update(index_elements=["node_name"], 
+                                                        set_={
+                                                            "geom": insert_stmt.excluded.geom,
+                                                            "description": insert_stmt.excluded.description,
+                                                            "nominal_voltage_kv": insert_stmt.excluded.nominal_voltage_kv,
+                                                            "isactive": insert_stmt.excluded.isactive,
+                                                            "remarks": insert_stmt.excluded.remarks})
         await supasession.exec(upsert_stmt)
+    await pipeline(stream_rows(localsession, stmt), write)
     await supasession.commit()
+    layers_changed("nodes")
     return JSONResponse(dict(STATUS = "UPSERT SUCCESFULL"))
 
 @router.put("/upsert/primary_lines")
 async def upsert_primary_lines(localsession:AsyncSession = local_session_dep, supasession:AsyncSession = supa_session_dep):
-    get_villages = await localsession.exec(select(distinct(localPrimaryLine.village)))
-    list_of_villages = get_villages.fetchall()
-
-    # PARTIALLY INSERT TO AVOID OVER LAPPING OF PARAMETERS
-    for vill in list_of_villages:
-        local_stmt = select(localPrimaryLine).where(cast(localPrimaryLine.village, Text) == vill)
-        data = await localsession.scalars(local_stmt)
+    # CHUNKED TO AVOID OVER LAPPING OF PARAMETERS
+    local_stmt = select(localPrimaryLine.geom, localPrimaryLine.primary_line_id, localPrimaryLine.phasing,
+                        localPrimaryLine.description, localPrimaryLine.configuration, localPrimaryLine.system_grounding_type,
+                        localPrimaryLine.conductor_type, localPrimaryLine.neutral_wire_type, localPrimaryLine.earth_resistivity)
+    async def write(rows):
         values = [{"geom": val.geom,
                 "line_id": val.primary_line_id,
                 "phasing": val.phasing,
@@ -123,9 +164,9 @@ async def upsert_primary_lines(localsession:AsyncSession = local_session_dep, su
                 "isactive": True
                 
                 }
-                for val in data.fetchall()]
+                for val in rows]
 
-        insert_stmt = insert(PrimaryLines).values(values)
+        insert_stmt = insert(PrimaryLines).values(unique_by(values, "line_id"))
 
         upsert = insert_stmt.on_conflict_do_update(
             index_elements=["line_id"],
@@ -142,51 +183,18 @@ async def upsert_primary_lines(localsession:AsyncSession = local_session_dep, su
             }
         )
         await supasession.exec(upsert)
+    await pipeline(stream_rows(localsession, local_stmt), write)
     await supasession.commit()
+    layers_changed(*PRIMARY_LINE_LAYERS)
 
 
+# ASSIGN substation_id BY TRACING THE PRIMARY NETWORK FROM EVERY SUBSTATION IN MEMORY
+# AND WRITING THE RESULT BACK WITH ONE UPDATE PER TABLE, SEE services/topology.py
 @router.put("/update/primary_lines")
-async def update_primary_lines(localsession:AsyncSession = local_session_dep, supasession:AsyncSession = supa_session_dep):
-    while True:
-        select_primary_line_with_substation_id = await supasession.exec(select(PrimaryLines.to_node).where(PrimaryLines.substation_id != None))
-        to_node = select_primary_line_with_substation_id.fetchall()
-        print(len(to_node))
-        select_primarY_line_without_substation_id = await supasession.exec(select(PrimaryLines).where(and_(PrimaryLines.from_node.in_(to_node),PrimaryLines.substation_id == None)))
-        primary_line_data = select_primarY_line_without_substation_id.fetchall()
-        if not primary_line_data:
-            break
-        values = [
-            {
-                "geom": val.geom,
-                "line_id": val.line_id,
-                "phasing": val.phasing,
-                "description": val.description,
-                "configuration": val.configuration,
-                "system_grounding_type": val.system_grounding_type,
-                "conductor_type": val.conductor_type,
-                "neutral_wire_type": val.neutral_wire_type,
-                "earth_resistivity": val.earth_resistivity
-            } for val in primary_line_data
-        ]
-
-        # UPSERT STATEMENT
-        insert_stmt = insert(PrimaryLines).values(values)
-        upsert_stmt = insert_stmt.on_conflict_do_update(
-            index_elements=["line_id"],
-            set_={
-                "geom": insert_stmt.excluded.geom,
-                    "phasing": insert_stmt.excluded.phasing,
-                    "description": insert_stmt.excluded.description,
-                    "configuration": insert_stmt.excluded.configuration,
-                    "system_grounding_type": insert_stmt.excluded.system_grounding_type,
-                    "conductor_type": insert_stmt.excluded.conductor_type,
-                    "neutral_wire_type": insert_stmt.excluded.neutral_wire_type,
-                    "earth_resistivity": insert_stmt.excluded.earth_resistivity
-            },
-            where=(PrimaryLines.line_id != None)
-        )
-        await supasession.exec(upsert_stmt)
-        await supasession.commit()
+async def update_primary_lines(supasession:AsyncSession = supa_session_dep):
+    report = await trace_substations(supasession)
+    layers_changed(*PRIMARY_LINE_LAYERS, *LINE_BUSHING_LAYERS)
+    return JSONResponse(dict(STATUS = "TRACE SUCCESFULL", **report))
 
 @router.put("/upsert/tranformer_type")
 async def upsert_transformer_type(supasession:AsyncSession = supa_session_dep, localsession:AsyncSession= local_session_dep):
@@ -203,29 +211,34 @@ async def upsert_transformer_type(supasession:AsyncSession = supa_session_dep, l
     )
     await supasession.exec(upsert_stmt)
     await supasession.commit()
+    transformer_types_changed()
     
 @router.put("/upsert/distribution_tranformer")
-async def upsert_dt(supasession:AsyncSession = supa_session_dep, localsession:AsyncSession= local_session_dep, uploader:GoogleFileUploader = google_file_uploader):
-    old_dt_stmt = await localsession.exec(select(localDistributionTransformer))
-    local_dt_data = old_dt_stmt.fetchall()
-    for val in local_dt_data:
-        if val.image:
-            uploaded_image = uploader.uploadFile(filepath=val.image)
-        else:
-            uploaded_image = None
-        
-            
-        values = {"geom": val.geom,
-                "transformer_id" : val.transformer_id,
-                "description" : val.description,
-                "installation_type" : val.installation_type,
-                "connection_code": val.connection_code,
-                "transformer_type" : val.transformer_type,
-                "primary_voltage_rating": val.primary_voltage_rating,
-                "secondary_voltage_rating" : val.secondary_voltage_rating,
-                "image" : uploaded_image}
+async def upsert_dt(supasession:AsyncSession = supa_session_dep, localsession:AsyncSession= local_session_dep, storage:StorageBackend = transformer_storage_dep):
+    old_dt_stmt = select(localDistributionTransformer.geom, localDistributionTransformer.transformer_id,
+                         localDistributionTransformer.description, localDistributionTransformer.installation_type,
+                         localDistributionTransformer.connection_code, localDistributionTransformer.transformer_type,
+                         localDistributionTransformer.primary_voltage_rating, localDistributionTransformer.secondary_voltage_rating,
+                         localDistributionTransformer.image)
+    uploads = []
+    async def upload(rows):
+        return await upload_pool.upload_all([
+            (val.transformer_id, partial(storage.upload_cached, val.transformer_id, val.image) if val.image else None) for val in rows])
+    async def write(rows):
+        values = []
+        for val, uploaded in rows:
+            uploads.append(uploaded)
+            values.append({"geom": val.geom,
+                    "transformer_id" : val.transformer_id,
+                    "description" : val.description,
+                    "installation_type" : val.installation_type,
+                    "connection_code": val.connection_code,
+                    "transformer_type" : val.transformer_type,
+                    "primary_voltage_rating": val.primary_voltage_rating,
+                    "secondary_voltage_rating" : val.secondary_voltage_rating,
+                    "image" : uploaded.url})
 
-        insert_stmt = insert(DistributionTransformer).values(values)
+        insert_stmt = insert(DistributionTransformer).values(unique_by(values, "transformer_id"))
         upsert_stmt = insert_stmt.on_conflict_do_update(
             index_elements=["transformer_id"],
             set_={
@@ -235,59 +248,51 @@ async def upsert_dt(supasession:AsyncSession = supa_session_dep, localsession:As
                 "transformer_type": insert_stmt.excluded.transformer_type,
                 "primary_voltage_rating": insert_stmt.excluded.primary_voltage_rating,
                 "secondary_voltage_rating": insert_stmt.excluded.secondary_voltage_rating,
-                "image": uploaded_image
+                # NO IMAGE OR A FAILED UPLOAD KEEPS THE IMAGE ALREADY ON SUPABASE
+                "image": func.coalesce(insert_stmt.excluded.image, DistributionTransformer.image)
             })
         await supasession.exec(upsert_stmt)
+        # COMMIT EVERY CHUNK SO A FAILED CHUNK DOES NOT LOSE THE ROWS BEFORE IT
         await supasession.commit()
-        print(f"UPSERT COMPLETE: {val.transformer_id}")
+        logger.debug("UPSERT COMPLETE: %d TRANSFORMERS", len(values))
+    # THE IMAGES OF THE NEXT CHUNK UPLOAD WHILE THE CURRENT CHUNK IS UPSERTED
+    await pipeline(with_results(stream_rows(localsession, old_dt_stmt), upload), write)
+    layers_changed("distribution_transformer")
             
 
         
     return JSONResponse({
-        "UPSERT STATUS": "SUCESSFUL"
+        "UPSERT STATUS": "SUCESSFUL",
+        "uploads": upload_report(uploads)
     })
     
 @router.put("/upsert/line_bushing")
 async def upsert_line_bushing(localsession:AsyncSession = local_session_dep, supasession:AsyncSession = supa_session_dep):
-    local_bushing = await localsession.exec(select(localLineBushing).where(cast(localLineBushing.description, Text).ilike('%PRIMARY%')))
-    
-    primary_line_bushing_values = [
-        dict(
-            geom = val.geom,
-            line_bushing_name = val.line_bushing_id,
-            phasing = val.phasing     
-        ) for val in local_bushing.fetchall()
-    ]
-
-    insert_stmt = insert(LineBushing).values(primary_line_bushing_values)
-    upsert_stmt = insert_stmt.on_conflict_do_update(
-        index_elements=["line_bushing_name"],
-        set_=dict(
-            geom = insert_stmt.excluded.geom,
-            phasing = insert_stmt.excluded.phasing
+    async def write(rows):
+        values = [
+            dict(
+                geom = val.geom,
+                line_bushing_name = val.line_bushing_id,
+                phasing = val.phasing     
+            ) for val in rows
+        ]
+        insert_stmt = insert(LineBushing).values(unique_by(values, "line_bushing_name"))
+        upsert_stmt = insert_stmt.on_conflict_do_update(
+            index_elements=["line_bushing_name"],
+            set_=dict(
+                geom = insert_stmt.excluded.geom,
+                phasing = insert_stmt.excluded.phasing
+            )
         )
-    )
-    await supasession.exec(upsert_stmt)
-    await supasession.commit()
-    
-    # SECONDARY LINE BUSHING
-    local_secondary_line_bushing = await localsession.exec(select(localLineBushing).where(cast(localLineBushing.description, Text).ilike("%SECONDARY%")))
-    secondary_line_bushing_val = [
-        dict(
-            geom = val.geom,
-            line_bushing_name = val.line_bushing_id,
-            phasing = val.phasing
-            ) for val in local_secondary_line_bushing
-    ]
-    insert_secondary_lb = insert(LineBushing).values(secondary_line_bushing_val)
-    upsert_secondary_lb = insert_secondary_lb.on_conflict_do_update(
-        index_elements=["line_bushing_name"],
-        set_=dict(
-            geom = insert_stmt.excluded.geom,
-            phasing = insert_stmt.excluded.phasing
-        ))
-    await supasession.exec(upsert_secondary_lb)
-    await supasession.commit()
+        await supasession.exec(upsert_stmt)
+
+    # PRIMARY THEN SECONDARY LINE BUSHING
+    for description in ("%PRIMARY%", "%SECONDARY%"):
+        local_bushing = select(localLineBushing.geom, localLineBushing.line_bushing_id, localLineBushing.phasing).where(
+            cast(localLineBushing.description, Text).ilike(description))
+        await pipeline(stream_rows(localsession, local_bushing), write)
+        await supasession.commit()
+    layers_changed(*LINE_BUSHING_LAYERS)
     return JSONResponse({
         "UPSERT STATUS": "SUCESSFUL"
     })
\ No newline at end of file
@@ -0,0 +1,357 @@
+from sqlmodel import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..db.sessesion import env_int
+from ..db.local_model import localSyncState
+from .changes import layers_changed, SUBSTATION_LAYERS, PRIMARY_LINE_LAYERS, LINE_BUSHING_LAYERS
+from .derived import disable_triggers_sql, recompute_derived
+from .sync_stream import stream_rows, pipeline
+from sqlalchemy.exc import IntegrityError
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# ROWS READ FROM THE LOCAL DATABASE AND COPIED TO THE STAGING TABLE AT A TIME
+COPY_BATCH = env_int("BULKCOPYBATCH", 5000)
+
+# LOCAL gis TABLE -> TEMP STAGING TABLE (BINARY COPY) -> ONE INSERT .. SELECT .. ON CONFLICT PER LAYER
+# source COLUMNS ARE IN THE ORDER AND NAMED AS IN staging, key IS THE UNIQUE COLUMN OF table ON SUPABASE, THE MERGE KEEPS THE LAST LOCAL ROW (HIGHEST id) OF A DUPLICATED KEY
+# IMAGES ARE NOT UPLOADED ON THIS PATH, image IS LEFT AS IT IS ON SUPABASE
+# references ARE THE (table, column) POINTING AT id OF table WITHOUT ON DELETE, SET TO NULL BEFORE A KEY IS DELETED
+BULK_LAYERS = [
+    dict(
+        name = "substation",
+        table = "gis.substation",
+        references = [("gis.nodes", "substation_id")],
+        changed = SUBSTATION_LAYERS,
+        key = "generator_name",
+        source = """
+            SELECT id, ST_AsEWKB(geom) AS geom, generator_id AS generator_name, phasing, description,
+                   voltage_rating_kv AS voltage_rating, village, municipality
+            FROM gis.power_station""",
+        staging = """
+            id integer, geom bytea, generator_name text, phasing text, description text,
+            voltage_rating float8, village text, municipality text""",
+        merge = """
+            INSERT INTO gis.substation AS t (geom, generator_name, phasing, description, voltage_rating, village, municipality, isactive)
+            SELECT DISTINCT ON (s.generator_name)
+                ST_GeomFromEWKB(s.geom), s.generator_name, s.phasing, s.description, s.voltage_rating, s.village, s.municipality, true
+            FROM stage_substation AS s
+            WHERE s.generator_name IS NOT NULL
+            ORDER BY s.generator_name, s.id DESC
+            ON CONFLICT (generator_name) DO UPDATE SET
+                geom = excluded.geom,
+                phasing = excluded.phasing,
+                description = excluded.description,
+                voltage_rating = excluded.voltage_rating,
+                village = excluded.village,
+                municipality = excluded.municipality,
+                isactive = true
+            WHERE (t.geom, t.phasing, t.description, t.voltage_rating, t.village, t.municipality, t.isactive)
+                IS DISTINCT FROM (excluded.geom, excluded.phasing, excluded.description, excluded.voltage_rating,
+                                  excluded.village, excluded.municipality, true)""",
+    ),
+    dict(
+        name = "nodes",
+        table = "gis.nodes",
+        references = [("gis.primary_lines", "node_id")],
+        changed = ("nodes",),
+        key = "node_name",
+        source = """
+            SELECT id, ST_AsEWKB(geom) AS geom, bus_id AS node_name, description, nominal_voltage_kv
+            FROM gis.bus""",
+        staging = """
+            id integer, geom bytea, node_name text, description text, nominal_voltage_kv numeric""",
+        merge = """
+            INSERT INTO gis.nodes AS t (geom, node_name, description, nominal_voltage_kv, isactive, remarks)
+            SELECT DISTINCT ON (s.node_name)
+                ST_GeomFromEWKB(s.geom), s.node_name, s.description, s.nominal_voltage_kv, true, NULL
+            FROM stage_nodes AS s
+            WHERE s.node_name IS NOT NULL
+            ORDER BY s.node_name, s.id DESC
+            ON CONFLICT (node_name) DO UPDATE SET
+                geom = excluded.geom,
+                description = excluded.description,
+                nominal_voltage_kv = excluded.nominal_voltage_kv,
+                isactive = excluded.isactive,
+                remarks = excluded.remarks
+            WHERE (t.geom, t.description, t.nominal_voltage_kv, t.isactive, t.remarks)
+                IS DISTINCT FROM (excluded.geom, excluded.description, excluded.nominal_voltage_kv,
+                                  excluded.isactive, excluded.remarks)""",
+    ),
+    dict(
+        name = "primary_lines",
+        table = "gis.primary_lines",
+        references = [("gis.line_bushing", "primary_line_id")],
+        changed = PRIMARY_LINE_LAYERS,
+        key = "line_id",
+        source = """
+            SELECT id, ST_AsEWKB(geom) AS geom, primary_line_id AS line_id, phasing, description, configuration,
+                   system_grounding_type, conductor_type, neutral_wire_type, earth_resistivity
+            FROM gis.primary_line""",
+        staging = """
+            id integer, geom bytea, line_id text, phasing text, description text, configuration text,
+            system_grounding_type text, conductor_type text, neutral_wire_type text, earth_resistivity integer""",
+        merge = """
+            INSERT INTO gis.primary_lines AS t (geom, line_id, phasing, description, configuration, system_grounding_type,
+                                               conductor_type, neutral_wire_type, earth_resistivity, isactive)
+            SELECT DISTINCT ON (s.line_id)
+                ST_GeomFromEWKB(s.geom), s.line_id, s.phasing, s.description, s.configuration, s.system_grounding_type,
+                s.conductor_type, s.neutral_wire_type, s.earth_resistivity, true
+            FROM stage_primary_lines AS s
+            WHERE s.line_id IS NOT NULL
+            ORDER BY s.line_id, s.id DESC
+            ON CONFLICT (line_id) DO UPDATE SET
+                geom = excluded.geom,
+                phasing = excluded.phasing,
+                description = excluded.description,
+                configuration = excluded.configuration,
+                system_grounding_type = excluded.system_grounding_type,
+                conductor_type = excluded.conductor_type,
+                neutral_wire_type = excluded.neutral_wire_type,
+                earth_resistivity = excluded.earth_resistivity,
+                isactive = true
+            WHERE (t.geom, t.phasing, t.description, t.configuration, t.system_grounding_type, t.conductor_type,
+                   t.neutral_wire_type, t.earth_resistivity, t.isactive)
+                IS DISTINCT FROM (excluded.geom, excluded.phasing, excluded.description, excluded.configuration,
+                                  excluded.system_grounding_type, excluded.conductor_type, excluded.neutral_wire_type,
+                                  excluded.earth_resistivity, true)""",
+    ),
+    dict(
+        name = "distribution_transformer",
+        table = "gis.distribution_transformer",
+        changed = ("distribution_transformer",),
+        key = "transformer_id",
+        source = """
+            SELECT id, ST_AsEWKB(geom) AS geom, transformer_id, description, installation_type, connection_code,
+                   transformer_type, primary_voltage_rating_kv AS primary_voltage_rating,
+                   secondary_voltage_rating_kv AS secondary_voltage_rating
+            FROM gis.distribution_transformer""",
+        staging = """
+            id integer, geom bytea, transformer_id text, description text, installation_type text, connection_code integer,
+            transformer_type text, primary_voltage_rating numeric, secondary_voltage_rating numeric""",
+        # LIKE /upsert/distribution_tranformer THE GEOMETRY IS ONLY WRITTEN ON INSERT
+        merge = """
+            INSERT INTO gis.distribution_transformer AS t (geom, transformer_id, description, installation_type, connection_code,
+                                                          transformer_type, primary_voltage_rating, secondary_voltage_rating)
+            SELECT DISTINCT ON (s.transformer_id)
+                ST_GeomFromEWKB(s.geom), s.transformer_id, s.description, s.installation_type, s.connection_code,
+                s.transformer_type, s.primary_voltage_rating, s.secondary_voltage_rating
+            FROM stage_distribution_transformer AS s
+            WHERE s.transformer_id IS NOT NULL
+            ORDER BY s.transformer_id, s.id DESC
+            ON CONFLICT (transformer_id) DO UPDATE SET
+                description = excluded.description,
+                installation_type = excluded.installation_type,
+                connection_code = excluded.connection_code,
+                transformer_type = excluded.transformer_type,
+                primary_voltage_rating = excluded.primary_voltage_rating,
+                secondary_voltage_rating = excluded.secondary_voltage_rating
+            WHERE (t.description, t.installation_type, t.connection_code, t.transformer_type,
+                   t.primary_voltage_rating, t.secondary_voltage_rating)
+                IS DISTINCT FROM (excluded.description, excluded.installation_type, excluded.connection_code,
+                                  excluded.transformer_type, excluded.primary_voltage_rating, excluded.secondary_voltage_rating)""",
+    ),
+    # AFTER THE TRANSFORMERS, gis.line_bushing_update() LINKS A BUSHING TO THE TRANSFORMER UNDER ITS END POINTS
+    # LIKE /upsert/line_bushing ONLY PRIMARY AND SECONDARY BUSHINGS, THE PRIMARY ONES FIRST
+    dict(
+        name = "line_bushing",
+        table = "gis.line_bushing",
+        references = [("gis.distribution_transformer", "line_bushing_id")],
+        changed = LINE_BUSHING_LAYERS,
+        key = "line_bushing_name",
+        source = """
+            SELECT id, ST_AsEWKB(geom) AS geom, line_bushing_id AS line_bushing_name, phasing,
+                   CASE WHEN description ILIKE '%PRIMARY%' THEN 0 ELSE 1 END AS rank
+            FROM gis.line_bushing
+            WHERE description ILIKE '%PRIMARY%' OR description ILIKE '%SECONDARY%'""",
+        staging = """
+            id integer, geom bytea, line_bushing_name text, phasing text, rank integer""",
+        merge = """
+            INSERT INTO gis.line_bushing AS t (geom, line_bushing_name, phasing)
+            SELECT ST_GeomFromEWKB(s.geom), s.line_bushing_name, s.phasing
+            FROM (
+                SELECT DISTINCT ON (s.line_bushing_name) s.*
+                FROM stage_line_bushing AS s
+                WHERE s.line_bushing_name IS NOT NULL
+                ORDER BY s.line_bushing_name, s.id DESC
+            ) AS s
+            ORDER BY s.rank, s.id
+            ON CONFLICT (line_bushing_name) DO UPDATE SET
+                geom = excluded.geom,
+                phasing = excluded.phasing
+            WHERE (t.geom, t.phasing) IS DISTINCT FROM (excluded.geom, excluded.phasing)""",
+    ),
+]
+
+BULK_LAYER_NAMES = [conf["name"] for conf in BULK_LAYERS]
+
+def staging_columns(conf:dict) -> list[str]:
+    return [column.split()[0] for column in conf["staging"].split(",")]
+
+def hashed_source_sql(conf:dict, incremental:bool):
+    '''The source rows with an md5 of everything synced but the local id, the last row of a duplicated key.
+    Incremental, only rows whose hash differs from the one of the last successful sync'''
+    columns = [column for column in staging_columns(conf) if column != "id"]
+    changed = """
+        LEFT JOIN gis.sync_state AS st ON st.layer = :layer AND st.key = h.key
+        WHERE st.row_hash IS DISTINCT FROM h.row_hash""" if incremental else ""
+    return text(f"""
+        WITH hashed AS (
+            SELECT DISTINCT ON (s.{conf["key"]})
+                s.*, s.{conf["key"]} AS key, md5(ROW({", ".join(f"s.{column}" for column in columns)})::text) AS row_hash
+            FROM ({conf["source"]}) AS s
+            WHERE s.{conf["key"]} IS NOT NULL
+            ORDER BY s.{conf["key"]}, s.id DESC
+        )
+        SELECT {", ".join(f"h.{column}" for column in staging_columns(conf))}, h.row_hash
+        FROM hashed AS h
+        {changed}
+    """).bindparams(layer=conf["name"])
+
+def deleted_keys_sql(conf:dict):
+    '''Keys synced before that are gone from the local table'''
+    return text(f"""
+        SELECT st.key FROM gis.sync_state AS st
+        WHERE st.layer = :layer
+        AND NOT EXISTS (SELECT 1 FROM ({conf["source"]}) AS s WHERE s.{conf["key"]} = st.key)
+    """).bindparams(layer=conf["name"])
+
+def merge_sql(conf:dict):
+    '''The merge statement counting inserted and updated rows, xmax is 0 only on freshly inserted rows'''
+    return text(f"""
+        WITH merged AS ({conf["merge"]}
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged
+    """)
+
+def detach_sql(conf:dict, table:str, column:str):
+    return text(f"""
+        UPDATE {table} SET {column} = NULL
+        WHERE {column} IN (SELECT id FROM {conf["table"]} WHERE {conf["key"]} = ANY(:keys))
+    """)
+
+def delete_sql(conf:dict):
+    return text(f"""
+        WITH deleted AS (DELETE FROM {conf["table"]} WHERE {conf["key"]} = ANY(:keys) RETURNING 1)
+        SELECT count(*) FROM deleted
+    """)
+
+async def stage_layer(localsession:AsyncSession, supasession:AsyncSession, conf:dict, incremental:bool) -> list[tuple]:
+    '''Stream the local rows into the staging table with binary COPY, returns the (key, row_hash) of the staged rows'''
+    table = f"stage_{conf['name']}"
+    await supasession.exec(text(f"CREATE TEMP TABLE {table} ({conf['staging']}, row_hash text) ON COMMIT DROP"))
+    connection = await supasession.connection()
+    raw = await connection.get_raw_connection()
+    key = staging_columns(conf).index(conf["key"])
+    hashes = []
+    async def copy(rows):
+        records = [tuple(row) for row in rows]
+        await raw.driver_connection.copy_records_to_table(table, records=records)
+        hashes.extend((record[key], record[-1]) for record in records)
+    # THE NEXT CHUNK IS READ FROM THE LOCAL DATABASE WHILE THE CURRENT ONE IS COPIED
+    await pipeline(stream_rows(localsession, hashed_source_sql(conf, incremental), COPY_BATCH), copy)
+    return hashes
+
+async def save_state(localsession:AsyncSession, conf:dict, hashes:list[tuple], deleted:list[str]):
+    '''Only called after the Supabase commit, a failed sync sends the same rows again next time'''
+    connection = await localsession.connection()
+    raw = await connection.get_raw_connection()
+    if hashes:
+        await raw.driver_connection.executemany("""
+            INSERT INTO gis.sync_state (layer, key, row_hash) VALUES ($1, $2, $3)
+            ON CONFLICT (layer, key) DO UPDATE SET row_hash = excluded.row_hash, synced_at = now()
+        """, [(conf["name"], key, row_hash) for key, row_hash in hashes])
+    if deleted:
+        await localsession.exec(text("DELETE FROM gis.sync_state WHERE layer = :layer AND key = ANY(:keys)")
+                                .bindparams(layer=conf["name"], keys=deleted))
+    await localsession.commit()
+
+async def delete_keys(supasession:AsyncSession, conf:dict, keys:list[str]) -> tuple[int, list, list]:
+    '''Detach the rows referencing the deleted ones, then delete. Returns (deleted rows, deleted keys, failed keys),
+    a key that still cannot be deleted is skipped and stays in sync_state, the rest of the layer goes through'''
+    for table, column in conf.get("references", []):
+        await supasession.exec(detach_sql(conf, table, column).bindparams(keys=keys))
+    try:
+        async with supasession.begin_nested():
+            result = await supasession.exec(delete_sql(conf).bindparams(keys=keys))
+        return result.scalar(), keys, []
+    except IntegrityError:
+        pass
+    # ONE SAVEPOINT PER KEY TO FIND THE ONES STILL REFERENCED
+    deleted, done, failed = 0, [], []
+    for key in keys:
+        try:
+            async with supasession.begin_nested():
+                result = await supasession.exec(delete_sql(conf).bindparams(keys=[key]))
+            deleted += result.scalar()
+            done.append(key)
+        except IntegrityError as exc:
+            logger.warning("DELETE OF %s %s FAILED: %s", conf["name"], key, exc.orig)
+            failed.append(key)
+    return deleted, done, failed
+
+async def merge_layer(localsession:AsyncSession, supasession:AsyncSession, conf:dict, incremental:bool) -> tuple[dict, list, list]:
+    '''Stage, merge and delete one layer in the open Supabase transaction, does not commit'''
+    started = time.perf_counter()
+    hashes = await stage_layer(localsession, supasession, conf, incremental)
+    copied = time.perf_counter()
+    result = await supasession.exec(merge_sql(conf))
+    inserted, updated = result.one()
+    deleted_keys = list((await localsession.exec(deleted_keys_sql(conf))).scalars())
+    deleted, failed_keys = 0, []
+    if deleted_keys:
+        deleted, deleted_keys, failed_keys = await delete_keys(supasession, conf, deleted_keys)
+    merged = time.perf_counter()
+    report = dict(
+        staged = len(hashes),
+        inserted = inserted,
+        updated = updated,
+        deleted = deleted,
+        # STILL REFERENCED ON SUPABASE, RETRIED ON THE NEXT SYNC
+        delete_failed = failed_keys,
+        # ALREADY UP TO DATE ON SUPABASE
+        unchanged = len(hashes) - inserted - updated,
+        copy_ms = round((copied - started) * 1000, 1),
+        merge_ms = round((merged - copied) * 1000, 1),
+    )
+    return report, hashes, deleted_keys
+
+async def sync_layer(localsession:AsyncSession, supasession:AsyncSession, conf:dict, incremental:bool = True) -> dict:
+    report, hashes, deleted_keys = await merge_layer(localsession, supasession, conf, incremental)
+    await supasession.commit()
+    await save_state(localsession, conf, hashes, deleted_keys)
+    if report["inserted"] or report["updated"] or report["deleted"]:
+        layers_changed(*conf["changed"])
+    return report
+
+async def bulk_load(localsession:AsyncSession, supasession:AsyncSession, confs:list[dict], incremental:bool) -> dict:
+    '''Every layer in one transaction with the row triggers off, the derived columns are recomputed set wise before the commit'''
+    await supasession.exec(disable_triggers_sql)
+    report, states = {}, []
+    for conf in confs:
+        report[conf["name"]], hashes, deleted_keys = await merge_layer(localsession, supasession, conf, incremental)
+        states.append((conf, hashes, deleted_keys))
+    report["derived"] = await recompute_derived(supasession)
+    await supasession.commit()
+    for conf, hashes, deleted_keys in states:
+        await save_state(localsession, conf, hashes, deleted_keys)
+    layers_changed(*SUBSTATION_LAYERS, *PRIMARY_LINE_LAYERS, *LINE_BUSHING_LAYERS)
+    return report
+
+async def bulk_sync(localsession:AsyncSession, supasession:AsyncSession, layers:list[str], incremental:bool = True,
+                    triggers:bool = True) -> dict:
+    '''Sync the layers in dependency order, each layer is its own transaction.
+    Incremental, only the rows changed since the last successful sync of the layer are sent.
+    Without triggers, see bulk_load'''
+    connection = await localsession.connection()
+    await connection.run_sync(localSyncState.__table__.create, checkfirst=True)
+    await localsession.commit()
+    confs = [conf for conf in BULK_LAYERS if conf["name"] in layers]
+    if not triggers:
+        return await bulk_load(localsession, supasession, confs, incremental)
+    report = {}
+    for conf in confs:
+        report[conf["name"]] = await sync_layer(localsession, supasession, conf, incremental)
+    return report
@@ -0,0 +1,42 @@
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .tiles import tile_cache, invalidate_substation_tiles
+from .snapshot import snapshot_cache
+from .layer_store import layer_store
+from .feeder_tree import feeder_index
+
+# LAYERS EACH SYNC ROUTE TOUCHES, INCLUDING WHAT THE gis TRIGGERS CASCADE TO
+SUBSTATION_LAYERS = ("substation", "nodes", "primary_lines", "distribution_transformer")
+PRIMARY_LINE_LAYERS = ("primary_lines", "nodes")
+LINE_BUSHING_LAYERS = ("line_bushing", "distribution_transformer")
+
+def layers_changed(*layers:str):
+    '''Call after a bulk write, drops every cached artifact built from the layers'''
+    tile_cache.invalidate_layer(*layers)
+    layer_store.layers_changed(*layers)
+    feeder_index.layers_changed(*layers)
+    snapshot_cache.invalidate()
+
+async def substation_changed(session:AsyncSession, substation_id:int):
+    '''Call after a substation toggle, only the tiles around the substation's features are dropped'''
+    await invalidate_substation_tiles(session, substation_id)
+    layer_store.substation_changed(substation_id)
+    snapshot_cache.invalidate()
+
+def rows_changed(pending:dict):
+    '''Call with a coalesced notification batch, layer -> {id: {"op", "bbox"}} or None for the whole layer'''
+    layer_store.rows_changed(pending)
+    feeder_index.layers_changed(*pending)
+    for layer, rows in pending.items():
+        if layer not in tile_cache.versions:
+            continue
+        if rows is None:
+            tile_cache.invalidate_layer(layer)
+            continue
+        for row in rows.values():
+            if row.get("bbox"):
+                tile_cache.invalidate_bounds(layer, tuple(row["bbox"]))
+    snapshot_cache.invalidate()
+
+def transformer_types_changed():
+    '''Call after /upsert/tranformer_type, the kva ratings of the feeder tree are reloaded'''
+    feeder_index.invalidate()
@@ -0,0 +1,128 @@
+from sqlmodel import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import NamedTuple, Optional
+from .mapdata import MAPDATA_LAYERS, feature_json_sql
+from .viewport import Viewport, layer_visible
+import json
+
+# DELTA PROTOCOL ON /ws/mapdata?delta=true
+#   {"type": "snapshot", "seq": 7, "version": 3, "data": <FeatureCollection>}
+#   {"type": "delta", "seq": 8, "version": 4, "layers": {"substation": {"added": [], "changed": [], "removed": []}, ..}}
+# seq IS COUNTED PER CONNECTION, A CLIENT ONLY GETS DELTAS FOR ITS SUBSCRIPTION AND VIEWPORT
+# ONLY LAYERS WITH CHANGES FOR THE CLIENT ARE IN "layers", nodes ARE ONLY SENT AS DELTAS
+# A CLIENT THAT SEES A GAP IN seq, OR GETS {"type": "resync_required"} AFTER FALLING BEHIND,
+# SENDS {"type": "resync"} AND GETS A NEW snapshot
+RESYNC_REQUIRED = '{"type":"resync_required"}'
+
+DELTA_LAYERS = MAPDATA_LAYERS + [
+    dict(
+        name = "nodes",
+        layer = "nodes",
+        table = "gis.nodes",
+        properties = """
+            t.node_name,
+            t.description,
+            t.substation_id,
+            t.isactive""",
+    ),
+]
+
+# LAYER NAME -> KEY USED IN THE MAPDATA PAYLOAD
+LAYER_KEYS = {conf["layer"]: conf["name"] for conf in DELTA_LAYERS}
+
+class Change(NamedTuple):
+    '''One feature change, bounds is (min_lon, min_lat, max_lon, max_lat) used to route it by viewport,
+    tags holds municipality, village and substation_id used to route it by region, None if unknown'''
+    layer: str
+    kind: str
+    id: int
+    bounds: Optional[tuple[float, float, float, float]]
+    body: dict
+    tags: Optional[dict] = None
+
+
+def in_viewport(change:Change, viewport:Viewport) -> bool:
+    if not layer_visible(viewport, change.layer):
+        return False
+    if viewport.bbox is None or change.bounds is None:
+        return True
+    a, b = change.bounds, viewport.bbox
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def delta_layers(changes:list[Change]) -> dict:
+    layers = {}
+    for change in changes:
+        if change.layer in LAYER_KEYS:
+            layer = layers.setdefault(LAYER_KEYS[change.layer], dict(added=[], changed=[], removed=[]))
+            layer[change.kind].append(change.id if change.kind == "removed" else change.body)
+    return layers
+
+def layers_json(changes:list[Change]) -> str:
+    return json.dumps(delta_layers(changes), separators=(",", ":"), ensure_ascii=False)
+
+# THE LAYERS JSON IS SERIALIZED ONCE AND SHARED, ONLY seq IS FORMATTED PER CONNECTION
+def delta_message(seq:int, version:int, layers:str) -> str:
+    return f'{{"type":"delta","seq":{seq},"version":{version},"layers":{layers}}}'
+
+def snapshot_message(seq:int, version:int, data:bytes) -> str:
+    return f'{{"type":"snapshot","seq":{seq},"version":{version},"data":{data.decode()}}}'
+
+
+# EVERYTHING A SUBSTATION TOGGLE TOUCHES ON THE MAP, node_is_active() CASCADES isactive BY substation_id
+substation_status_sql = text("""
+    SELECT 'substation' AS layer, id, isactive, village, municipality, ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)
+    FROM gis.substation WHERE id = :substation_id
+    UNION ALL
+    SELECT 'nodes', id, isactive, village, municipality, ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)
+    FROM gis.nodes WHERE substation_id = :substation_id
+    UNION ALL
+    SELECT 'primary_lines', id, isactive, village, municipality, ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)
+    FROM gis.primary_lines WHERE substation_id = :substation_id
+    UNION ALL
+    SELECT 'distribution_transformer', id, isactive, village, municipality, ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)
+    FROM gis.distribution_transformer WHERE substation_id = :substation_id
+""")
+
+async def substation_changes(session:AsyncSession, substation_id:int) -> list[Change]:
+    result = await session.exec(substation_status_sql.bindparams(substation_id=substation_id))
+    return [
+        Change(layer, "changed", feature_id,
+               None if xmin is None else (xmin, ymin, xmax, ymax),
+               dict(id=feature_id, properties=dict(isactive=isactive)),
+               dict(municipality=municipality, village=village, substation_id=substation_id))
+        for layer, feature_id, isactive, village, municipality, xmin, ymin, xmax, ymax in result
+    ]
+
+
+# FULL FEATURES OF THE ROWS A NOTIFICATION BATCH TOUCHED, WITH THEIR REGION TAGS
+def changed_features_sql(conf:dict):
+    substation_id = "t.id" if conf["layer"] == "substation" else "t.substation_id"
+    feature, join = feature_json_sql(conf)
+    return text(f"""
+        SELECT t.id, {feature}, t.municipality, t.village, {substation_id}
+        FROM {conf["table"]} AS t
+        {join}
+        WHERE t.id = ANY(:ids)
+    """)
+
+async def feature_changes(session:AsyncSession, pending:dict) -> Optional[list[Change]]:
+    '''Changes of a coalesced notification batch, None when a map layer changed in bulk and clients have to resync'''
+    changes = []
+    for conf in DELTA_LAYERS:
+        if conf["layer"] not in pending:
+            continue
+        rows = pending[conf["layer"]]
+        if rows is None:
+            return None
+        result = await session.exec(changed_features_sql(conf).bindparams(ids=list(rows)))
+        features = {row[0]: row[1:] for row in result.all()}
+        for feature_id, row in rows.items():
+            bounds = tuple(row["bbox"]) if row.get("bbox") else None
+            if feature_id not in features:
+                changes.append(Change(conf["layer"], "removed", feature_id, bounds, {}))
+                continue
+            feature, municipality, village, substation_id = features[feature_id]
+            kind = "added" if row["op"] == "INSERT" else "changed"
+            changes.append(Change(conf["layer"], kind, feature_id, bounds, json.loads(feature),
+                                  dict(municipality=municipality, village=village, substation_id=substation_id)))
+    return changes
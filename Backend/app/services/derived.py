@@ -0,0 +1,167 @@
+from sqlmodel import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..db.sessesion import PUBLISHED_LAYERS
+from ..db.supa_model import FEATURE_PROPERTIES, republish_sql
+from .topology import trace_substations
+import json
+import time
+
+# BULK LOAD MODE, THE gis TRIGGERS ARE OFF FOR THE TRANSACTION (session_replication_role = replica)
+# AND WHAT THEY WOULD HAVE SET ROW BY ROW IS RECOMPUTED HERE WITH A FEW SPATIAL JOINS
+# replica ALSO SKIPS FOREIGN KEY CHECKS AND THE gis_changes NOTIFY, A BULK NOTIFY IS SENT INSTEAD
+DERIVED_TABLES = ("substation", "nodes", "primary_lines", "line_bushing", "distribution_transformer")
+
+disable_triggers_sql = text("SET LOCAL session_replication_role = replica")
+
+# EACH STATEMENT IS ONE OF THE ROW TRIGGERS OF supa_model.py, ONLY ROWS THAT CHANGE ARE WRITTEN
+DERIVED_SQL = dict(
+    # gis.update_vill_mun() AND gis.update_franchise_area_id()
+    substation = text("""
+        UPDATE gis.substation AS t
+        SET village = f.village, municipality = f.municipality, franchise_area_id = f.id
+        FROM gis.substation AS s
+        LEFT JOIN LATERAL (
+            SELECT fa.id, fa.village, fa.municipality FROM gis.franchise_area AS fa
+            WHERE ST_Intersects(fa.geom, s.geom) LIMIT 1
+        ) AS f ON true
+        WHERE t.id = s.id
+        AND (t.village, t.municipality, t.franchise_area_id) IS DISTINCT FROM (f.village, f.municipality, f.id)
+    """),
+    # gis.update_vill_mun() AND gis.update_nodes_substation_id()
+    nodes = text("""
+        UPDATE gis.nodes AS t
+        SET village = f.village,
+            municipality = f.municipality,
+            substation_id = CASE WHEN sub.any_id IS NULL THEN t.substation_id ELSE sub.primary_id END
+        FROM gis.nodes AS n
+        LEFT JOIN LATERAL (
+            SELECT fa.village, fa.municipality FROM gis.franchise_area AS fa
+            WHERE ST_Intersects(fa.geom, n.geom) LIMIT 1
+        ) AS f ON true
+        CROSS JOIN LATERAL (
+            SELECT min(s.id) AS any_id, min(s.id) FILTER (WHERE n.description ILIKE '%primary%') AS primary_id
+            FROM gis.substation AS s WHERE ST_Intersects(s.geom, n.geom)
+        ) AS sub
+        WHERE t.id = n.id
+        AND (t.village, t.municipality, t.substation_id)
+            IS DISTINCT FROM (f.village, f.municipality, CASE WHEN sub.any_id IS NULL THEN t.substation_id ELSE sub.primary_id END)
+    """),
+    # gis.update_primary_line(), substation_id IS SET BY THE TRACE
+    primary_lines = text("""
+        UPDATE gis.primary_lines AS t
+        SET from_node = a.node_name, to_node = b.node_name, node_id = b.id, village = b.village, municipality = b.municipality
+        FROM gis.primary_lines AS pl
+        LEFT JOIN LATERAL (
+            SELECT n.node_name FROM gis.nodes AS n
+            WHERE ST_Intersects(n.geom, ST_StartPoint(pl.geom)) AND n.description ILIKE '%primary%' LIMIT 1
+        ) AS a ON true
+        LEFT JOIN LATERAL (
+            SELECT n.id, n.node_name, n.village, n.municipality FROM gis.nodes AS n
+            WHERE ST_Intersects(n.geom, ST_EndPoint(pl.geom)) AND n.description ILIKE '%primary%' LIMIT 1
+        ) AS b ON true
+        WHERE t.id = pl.id
+        AND (t.from_node, t.to_node, t.node_id, t.village, t.municipality)
+            IS DISTINCT FROM (a.node_name, b.node_name, b.id, b.village, b.municipality)
+    """),
+    # gis.line_bushing_update(), A BUSHING STARTING ON THE END OF A PRIMARY LINE
+    primary_bushings = text("""
+        UPDATE gis.line_bushing AS t
+        SET primary_line_id = pl.id, from_node_id = pl.to_node, to_node_id = dt.transformer_id,
+            description = 'PRIMARY LINE BUSHING', village = pl.village, municipality = pl.municipality
+        FROM gis.line_bushing AS lb
+        CROSS JOIN LATERAL (
+            SELECT p.id, p.to_node, p.village, p.municipality FROM gis.primary_lines AS p
+            WHERE ST_Intersects(ST_EndPoint(p.geom), ST_StartPoint(lb.geom)) LIMIT 1
+        ) AS pl
+        LEFT JOIN LATERAL (
+            SELECT d.transformer_id FROM gis.distribution_transformer AS d
+            WHERE ST_Intersects(d.geom, ST_EndPoint(lb.geom)) LIMIT 1
+        ) AS dt ON true
+        WHERE t.id = lb.id
+        AND (t.primary_line_id, t.from_node_id, t.to_node_id, t.description, t.village, t.municipality)
+            IS DISTINCT FROM (pl.id, pl.to_node, dt.transformer_id, 'PRIMARY LINE BUSHING', pl.village, pl.municipality)
+    """),
+    # gis.line_bushing_update(), A BUSHING STARTING ON A TRANSFORMER
+    secondary_bushings = text("""
+        UPDATE gis.line_bushing AS t
+        SET primary_line_id = up.primary_line_id, from_node_id = dt.transformer_id, to_node_id = n.node_name,
+            description = 'SECONDARY LINE BUSHING', village = dt.village, municipality = dt.municipality
+        FROM gis.line_bushing AS lb
+        CROSS JOIN LATERAL (
+            SELECT d.transformer_id, d.village, d.municipality FROM gis.distribution_transformer AS d
+            WHERE ST_Intersects(d.geom, ST_StartPoint(lb.geom)) LIMIT 1
+        ) AS dt
+        LEFT JOIN LATERAL (
+            SELECT u.primary_line_id FROM gis.line_bushing AS u
+            WHERE ST_Intersects(ST_EndPoint(u.geom), ST_StartPoint(lb.geom)) LIMIT 1
+        ) AS up ON true
+        LEFT JOIN LATERAL (
+            SELECT x.node_name FROM gis.nodes AS x
+            WHERE ST_Intersects(x.geom, ST_EndPoint(lb.geom)) LIMIT 1
+        ) AS n ON true
+        WHERE t.id = lb.id
+        AND NOT EXISTS (
+            SELECT 1 FROM gis.primary_lines AS p WHERE ST_Intersects(ST_EndPoint(p.geom), ST_StartPoint(lb.geom))
+        )
+        AND (t.primary_line_id, t.from_node_id, t.to_node_id, t.description, t.village, t.municipality)
+            IS DISTINCT FROM (up.primary_line_id, dt.transformer_id, n.node_name, 'SECONDARY LINE BUSHING', dt.village, dt.municipality)
+    """),
+    # gis.line_bushing_after_update(), substation_id IS SET BY THE TRACE
+    transformer_primary = text("""
+        UPDATE gis.distribution_transformer AS dt
+        SET line_bushing_id = lb.id, from_primary_node = lb.from_node_id, primary_phasing = lb.phasing,
+            village = lb.village, municipality = lb.municipality
+        FROM gis.line_bushing AS lb
+        WHERE lb.description ILIKE '%primary%' AND lb.to_node_id = dt.transformer_id
+        AND (dt.line_bushing_id, dt.from_primary_node, dt.primary_phasing, dt.village, dt.municipality)
+            IS DISTINCT FROM (lb.id, lb.from_node_id, lb.phasing, lb.village, lb.municipality)
+    """),
+    transformer_secondary = text("""
+        UPDATE gis.distribution_transformer AS dt
+        SET to_secondary_node = lb.to_node_id, secondary_phasing = lb.phasing
+        FROM gis.line_bushing AS lb
+        WHERE lb.description ILIKE '%secondary%' AND lb.from_node_id = dt.transformer_id
+        AND (dt.to_secondary_node, dt.secondary_phasing) IS DISTINCT FROM (lb.to_node_id, lb.phasing)
+    """),
+)
+
+# gis.node_is_active(), AFTER THE TRACE EVERY FEATURE TAKES isactive OF ITS SUBSTATION
+ISACTIVE_SQL = [
+    text(f"""
+        UPDATE {table} AS t SET isactive = s.isactive
+        FROM gis.substation AS s
+        WHERE t.substation_id = s.id AND t.isactive IS DISTINCT FROM s.isactive
+    """)
+    for table in ("gis.nodes", "gis.primary_lines", "gis.distribution_transformer")
+]
+
+# THE ROLLUP STATEMENT TRIGGERS ARE OFF TOO, gis.network_rollup IS RECOMPUTED FROM THE LOADED TABLES
+rollup_rebuild_sql = text("SELECT gis.rollup_rebuild()")
+
+# AND THE feature_json OF THE PUBLISHED LAYERS IS RENDERED AGAIN, LAST, FROM THE FINAL ROWS
+REPUBLISH_SQL = {table: text(republish_sql(table)) for table in FEATURE_PROPERTIES}
+
+bulk_notify_sql = text("SELECT pg_notify('gis_changes', :payload)")
+
+
+async def recompute_derived(session:AsyncSession) -> dict:
+    '''Run inside the bulk load transaction, after every layer is merged. Does not commit'''
+    started = time.perf_counter()
+    updated = {}
+    for name, stmt in DERIVED_SQL.items():
+        result = await session.exec(stmt)
+        updated[name] = result.rowcount
+    trace = await trace_substations(session, commit=False)
+    updated["isactive"] = 0
+    for stmt in ISACTIVE_SQL:
+        result = await session.exec(stmt)
+        updated["isactive"] += result.rowcount
+    await session.exec(rollup_rebuild_sql)
+    if PUBLISHED_LAYERS:
+        for table, stmt in REPUBLISH_SQL.items():
+            result = await session.exec(stmt)
+            updated[f"published_{table}"] = result.rowcount
+    # THE ROW TRIGGERS DID NOT NOTIFY, EVERY LISTENER RELOADS THE TABLES
+    for table in DERIVED_TABLES:
+        await session.exec(bulk_notify_sql.bindparams(payload=json.dumps(dict(layer=table, op="BULK"))))
+    return dict(updated=updated, trace=trace, derived_ms=round((time.perf_counter() - started) * 1000, 1))
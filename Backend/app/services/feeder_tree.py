@@ -0,0 +1,287 @@
+from sqlmodel import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order, depth_first_order
+from ..db.sessesion import engine_registry
+from .topology import seeds_sql
+from .mapdata import feature_columns
+from .deltas import DELTA_LAYERS
+from typing import Optional
+import asyncio
+import numpy as np
+import time
+
+# LAYERS THE FEEDER TREE IS BUILT FROM, A WRITE TO ANY OF THEM REBUILDS IT ON THE NEXT QUERY
+FEEDER_LAYERS = ("substation", "nodes", "primary_lines", "line_bushing", "distribution_transformer")
+
+# VERTEX KINDS
+SUBSTATION, NODE, LINE, BUSHING, TRANSFORMER = range(5)
+KIND_NAMES = ("substation", "nodes", "primary_lines", "line_bushing", "distribution_transformer")
+
+substations_sql = text("SELECT id, generator_name FROM gis.substation")
+nodes_sql = text("SELECT id, node_name FROM gis.nodes WHERE node_name IS NOT NULL")
+lines_sql = text("SELECT id, line_id, from_node, to_node FROM gis.primary_lines")
+bushings_sql = text("""
+    SELECT id, line_bushing_name, primary_line_id, from_node_id, to_node_id, description
+    FROM gis.line_bushing
+""")
+transformers_sql = text("""
+    SELECT dt.id, dt.transformer_id, dt.from_primary_node, tt.kva_rating
+    FROM gis.distribution_transformer AS dt
+    LEFT JOIN gis.transformer_type AS tt ON tt.name = dt.transformer_type
+""")
+
+# FEATURE JSON OF THE TRACE ENDPOINTS, THE PROPERTIES OF THE MAP LAYERS PLUS THE layer OF THE FEATURE
+TRACE_LAYERS = {conf["layer"]: conf for conf in DELTA_LAYERS + [
+    dict(
+        name = "line_bushing",
+        layer = "line_bushing",
+        table = "gis.line_bushing",
+        properties = """
+            t.line_bushing_name,
+            t.description,
+            t.from_node_id,
+            t.to_node_id,
+            t.phasing""",
+    ),
+]}
+
+def trace_sql(conf:dict):
+    columns = feature_columns(dict(conf, properties=f"{conf['properties']}, '{conf['layer']}' AS layer"))
+    return text(f"""
+        SELECT t.id, row_to_json(f)::text
+        FROM {conf["table"]} AS t
+        CROSS JOIN LATERAL (SELECT {columns}) AS f
+        WHERE t.id = ANY(:ids)
+    """)
+
+
+class FeederTree:
+    '''The radial network as one tree over every feature, a virtual root feeds the substations.
+    The tree is laid out in DFS preorder (Euler tour), the subtree of v is preorder[position[v]:position[v] + subtree[v]],
+    so what hangs below any set of features is a few array slices'''
+    def __init__(self):
+        self.kinds: list[int] = []
+        self.ids: list[Optional[int]] = []
+        self.names: list[Optional[str]] = []
+        self.kva: list[float] = []
+        # (KIND, ROW id) AND NODE NAME -> VERTEX
+        self.index: dict[tuple[int, int], int] = {}
+        self.node_index: dict[str, int] = {}
+        self.src: list[int] = []
+        self.dst: list[int] = []
+
+    def vertex(self, kind:int, row_id:Optional[int], name:Optional[str], kva:float = 0.0) -> int:
+        vertex = len(self.kinds)
+        self.kinds.append(kind)
+        self.ids.append(row_id)
+        self.names.append(name)
+        self.kva.append(kva)
+        if row_id is not None:
+            self.index[(kind, row_id)] = vertex
+        return vertex
+
+    def node(self, name:Optional[str]) -> Optional[int]:
+        # LINE AND BUSHING ENDS ARE NODE NAMES, A NAME WITHOUT A nodes ROW IS STILL A VERTEX
+        if name is None:
+            return None
+        if name not in self.node_index:
+            self.node_index[name] = self.vertex(NODE, None, name)
+        return self.node_index[name]
+
+    def edge(self, parent:Optional[int], child:Optional[int]):
+        if parent is not None and child is not None:
+            self.src.append(parent)
+            self.dst.append(child)
+
+    def build(self, substations:list, seeds:dict[str, int], nodes:list, lines:list, bushings:list, transformers:list):
+        for substation_id, name in substations:
+            self.vertex(SUBSTATION, substation_id, name)
+        for node_id, name in nodes:
+            if name not in self.node_index:
+                self.node_index[name] = self.vertex(NODE, node_id, name)
+        for name, substation_id in seeds.items():
+            self.edge(self.index.get((SUBSTATION, substation_id)), self.node(name))
+        for line_id, name, from_node, to_node in lines:
+            line = self.vertex(LINE, line_id, name)
+            self.edge(self.node(from_node), line)
+            self.edge(line, self.node(to_node))
+        by_transformer = {}
+        for row_id, transformer_id, from_primary_node, kva in transformers:
+            by_transformer[transformer_id] = self.vertex(TRANSFORMER, row_id, transformer_id, float(kva or 0))
+        fed = set()
+        # PRIMARY BUSHINGS HANG FROM THE END NODE OF THEIR LINE (from_node_id) AND FEED A TRANSFORMER,
+        # SECONDARY BUSHINGS LEAVE A TRANSFORMER
+        for bushing_id, name, primary_line_id, from_node_id, to_node_id, description in bushings:
+            bushing = self.vertex(BUSHING, bushing_id, name)
+            description = (description or "").upper()
+            if "PRIMARY" in description:
+                parent = self.node(from_node_id) if from_node_id is not None else self.index.get((LINE, primary_line_id))
+                self.edge(parent, bushing)
+                transformer = by_transformer.get(to_node_id)
+                self.edge(bushing, transformer)
+                fed.add(transformer)
+            elif "SECONDARY" in description:
+                self.edge(by_transformer.get(from_node_id), bushing)
+                self.edge(bushing, self.node(to_node_id))
+        # A TRANSFORMER WITHOUT A PRIMARY BUSHING HANGS FROM ITS from_primary_node
+        for row_id, transformer_id, from_primary_node, kva in transformers:
+            transformer = by_transformer[transformer_id]
+            if transformer not in fed:
+                self.edge(self.node(from_primary_node), transformer)
+        self.pack()
+
+    def pack(self):
+        size = len(self.kinds)
+        root = size
+        substations = [v for v, kind in enumerate(self.kinds) if kind == SUBSTATION]
+        src = np.array(self.src + [root] * len(substations), dtype=np.int64)
+        dst = np.array(self.dst + substations, dtype=np.int64)
+        graph = csr_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(size + 1, size + 1))
+        # BFS KEEPS EACH FEATURE ON THE SUBSTATION IT IS FEWEST HOPS FROM (AS THE TOPOLOGY TRACE), A MESH BECOMES A TREE
+        order, predecessors = breadth_first_order(graph, root, directed=True, return_predecessors=True)
+        children = order[1:]
+        parents = predecessors[children]
+        tree = csr_matrix((np.ones(len(children), dtype=np.int8), (parents, children)), shape=(size + 1, size + 1))
+        preorder = depth_first_order(tree, root, directed=True, return_predecessors=False)
+        self.parent = np.full(size + 1, -1, dtype=np.int64)
+        self.parent[children] = parents
+        # SUBTREE SIZES, CHILDREN BEFORE PARENTS
+        subtree = np.ones(size + 1, dtype=np.int64)
+        for vertex in preorder[:0:-1]:
+            subtree[self.parent[vertex]] += subtree[vertex]
+        self.preorder = preorder
+        self.position = np.full(size + 1, -1, dtype=np.int64)
+        self.position[preorder] = np.arange(len(preorder))
+        self.subtree = subtree
+        self.kind_array = np.array(self.kinds + [-1], dtype=np.int8)
+        self.kva_array = np.array(self.kva + [0.0], dtype=np.float64)
+        self.root = root
+
+    def find(self, kind:int, key) -> Optional[int]:
+        if kind == NODE:
+            return self.node_index.get(key)
+        return self.index.get((kind, key))
+
+    def energized(self, vertex:int) -> bool:
+        '''Reached from a substation'''
+        return self.position[vertex] >= 0
+
+    def downstream(self, vertices:list[int]) -> np.ndarray:
+        '''Every vertex below (and including) the given ones. Subtree intervals are nested or disjoint,
+        an interval inside the previous one is skipped so nothing is visited twice'''
+        intervals = sorted(
+            (self.position[v], self.position[v] + self.subtree[v]) for v in vertices if self.energized(v))
+        slices, end = [], -1
+        for start, stop in intervals:
+            if start >= end:
+                slices.append(self.preorder[start:stop])
+                end = stop
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def upstream(self, vertex:int) -> list[int]:
+        '''The vertex and every vertex on its way up to the substation'''
+        path = []
+        while vertex >= 0 and vertex != self.root:
+            path.append(vertex)
+            vertex = self.parent[vertex]
+        return path
+
+    def features(self, vertices) -> dict[str, list[dict]]:
+        '''Vertices grouped by layer, vertices without a row (bare node names) are left out'''
+        grouped = {name: [] for name in KIND_NAMES}
+        for vertex in vertices:
+            row_id = self.ids[vertex]
+            if row_id is None:
+                continue
+            feature = dict(id=row_id, name=self.names[vertex])
+            if self.kinds[vertex] == TRANSFORMER:
+                feature["kva"] = self.kva[vertex]
+            grouped[KIND_NAMES[self.kinds[vertex]]].append(feature)
+        return grouped
+
+    def outage(self, vertices:list[int]) -> dict:
+        affected = self.downstream(vertices)
+        grouped = self.features(affected)
+        kva = self.kva_array[affected[self.kind_array[affected] == TRANSFORMER]].sum()
+        return dict(
+            features = grouped,
+            totals = dict({name: len(rows) for name, rows in grouped.items()}, kva = round(float(kva), 2)),
+        )
+
+    def stats(self) -> dict:
+        return dict(
+            vertices = len(self.kinds),
+            edges = len(self.src),
+            energized = int((self.position[:-1] >= 0).sum()),
+        )
+
+
+async def load_feeder_tree(session:AsyncSession) -> FeederTree:
+    tree = FeederTree()
+    tree.build(
+        substations = (await session.exec(substations_sql)).all(),
+        seeds = {name: substation_id for name, substation_id in (await session.exec(seeds_sql)).all()},
+        nodes = (await session.exec(nodes_sql)).all(),
+        lines = (await session.exec(lines_sql)).all(),
+        bushings = (await session.exec(bushings_sql)).all(),
+        transformers = (await session.exec(transformers_sql)).all(),
+    )
+    return tree
+
+async def trace_features(session:AsyncSession, tree:FeederTree, vertices) -> list[str]:
+    '''Feature JSON of the vertices in trace order, one query by primary key per layer'''
+    keys = [(KIND_NAMES[tree.kinds[vertex]], tree.ids[vertex]) for vertex in vertices if tree.ids[vertex] is not None]
+    by_layer: dict[str, list[int]] = {}
+    for layer, row_id in keys:
+        by_layer.setdefault(layer, []).append(row_id)
+    fragments = {}
+    for layer, ids in by_layer.items():
+        result = await session.exec(trace_sql(TRACE_LAYERS[layer]).bindparams(ids=ids))
+        for row_id, fragment in result.all():
+            fragments[(layer, row_id)] = fragment
+    return [fragments[key] for key in keys if key in fragments]
+
+
+class FeederIndex:
+    '''One feeder tree per worker, built on the first query and rebuilt on the first query after a write'''
+    def __init__(self):
+        self.tree: Optional[FeederTree] = None
+        self.version = 0
+        self.built_version = -1
+        self.lock = asyncio.Lock()
+        self.builds = 0
+        self.build_ms = 0.0
+
+    def invalidate(self):
+        self.version += 1
+
+    def layers_changed(self, *layers:str):
+        if any(layer in FEEDER_LAYERS for layer in layers):
+            self.invalidate()
+
+    async def get(self) -> FeederTree:
+        if self.tree is not None and self.built_version == self.version:
+            return self.tree
+        async with self.lock:
+            if self.tree is None or self.built_version != self.version:
+                # A WRITE DURING THE BUILD LEAVES IT STALE, THE NEXT QUERY BUILDS AGAIN
+                version = self.version
+                started = time.perf_counter()
+                async with AsyncSession(engine_registry.supa_engine) as session:
+                    self.tree = await load_feeder_tree(session)
+                self.built_version = version
+                self.builds += 1
+                self.build_ms = round((time.perf_counter() - started) * 1000, 1)
+        return self.tree
+
+    def stats(self) -> dict:
+        return dict(
+            built = self.tree is not None,
+            stale = self.built_version != self.version,
+            builds = self.builds,
+            build_ms = self.build_ms,
+            **(self.tree.stats() if self.tree is not None else {}),
+        )
+
+feeder_index = FeederIndex()
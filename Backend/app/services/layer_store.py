@@ -0,0 +1,247 @@
+from sqlmodel import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import Optional
+from ..db.sessesion import engine_registry, env_bool
+from .mapdata import MAPDATA_LAYERS, feature_json_sql
+from .deltas import DELTA_LAYERS
+from .viewport import Viewport, layer_visible
+import numpy as np
+import shapely
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# KEEP THE MAP LAYERS IN PROCESS AND ANSWER /mapdata WITHOUT A ROUND TRIP TO SUPABASE
+ENABLED = env_bool("LAYERSTORE", False)
+
+# nearest() FIRST SEARCHES THIS FAR BEYOND THE NEAREST FEATURE, IN DEGREES (ABOUT 10 m)
+NEAREST_MIN_RADIUS = 1e-4
+
+# LAYER NAME -> CONF OF THE LAYERS KEPT IN MEMORY (THE MAPDATA LAYERS AND nodes)
+STORE_LAYERS = {conf["layer"]: conf for conf in DELTA_LAYERS}
+
+
+def load_sql(conf:dict, where:str = ""):
+    '''id, WKB geometry and the Feature JSON of each row, the same JSON /mapdata builds in PostGIS'''
+    feature, join = feature_json_sql(conf)
+    return text(f"""
+        SELECT t.id, ST_AsBinary(t.geom), {feature}
+        FROM {conf["table"]} AS t
+        {join}
+        {where}
+    """)
+
+
+class LayerIndex:
+    '''One layer, rows are kept by id and packed into sorted arrays with an STRtree on first query after a change'''
+    def __init__(self):
+        self.features: dict[int, tuple[Optional[shapely.Geometry], str]] = {}
+        self.dirty = True
+        self.ids = np.empty(0, dtype=np.int64)
+        self.geoms = np.empty(0, dtype=object)
+        self.fragments: list[str] = []
+        self.tree = shapely.STRtree([])
+        self.located = 0
+
+    def replace(self, rows:list):
+        self.features = {}
+        self.upsert(rows)
+
+    def upsert(self, rows:list):
+        geoms = shapely.from_wkb([None if wkb is None else bytes(wkb) for _, wkb, _ in rows])
+        for (feature_id, _, fragment), geom in zip(rows, geoms):
+            self.features[feature_id] = (geom, fragment)
+        self.dirty = True
+
+    def remove(self, ids):
+        for feature_id in ids:
+            self.features.pop(feature_id, None)
+        self.dirty = True
+
+    def pack(self):
+        if not self.dirty:
+            return
+        # SORTED BY id, SAME ORDER AS THE string_agg(.. ORDER BY id) OF THE SQL PATH
+        ids = sorted(self.features)
+        self.ids = np.array(ids, dtype=np.int64)
+        self.geoms = np.array([self.features[feature_id][0] for feature_id in ids], dtype=object)
+        self.fragments = [self.features[feature_id][1] for feature_id in ids]
+        self.tree = shapely.STRtree(self.geoms)
+        # ROWS WITH A GEOMETRY, THE ONLY ONES IN THE STRtree
+        self.located = int(np.count_nonzero(~shapely.is_missing(self.geoms)))
+        self.dirty = False
+
+    def query(self, bbox:Optional[tuple]) -> str:
+        '''Comma separated Feature objects intersecting the bbox, every feature without one'''
+        self.pack()
+        if bbox is None:
+            return ",".join(self.fragments)
+        hits = np.sort(self.tree.query(shapely.box(*bbox), predicate="intersects"))
+        return ",".join(self.fragments[index] for index in hits)
+
+    def nearest(self, lon:float, lat:float, limit:int = 1) -> list[str]:
+        '''The limit features nearest to the point, by distance then id like the SQL path, rows without geometry are skipped.
+        The STRtree gives every feature within a radius around the nearest one, widened until it holds limit'''
+        self.pack()
+        point = shapely.Point(lon, lat)
+        nearest, distance = self.tree.query_nearest(point, return_distance=True)
+        if not len(nearest):
+            return []
+        limit = min(limit, self.located)
+        radius = float(distance[0]) + NEAREST_MIN_RADIUS
+        while True:
+            # THE ENVELOPE QUERY IS CHEAP, THE DISTANCES ARE ONLY COMPUTED FOR ITS HITS
+            hits = np.sort(self.tree.query(shapely.box(lon - radius, lat - radius, lon + radius, lat + radius)))
+            distances = shapely.distance(self.geoms[hits], point)
+            within = distances <= radius
+            if within.sum() >= limit:
+                break
+            # limit HITS ARE NO FARTHER THAN THE limit-th DISTANCE, ONE MORE QUERY WITH IT AS RADIUS IS ENOUGH
+            radius = float(np.partition(distances, limit - 1)[limit - 1]) if len(hits) >= limit else radius * 2
+        hits, distances = hits[within], distances[within]
+        order = np.argsort(distances, kind="stable")[:limit]
+        return [self.fragments[index] for index in hits[order]]
+
+
+class LayerStore:
+    '''The map layers held in memory. Writes only mark rows stale, they are reloaded by id before the next read'''
+    def __init__(self):
+        self.layers: dict[str, LayerIndex] = {}
+        # LAYER -> STALE ROW IDS, None WHEN THE WHOLE LAYER HAS TO BE RELOADED
+        self.stale: dict[str, Optional[set[int]]] = {}
+        # SUBSTATION TOGGLES, ROWS ARE RELOADED BY substation_id
+        self.stale_substations: set[int] = set()
+        self.lock = asyncio.Lock()
+        self.loaded_at: Optional[float] = None
+        self.reloads = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    async def load(self):
+        async with self.lock:
+            async with AsyncSession(engine_registry.supa_engine) as session:
+                for layer, conf in STORE_LAYERS.items():
+                    result = await session.exec(load_sql(conf))
+                    self.layers.setdefault(layer, LayerIndex()).replace(result.all())
+                    self.layers[layer].pack()
+            self.stale.clear()
+            self.stale_substations.clear()
+            self.loaded_at = time.time()
+
+    async def start(self):
+        if not ENABLED:
+            return
+        try:
+            await self.load()
+        except Exception as exc:
+            # /mapdata STAYS ON THE SQL PATH
+            logger.warning("LAYER STORE LOAD FAILED: %s", exc)
+
+    # STALE MARKERS, CALLED FROM services/changes.py
+    def layers_changed(self, *layers:str):
+        if not self.loaded:
+            return
+        for layer in layers:
+            if layer in STORE_LAYERS:
+                self.stale[layer] = None
+
+    def rows_changed(self, pending:dict):
+        if not self.loaded:
+            return
+        for layer, rows in pending.items():
+            if layer not in STORE_LAYERS or self.stale.get(layer, set()) is None:
+                continue
+            if rows is None:
+                self.stale[layer] = None
+            else:
+                self.stale.setdefault(layer, set()).update(rows)
+
+    def substation_changed(self, substation_id:int):
+        if not self.loaded:
+            return
+        self.stale_substations.add(substation_id)
+
+    async def refresh(self):
+        '''Reload what went stale, the session is only opened if something did'''
+        if not self.stale and not self.stale_substations:
+            return
+        async with self.lock:
+            stale, self.stale = self.stale, {}
+            substations, self.stale_substations = self.stale_substations, set()
+            if not stale and not substations:
+                return
+            try:
+                async with AsyncSession(engine_registry.supa_engine) as session:
+                    await self.reload(session, stale, substations)
+            except Exception:
+                # TRY AGAIN ON THE NEXT READ
+                for layer, rows in stale.items():
+                    self.rows_changed({layer: rows})
+                self.stale_substations |= substations
+                raise
+
+    async def reload(self, session:AsyncSession, stale:dict, substations:set[int]):
+        for layer, conf in STORE_LAYERS.items():
+            index = self.layers[layer]
+            rows = stale.get(layer, set())
+            if rows is None:
+                result = await session.exec(load_sql(conf))
+                index.replace(result.all())
+                self.reloads += 1
+                continue
+            if rows:
+                result = await session.exec(load_sql(conf, "WHERE t.id = ANY(:ids)").bindparams(ids=list(rows)))
+                found = result.all()
+                index.remove(rows - {row[0] for row in found})
+                index.upsert(found)
+            if substations:
+                substation_id = "t.id" if layer == "substation" else "t.substation_id"
+                result = await session.exec(
+                    load_sql(conf, f"WHERE {substation_id} = ANY(:substations)").bindparams(substations=list(substations)))
+                index.upsert(result.all())
+
+    async def build_mapdata(self, viewport:Viewport = Viewport()) -> bytes:
+        '''Same payload as services/mapdata.build_mapdata, answered from memory'''
+        await self.refresh()
+        parts = []
+        for conf in MAPDATA_LAYERS:
+            features = ""
+            if layer_visible(viewport, conf["layer"]):
+                features = self.layers[conf["layer"]].query(viewport.bbox)
+            parts.append(f'{{"{conf["name"]}":[{features}]}}')
+        return f'{{"type":"FeatureCollection","features":[{",".join(parts)}]}}'.encode()
+
+    async def nearest(self, layer:str, lon:float, lat:float, limit:int = 1) -> list[str]:
+        await self.refresh()
+        return self.layers[layer].nearest(lon, lat, limit)
+
+    def stats(self) -> dict:
+        return dict(
+            enabled = ENABLED,
+            loaded = self.loaded,
+            loaded_at = self.loaded_at,
+            reloads = self.reloads,
+            features = {layer: len(index.features) for layer, index in self.layers.items()},
+            stale = {layer: "all" if rows is None else len(rows) for layer, rows in self.stale.items()},
+            stale_substations = len(self.stale_substations),
+        )
+
+layer_store = LayerStore()
+
+
+# SQL PATH OF THE NEAREST QUERY WHEN THE STORE IS NOT LOADED, <-> USES THE GIST INDEX ON geom
+NEAREST_SQL = """
+            WHERE t.geom IS NOT NULL
+            ORDER BY t.geom <-> ST_SetSRID(ST_MakePoint(:lon, :lat), 4326), t.id
+            LIMIT :limit"""
+
+async def nearest_features(session:AsyncSession, layer:str, lon:float, lat:float, limit:int = 1) -> list[str]:
+    conf = STORE_LAYERS[layer]
+    feature, join = feature_json_sql(conf)
+    stmt = text(f"SELECT {feature} FROM {conf['table']} AS t {join} {NEAREST_SQL}")
+    result = await session.exec(stmt.bindparams(lon=lon, lat=lat, limit=limit))
+    return list(result.scalars())
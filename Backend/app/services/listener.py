@@ -0,0 +1,119 @@
+from typing import Awaitable, Callable, Optional
+from ..db.sessesion import engine_registry, env_int
+from .tiles import TILE_LAYERS
+import asyncio
+import asyncpg
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "gis_changes"
+# MILLISECONDS TO KEEP COLLECTING NOTIFICATIONS BEFORE ONE PUSH
+COALESCE_MS = env_int("NOTIFYCOALESCEMS", 200)
+RECONNECT_SECONDS = 5
+# MORE CHANGED ROWS THAN THIS IN ONE LAYER IS HANDLED AS A BULK CHANGE OF THE WHOLE LAYER
+BULK_ROWS = env_int("NOTIFYBULKROWS", 5000)
+
+# LAYER -> ROW ID -> {"op": .., "bbox": ..}, None WHEN THE WHOLE LAYER HAS TO BE RELOADED
+Pending = dict[str, Optional[dict[int, dict]]]
+
+
+class ChangeListener:
+    '''One LISTEN connection per process, notifications are coalesced and handed to a callback in batches'''
+    def __init__(self):
+        self.pending: Pending = {}
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.connection: Optional[asyncpg.Connection] = None
+        self.on_changes: Optional[Callable[[Pending], Awaitable[None]]] = None
+        self.received = 0
+        self.batches = 0
+
+    @property
+    def running(self) -> bool:
+        return self.connection is not None and not self.connection.is_closed()
+
+    def on_notify(self, connection, pid, channel, payload:str):
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            return
+        self.received += 1
+        self.wakeup.set()
+        rows = self.pending.setdefault(change["layer"], {})
+        if rows is None:
+            return
+        # A BULK LOAD SENDS ONE {"layer", "op": "BULK"} PER TABLE INSTEAD OF A NOTIFY PER ROW
+        if len(rows) >= BULK_ROWS or change["op"] == "BULK":
+            self.pending[change["layer"]] = None
+            return
+        previous = rows.get(change["id"])
+        # AN INSERT FOLLOWED BY UPDATES IS STILL AN INSERT FOR THE CLIENT
+        if previous and previous["op"] == "INSERT" and change["op"] == "UPDATE":
+            change["op"] = "INSERT"
+        rows[change["id"]] = dict(op=change["op"], bbox=change.get("bbox"))
+
+    async def start(self, on_changes:Callable[[Pending], Awaitable[None]]):
+        self.on_changes = on_changes
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.close()
+
+    async def close(self):
+        if self.connection is not None and not self.connection.is_closed():
+            await self.connection.close()
+        self.connection = None
+
+    async def listen(self):
+        dsn = engine_registry.supa_engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        self.connection = await asyncpg.connect(dsn)
+        await self.connection.add_listener(CHANNEL, self.on_notify)
+
+    async def run(self):
+        reconnect = False
+        while True:
+            try:
+                if not self.running:
+                    await self.listen()
+                    if reconnect:
+                        # NOTIFICATIONS SENT WHILE DISCONNECTED ARE LOST, RELOAD EVERY LAYER
+                        self.pending.update({layer: None for layer in TILE_LAYERS})
+                        self.wakeup.set()
+                    reconnect = True
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=RECONNECT_SECONDS)
+                except asyncio.TimeoutError:
+                    continue
+                await asyncio.sleep(COALESCE_MS / 1000)
+                self.wakeup.clear()
+                pending, self.pending = self.pending, {}
+                if pending:
+                    self.batches += 1
+                    try:
+                        await self.on_changes(pending)
+                    except Exception as exc:
+                        logger.warning("PUSHING CHANGES FAILED: %s", exc)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("CHANGE LISTENER FAILED: %s", exc)
+                await self.close()
+                await asyncio.sleep(RECONNECT_SECONDS)
+
+    def stats(self) -> dict:
+        return dict(
+            running = self.running,
+            received = self.received,
+            batches = self.batches,
+            pending = {layer: "bulk" if rows is None else len(rows) for layer, rows in self.pending.items()},
+        )
+
+change_listener = ChangeListener()
@@ -0,0 +1,248 @@
+from sqlmodel import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from scipy.sparse import csr_matrix, identity
+from scipy.sparse.csgraph import breadth_first_order
+from scipy.sparse.linalg import splu
+from datetime import datetime, timezone
+from ..db.sessesion import env_int
+from .topology import seeds_sql
+import numpy as np
+import re
+import time
+
+# TRANSFORMER LOAD AS A PERCENT OF ITS kva_rating AND THE LOAD POWER FACTOR IN PERCENT
+LOAD_PERCENT = env_int("LOADFLOWLOADPCT", 60)
+POWER_FACTOR = env_int("LOADFLOWPF", 90)
+MAX_ITERATIONS = env_int("LOADFLOWMAXITER", 30)
+# CONVERGED WHEN NO NODE VOLTAGE MOVES MORE THAN THIS (PER UNIT x 1e6)
+TOLERANCE = env_int("LOADFLOWTOLPPM", 10) / 1e6
+# SOURCE VOLTAGE WHEN substation.voltage_rating IS EMPTY, SAME DEFAULT AS /mapdata
+DEFAULT_KV = 13.2
+
+# POSITIVE SEQUENCE R, X IN OHM PER KM OF THE USUAL OVERHEAD ACSR SIZES, MATCHED IN conductor_type BY SIZE
+# conductor_type HOLDS NO IMPEDANCE, UNKNOWN SIZES USE 1/0
+CONDUCTOR_IMPEDANCE = {
+    "336": (0.19, 0.37),
+    "4/0": (0.27, 0.39),
+    "3/0": (0.35, 0.40),
+    "2/0": (0.44, 0.41),
+    "1/0": (0.55, 0.42),
+    "#2": (0.86, 0.44),
+    "#4": (1.35, 0.45),
+    "#6": (2.16, 0.47),
+}
+DEFAULT_IMPEDANCE = CONDUCTOR_IMPEDANCE["1/0"]
+
+substations_sql = text("""
+    SELECT id, COALESCE(voltage_rating::float8, :default_kv) FROM gis.substation WHERE isactive IS NOT false
+""").bindparams(default_kv=DEFAULT_KV)
+lines_sql = text("""
+    SELECT id, from_node, to_node, COALESCE(length_meters::float8, 0), conductor_type, phasing
+    FROM gis.primary_lines
+""")
+# TRANSFORMERS LOAD THE PRIMARY NODE THEY HANG FROM (from_primary_node, SET BY THE LINE BUSHING TRIGGER)
+loads_sql = text("""
+    SELECT dt.from_primary_node, sum(COALESCE(tt.kva_rating::float8, 0))
+    FROM gis.distribution_transformer AS dt
+    JOIN gis.transformer_type AS tt ON tt.name = dt.transformer_type
+    WHERE dt.from_primary_node IS NOT NULL
+    GROUP BY dt.from_primary_node
+""")
+clear_results_sql = text("DELETE FROM gis.load_flow")
+
+
+def conductor_impedance(conductor_type) -> tuple[float, float]:
+    name = (conductor_type or "").upper().replace("NO.", "#").replace("AWG", "")
+    for size, impedance in CONDUCTOR_IMPEDANCE.items():
+        if size in name:
+            return impedance
+    match = re.search(r"\b([246])\b", name)
+    return CONDUCTOR_IMPEDANCE[f"#{match.group(1)}"] if match else DEFAULT_IMPEDANCE
+
+def phase_count(phasing) -> int:
+    count = len(set((phasing or "").upper()) & set("ABC"))
+    return count or 3
+
+
+class RadialNetwork:
+    '''Every feeder of the franchise as one forest, solved together with a backward/forward sweep.
+    Vertices are the primary nodes in BFS order from the substations, the branch into vertex v is the line from its parent.
+    Per phase equivalent: the load of a vertex is spread on three phases, a line with fewer phases carries 3/n of it
+    per phase and a single phase line also drops on its neutral'''
+    def __init__(self, substations:dict[int, float], seeds:dict[str, int], lines:list, loads:dict[str, float]):
+        names = list(seeds)
+        index = {name: i for i, name in enumerate(names)}
+        for line in lines:
+            for name in line[1:3]:
+                if name is not None and name not in index:
+                    index[name] = len(names)
+                    names.append(name)
+        size = len(names)
+        root = size
+        # ONLY THE SEEDS OF ENERGIZED SUBSTATIONS FEED, THE REST OF THE NETWORK IS DEAD
+        roots = [index[name] for name, substation_id in seeds.items() if substation_id in substations]
+        # PARALLEL LINES BETWEEN THE SAME TWO NODES ARE ONE BRANCH
+        edges = {}
+        for position, (line_id, from_node, to_node, *_ ) in enumerate(lines):
+            if from_node in index and to_node in index:
+                edges.setdefault((index[from_node], index[to_node]), []).append(position)
+        src = np.array([edge[0] for edge in edges] + [root] * len(roots), dtype=np.int64)
+        dst = np.array([edge[1] for edge in edges] + roots, dtype=np.int64)
+        graph = csr_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(size + 1, size + 1))
+        order, predecessors = breadth_first_order(graph, root, directed=True, return_predecessors=True)
+        order = order[1:]
+        count = len(order)
+        # RENUMBER IN BFS ORDER, A PARENT ALWAYS COMES BEFORE ITS CHILDREN
+        position = np.full(size + 1, -1, dtype=np.int64)
+        position[order] = np.arange(count)
+        parents = predecessors[order]
+        is_root = parents == root
+        parent = np.where(is_root, -1, position[np.where(is_root, 0, parents)])
+
+        self.names = [names[vertex] for vertex in order]
+        self.parent = parent
+        self.is_root = is_root
+        seed_substation = {index[name]: seeds[name] for name in seeds}
+        # FEEDER OF EACH VERTEX, FROM ITS ROOT DOWN
+        self.substation = np.full(count, -1, dtype=np.int64)
+        for i in range(count):
+            self.substation[i] = seed_substation[order[i]] if is_root[i] else self.substation[parent[i]]
+        kv = np.array([substations.get(int(s), DEFAULT_KV) for s in self.substation], dtype=np.float64)
+        self.base_ln = kv * 1000 / np.sqrt(3)
+
+        # BRANCH INTO EACH NON ROOT VERTEX, impedance IS THE DROP PER AMPERE OF THE EQUIVALENT CURRENT INTO THE VERTEX
+        # AND loss_resistance THE LOSS PER AMPERE SQUARED, SUMMED OVER ITS PARALLEL LINES
+        impedance = np.zeros(count, dtype=np.complex128)
+        loss_resistance = np.zeros(count, dtype=np.float64)
+        # (VERTEX, LINE ID, SHARE OF THE VERTEX CURRENT, PER PHASE FACTOR, LOSS PER AMPERE SQUARED) OF EVERY LINE
+        self.branches = []
+        for i in np.nonzero(~is_root)[0]:
+            positions = edges[(order[parent[i]], order[i])]
+            drops, resistances, phase_factors, line_ids = [], [], [], []
+            for position in positions:
+                line = lines[position]
+                r, x = conductor_impedance(line[4])
+                phases = phase_count(line[5])
+                # PER PHASE CURRENT IS 3/n OF THE EQUIVALENT, A SINGLE PHASE LINE RETURNS ON ITS NEUTRAL
+                neutral = 2 if phases == 1 else 1
+                phase_factor = 3 / phases
+                drops.append(complex(r, x) * line[3] / 1000 * phase_factor * neutral)
+                resistances.append(r * line[3] / 1000 * phases * phase_factor ** 2 * neutral)
+                phase_factors.append(phase_factor)
+                line_ids.append(int(line[0]))
+            drops = np.array(drops)
+            # THE CURRENT SPLITS INVERSELY TO THE DROP IMPEDANCE, ZERO LENGTH LINES TAKE ALL OF IT
+            shorted = drops == 0
+            if shorted.any():
+                shares = shorted / shorted.sum()
+                impedance[i] = 0
+            else:
+                admittance = 1 / drops
+                shares = admittance / admittance.sum()
+                impedance[i] = 1 / admittance.sum()
+            for line_id, share, phase_factor, resistance in zip(line_ids, shares, phase_factors, resistances):
+                loss = resistance * abs(share) ** 2
+                loss_resistance[i] += loss
+                self.branches.append((i, line_id, share, phase_factor, loss))
+        self.impedance = impedance
+        self.loss_resistance = loss_resistance
+        self.parallel_lines = sum(len(positions) - 1 for positions in edges.values())
+
+        # CONSTANT POWER LOAD PER PHASE (VA)
+        angle = np.arccos(POWER_FACTOR / 100)
+        kva = np.array([loads.get(name, 0.0) for name in self.names], dtype=np.float64)
+        self.load_kva = kva * LOAD_PERCENT / 100
+        self.load = self.load_kva * 1000 / 3 * complex(np.cos(angle), np.sin(angle))
+
+        # C[parent, child] = 1, (I - C) IS UPPER TRIANGULAR IN BFS ORDER, FACTORED ONCE WITHOUT FILL
+        children = np.nonzero(~is_root)[0]
+        tree = csr_matrix((np.ones(len(children)), (parent[children], children)), shape=(count, count))
+        self.lu = splu((identity(count, format="csc") - tree).tocsc().astype(np.complex128), permc_spec="NATURAL") if count else None
+        self.count = count
+
+    def solve(self) -> dict:
+        '''Node voltages (V line to neutral) and the current into each vertex (A, per phase equivalent)'''
+        voltage = self.base_ln.astype(np.complex128)
+        if not self.count:
+            return dict(voltage=voltage, current=np.zeros(0, dtype=np.complex128), iterations=0, converged=True)
+        source = np.where(self.is_root, voltage, 0)
+        converged = False
+        for iteration in range(1, MAX_ITERATIONS + 1):
+            # BACKWARD, THE CURRENT INTO EACH VERTEX IS ITS OWN LOAD PLUS EVERYTHING BELOW IT: (I - C) i = load
+            injection = np.conj(self.load / voltage)
+            current = self.lu.solve(injection)
+            # FORWARD, V[v] = V[parent] - Z * I: (I - C)^T V = source - drop
+            drop = np.where(self.is_root, 0, self.impedance * current)
+            updated = self.lu.solve(source - drop, trans="T")
+            change = np.max(np.abs(updated - voltage) / self.base_ln)
+            voltage = updated
+            if change < TOLERANCE:
+                converged = True
+                break
+        return dict(voltage=voltage, current=current, iterations=iteration, converged=converged)
+
+    def results(self, solution:dict) -> tuple[list[tuple], list[dict]]:
+        '''Rows of gis.load_flow and the summary of each feeder'''
+        voltage_pu = np.abs(solution["voltage"]) / self.base_ln
+        voltage_kv = np.abs(solution["voltage"]) * np.sqrt(3) / 1000
+        current = np.abs(solution["current"]) if self.count else np.zeros(0)
+        loss_kw = self.loss_resistance * current ** 2 / 1000
+        solved_at = datetime.now(timezone.utc)
+        # ONE ROW PER LINE, PARALLEL LINES REPORT THEIR SHARE OF THE CURRENT AND OF THE LOSSES
+        rows = [
+            (line_id, int(self.substation[i]), self.names[i], float(voltage_pu[i]), float(voltage_kv[i]),
+             float(current[i] * abs(share) * phase_factor), float(loss * current[i] ** 2 / 1000), float(self.load_kva[i]), solved_at)
+            for i, line_id, share, phase_factor, loss in self.branches
+        ]
+        feeders = []
+        for substation_id in np.unique(self.substation):
+            members = self.substation == substation_id
+            lowest = np.argmin(np.where(members, voltage_pu, np.inf))
+            feeders.append(dict(
+                substation_id = int(substation_id),
+                nodes = int(members.sum()),
+                load_kva = round(float(self.load_kva[members].sum()), 2),
+                loss_kw = round(float(loss_kw[members].sum()), 3),
+                min_voltage_pu = round(float(voltage_pu[lowest]), 4),
+                min_voltage_node = self.names[lowest],
+            ))
+        return rows, feeders
+
+
+async def load_network(session:AsyncSession) -> RadialNetwork:
+    return RadialNetwork(
+        substations = {row[0]: row[1] for row in (await session.exec(substations_sql)).all()},
+        seeds = {name: substation_id for name, substation_id in (await session.exec(seeds_sql)).all()},
+        lines = (await session.exec(lines_sql)).all(),
+        loads = {name: kva for name, kva in (await session.exec(loads_sql)).all()},
+    )
+
+async def run_load_flow(session:AsyncSession) -> dict:
+    '''Solve every feeder and replace the rows of gis.load_flow with the result'''
+    started = time.perf_counter()
+    network = await load_network(session)
+    loaded = time.perf_counter()
+    solution = network.solve()
+    rows, feeders = network.results(solution)
+    solved = time.perf_counter()
+    await session.exec(clear_results_sql)
+    if rows:
+        connection = await session.connection()
+        raw = await connection.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            "load_flow", schema_name="gis", records=rows,
+            columns=["primary_line_id", "substation_id", "to_node", "voltage_pu", "voltage_kv",
+                     "current_a", "loss_kw", "load_kva", "solved_at"])
+    await session.commit()
+    written = time.perf_counter()
+    return dict(
+        nodes = network.count,
+        lines = len(rows),
+        parallel_lines = network.parallel_lines,
+        iterations = solution["iterations"],
+        converged = solution["converged"],
+        feeders = feeders,
+        load_ms = round((loaded - started) * 1000, 1),
+        solve_ms = round((solved - loaded) * 1000, 1),
+        write_ms = round((written - solved) * 1000, 1),
+    )
@@ -0,0 +1,75 @@
+from sqlmodel import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..db.sessesion import PUBLISHED_LAYERS
+from ..db.supa_model import FEATURE_PROPERTIES
+from .viewport import Viewport, layer_visible
+
+# EACH LAYER IS BUILT AS JSON TEXT INSIDE POSTGIS, row_to_json KEEPS THE COLUMN ORDER AND WRITES
+# COMPACT JSON SO THE OUTPUT MATCHES WHAT FASTAPI PRODUCED FROM THE geojson Feature OBJECTS
+MAPDATA_LAYERS = [
+    dict(
+        name = "substation",
+        layer = "substation",
+        table = "gis.substation",
+        properties = FEATURE_PROPERTIES["substation"],
+    ),
+    dict(
+        name = "primary_lines",
+        layer = "primary_lines",
+        table = "gis.primary_lines",
+        properties = FEATURE_PROPERTIES["primary_lines"],
+    ),
+    dict(
+        # KEY SPELLING IS PART OF THE API THE FRONTEND READS
+        name = "distribtion_transformer",
+        layer = "distribution_transformer",
+        table = "gis.distribution_transformer",
+        properties = FEATURE_PROPERTIES["distribution_transformer"],
+    ),
+]
+
+BBOX_SQL = """
+    WHERE t.geom && ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326)
+    AND ST_Intersects(t.geom, ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326))"""
+
+def feature_columns(conf:dict) -> str:
+    '''(type, id, geometry, properties) of the row t, row_to_json of these is one GeoJSON Feature
+    coordinates are rounded to 6 decimals, the precision geojson.loads writes'''
+    return f"""
+                'Feature' AS type,
+                t.id,
+                ST_AsGeoJSON(t.geom, 6)::json AS geometry,
+                (SELECT row_to_json(p) FROM (SELECT {conf["properties"]}) AS p) AS properties"""
+
+def feature_json_sql(conf:dict) -> tuple[str, str]:
+    '''(expression, join) giving the Feature text of the row t
+    a published layer (PUBLISHEDLAYERS=true) reads the feature_json its triggers keep, nothing is rendered per request'''
+    if PUBLISHED_LAYERS and conf["layer"] in FEATURE_PROPERTIES:
+        return "t.feature_json", ""
+    return "row_to_json(f)::text", f"CROSS JOIN LATERAL (SELECT {feature_columns(conf)}) AS f"
+
+def layer_sql(conf:dict, viewport:Viewport):
+    '''One row holding the comma separated Feature objects of the layer'''
+    feature, join = feature_json_sql(conf)
+    stmt = text(f"""
+        SELECT COALESCE(string_agg({feature}, ',' ORDER BY t.id), '')
+        FROM {conf["table"]} AS t
+        {join}
+        {BBOX_SQL if viewport.bbox is not None else ""}
+    """)
+    if viewport.bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = viewport.bbox
+        stmt = stmt.bindparams(min_lon=min_lon, min_lat=min_lat, max_lon=max_lon, max_lat=max_lat)
+    return stmt
+
+async def build_mapdata(session:AsyncSession, viewport:Viewport = Viewport()) -> bytes:
+    '''{"type":"FeatureCollection","features":[{"substation":[..]},{"primary_lines":[..]},{"distribtion_transformer":[..]}]}
+    built whole, one query per layer, the snapshot cache keeps the bytes and /mapdata sends them in one response'''
+    parts = []
+    for conf in MAPDATA_LAYERS:
+        features = ""
+        if layer_visible(viewport, conf["layer"]):
+            result = await session.exec(layer_sql(conf, viewport))
+            features = result.scalar()
+        parts.append(f'{{"{conf["name"]}":[{features}]}}')
+    return f'{{"type":"FeatureCollection","features":[{",".join(parts)}]}}'.encode()
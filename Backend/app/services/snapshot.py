@@ -0,0 +1,68 @@
+from cachetools import LRUCache
+from typing import Awaitable, Callable, Hashable, Optional
+from ..db.sessesion import env_int
+import asyncio
+import hashlib
+
+
+class SnapshotCache:
+    '''Serialized map payloads keyed by (data version, viewport).
+    Every write bumps the version, concurrent misses on the same key share one build'''
+    def __init__(self, maxsize:int):
+        self.version = 0
+        # ENTRIES ARE (ETAG, DATA), SIZED BY THE PAYLOAD
+        self.snapshots = LRUCache(maxsize=maxsize, getsizeof=lambda entry: max(len(entry[1]), 1))
+        self.locks: dict[tuple, asyncio.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def etag(data:bytes) -> str:
+        '''Content hash, so every worker and every restart issues the same tag for the same payload'''
+        return f'"{hashlib.blake2b(data, digest_size=16).hexdigest()}"'
+
+    def invalidate(self):
+        self.version += 1
+        self.snapshots.clear()
+
+    async def get(self, key:Hashable, build:Callable[[], Awaitable[bytes]]) -> tuple[str, bytes]:
+        version = self.version
+        cache_key = (version, key)
+        entry = self.snapshots.get(cache_key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        lock = self.locks.setdefault(cache_key, asyncio.Lock())
+        try:
+            async with lock:
+                entry = self.snapshots.get(cache_key)
+                if entry is None:
+                    self.misses += 1
+                    data = await build()
+                    entry = (self.etag(data), data)
+                    if version == self.version and len(data) <= self.snapshots.maxsize:
+                        self.snapshots[cache_key] = entry
+                else:
+                    self.hits += 1
+        finally:
+            self.locks.pop(cache_key, None)
+        return entry
+
+    def stats(self) -> dict:
+        return dict(
+            version = self.version,
+            snapshots = len(self.snapshots),
+            bytes = self.snapshots.currsize,
+            maxbytes = self.snapshots.maxsize,
+            hits = self.hits,
+            misses = self.misses,
+        )
+
+snapshot_cache = SnapshotCache(maxsize=env_int("SNAPSHOTCACHEBYTES", 128 * 1024 * 1024))
+
+
+def etag_matches(if_none_match:Optional[str], etag:str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
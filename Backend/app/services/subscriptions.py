@@ -0,0 +1,46 @@
+from typing import NamedTuple, Optional, Union
+
+# LAYERS A WEBSOCKET CLIENT CAN SUBSCRIBE TO AND THE REGION ATTRIBUTES IT CAN FILTER BY
+SUBSCRIBABLE_LAYERS = ("substation", "primary_lines", "distribution_transformer", "nodes")
+REGION_KEYS = ("municipality", "village", "substation_id")
+
+Values = Optional[Union[str, int, list]]
+
+
+class Subscription(NamedTuple):
+    '''What a client wants pushed, an empty set means no filter on that part.
+    A change is sent when its layer is subscribed AND it is in any subscribed region'''
+    layers: frozenset = frozenset()
+    municipality: frozenset = frozenset()
+    village: frozenset = frozenset()
+    substation_id: frozenset = frozenset()
+
+    def regions(self) -> list[tuple]:
+        return [(key, value) for key in REGION_KEYS for value in getattr(self, key)]
+
+    def keys(self) -> list[tuple]:
+        '''Index keys of the subscription, ("layer", name) and (region, value)'''
+        return [("layer", layer) for layer in self.layers] + self.regions()
+
+def as_values(values:Values) -> list:
+    if values is None or values == "":
+        return []
+    if isinstance(values, (str, int)):
+        values = str(values).split(",")
+    return [str(val).strip() for val in values if str(val).strip()]
+
+def parse_subscription(layers:Values = None,
+                       municipality:Values = None,
+                       village:Values = None,
+                       substation_id:Values = None) -> Subscription:
+    '''Accepts comma separated strings (query parameters) or lists (json messages), raises ValueError'''
+    layer_names = as_values(layers)
+    unknown = [name for name in layer_names if name not in SUBSCRIBABLE_LAYERS]
+    if unknown:
+        raise ValueError(f"unknown layers {', '.join(unknown)}")
+    return Subscription(
+        layers = frozenset(layer_names),
+        municipality = frozenset(as_values(municipality)),
+        village = frozenset(as_values(village)),
+        substation_id = frozenset(int(val) for val in as_values(substation_id)),
+    )
@@ -0,0 +1,47 @@
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import AsyncIterator, Awaitable, Callable
+from ..db.sessesion import env_int
+import asyncio
+
+# ROWS FETCHED FROM THE LOCAL DATABASE PER CHUNK, ALSO THE ROWS OF ONE MULTI VALUES UPSERT
+# 1000 ROWS OF ~10 COLUMNS STAY FAR BELOW THE 32767 BIND PARAMETERS OF ONE STATEMENT
+SYNC_CHUNK = env_int("SYNCCHUNKSIZE", 1000)
+
+
+async def stream_rows(session:AsyncSession, stmt, size:int = SYNC_CHUNK) -> AsyncIterator[list]:
+    '''Rows of the statement in chunks of size, read through a server side cursor'''
+    result = await session.stream(stmt)
+    async for rows in result.partitions(size):
+        yield rows
+
+async def pipeline(chunks:AsyncIterator[list], write:Callable[[list], Awaitable[None]]) -> int:
+    '''Write each chunk while the next one is fetched, at most two chunks are in memory. Returns the rows written'''
+    iterator = chunks.__aiter__()
+    fetch = asyncio.ensure_future(iterator.__anext__())
+    written = 0
+    try:
+        while True:
+            try:
+                chunk = await fetch
+            except StopAsyncIteration:
+                return written
+            fetch = asyncio.ensure_future(iterator.__anext__())
+            await write(chunk)
+            written += len(chunk)
+    finally:
+        if not fetch.done():
+            fetch.cancel()
+            try:
+                await fetch
+            except (asyncio.CancelledError, Exception):
+                pass
+
+async def with_results(chunks:AsyncIterator[list], work:Callable[[list], Awaitable[list]]) -> AsyncIterator[list]:
+    '''(row, result) pairs of each chunk, inside pipeline() the work of the next chunk overlaps the write of the current one'''
+    async for rows in chunks:
+        yield list(zip(rows, await work(rows)))
+
+def unique_by(values:list[dict], key:str) -> list[dict]:
+    '''Last row of each key, ON CONFLICT DO UPDATE cannot touch the same row twice in one statement.
+    Rows without a key never conflict and are all kept'''
+    return list({val[key] if val[key] is not None else id(val): val for val in values}.values())
@@ -0,0 +1,211 @@
+from sqlmodel import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from cachetools import LRUCache
+from typing import Optional
+from ..db.sessesion import env_int
+import math
+
+# MVT LAYERS, EVERY PROPERTY IS CAST TO A TYPE ST_AsMVT CAN ENCODE
+TILE_LAYERS = dict(
+    substation = dict(
+        table = "gis.substation",
+        columns = "t.id, t.generator_name AS substation_name, t.description, t.voltage_rating::float8 AS voltage_rating, t.isactive, t.village, t.municipality, t.image",
+    ),
+    nodes = dict(
+        table = "gis.nodes",
+        columns = "t.id, t.node_name, t.description, t.substation_id, t.nominal_voltage_kv::float8 AS nominal_voltage_kv, t.isactive",
+    ),
+    primary_lines = dict(
+        table = "gis.primary_lines",
+        columns = "t.id, t.line_id AS primary_line_id, t.from_node, t.to_node, t.phasing, t.substation_id, t.isactive",
+    ),
+    distribution_transformer = dict(
+        table = "gis.distribution_transformer",
+        columns = "t.id, t.transformer_id, t.description, t.transformer_type AS type, t.substation_id, t.village, t.municipality, t.image, t.isactive",
+    ),
+    line_bushing = dict(
+        table = "gis.line_bushing",
+        columns = "t.id, t.line_bushing_name, t.from_node_id, t.to_node_id, t.description, t.phasing, t.substation_id",
+    ),
+)
+
+MAX_ZOOM = 22
+
+def tile_sql(layer:str):
+    conf = TILE_LAYERS[layer]
+    return text(f"""
+        WITH bounds AS (
+            SELECT ST_TileEnvelope(:z, :x, :y) AS geom
+        ),
+        mvtgeom AS (
+            SELECT ST_AsMVTGeom(ST_Transform(t.geom, 3857), bounds.geom) AS geom, {conf["columns"]}
+            FROM {conf["table"]} AS t, bounds
+            WHERE t.geom && ST_Transform(bounds.geom, 4326)
+        )
+        SELECT ST_AsMVT(mvtgeom.*, '{layer}', 4096, 'geom', 'id') FROM mvtgeom
+    """)
+
+def valid_tile(z:int, x:int, y:int) -> bool:
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+def tile_bounds(z:int, x:int, y:int) -> tuple[float, float, float, float]:
+    '''LON/LAT bounds (min_lon, min_lat, max_lon, max_lat) of a web mercator tile'''
+    n = 2 ** z
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    return (x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y))
+
+def intersects(a:tuple, b:tuple) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+# WEB MERCATOR LATITUDE LIMIT
+MAX_LAT = 85.0511287798
+
+def tile_range(z:int, bounds:tuple[float, float, float, float]) -> tuple[int, int, int, int]:
+    '''(min_x, min_y, max_x, max_y) of the tiles of zoom z over the LON/LAT bounds, one tile wider on every side
+    for the 256/4096 buffer ST_AsMVTGeom draws features into'''
+    n = 2 ** z
+    def column(lon):
+        return math.floor((lon + 180.0) / 360.0 * n)
+    def row(lat):
+        lat = math.radians(min(max(lat, -MAX_LAT), MAX_LAT))
+        return math.floor((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)
+    return (max(column(bounds[0]) - 1, 0), max(row(bounds[3]) - 1, 0),
+            min(column(bounds[2]) + 1, n - 1), min(row(bounds[1]) + 1, n - 1))
+
+
+class TileLRU(LRUCache):
+    '''LRUCache telling the TileCache which keys it evicts'''
+    def __init__(self, maxsize:int, getsizeof, evicted):
+        super().__init__(maxsize=maxsize, getsizeof=getsizeof)
+        self.evicted = evicted
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.evicted(key)
+        return key, value
+
+
+class TileCache:
+    '''LRU tile cache bounded by total bytes, keyed by (layer, version, z, x, y).
+    The cached (x, y) are indexed by (layer, version, z) so a changed feature only looks at the tiles it covers'''
+    def __init__(self, maxsize:int):
+        self.tiles = TileLRU(maxsize, lambda tile: max(len(tile), 1), self.unindex)
+        self.index: dict[tuple, set[tuple[int, int]]] = {}
+        self.versions: dict[str, int] = {layer: 0 for layer in TILE_LAYERS}
+        # KEYS BEING QUERIED -> NUMBER OF QUERIES, stale WHEN THEIR BOUNDS CHANGED DURING THE QUERY
+        self.inflight: dict[tuple, int] = {}
+        self.stale: set[tuple] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, layer:str, z:int, x:int, y:int) -> tuple:
+        return (layer, self.versions[layer], z, x, y)
+
+    def get(self, key:tuple) -> Optional[bytes]:
+        tile = self.tiles.get(key)
+        if tile is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return tile
+
+    def begin(self, key:tuple):
+        '''Call before querying the tile of key'''
+        self.inflight[key] = self.inflight.get(key, 0) + 1
+
+    def finish(self, key:tuple, tile:Optional[bytes]):
+        '''Call after the query, the tile is cached under the key taken before it
+        unless its layer or its bounds changed in the meantime'''
+        if tile is not None and key not in self.stale and key[1] == self.versions[key[0]]:
+            self.tiles[key] = tile
+            self.index.setdefault(key[:3], set()).add(key[3:])
+        self.inflight[key] -= 1
+        if not self.inflight[key]:
+            del self.inflight[key]
+            self.stale.discard(key)
+
+    def unindex(self, key:tuple):
+        cached = self.index.get(key[:3])
+        if cached is not None:
+            cached.discard(key[3:])
+            if not cached:
+                del self.index[key[:3]]
+
+    def invalidate_layer(self, *layers:str):
+        # BUMPING THE VERSION ORPHANS EVERY CACHED TILE OF THE LAYER, THE LRU EVICTS THEM
+        for layer in layers:
+            self.versions[layer] += 1
+
+    def invalidate_bounds(self, layer:str, bounds:tuple[float, float, float, float]):
+        '''Drop only the cached tiles of the layer that overlap the feature bounds'''
+        version = self.versions[layer]
+        for z in range(MAX_ZOOM + 1):
+            cached = self.index.get((layer, version, z))
+            if not cached:
+                continue
+            min_x, min_y, max_x, max_y = tile_range(z, bounds)
+            if (max_x - min_x + 1) * (max_y - min_y + 1) < len(cached):
+                stale = [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1) if (x, y) in cached]
+            else:
+                stale = [(x, y) for x, y in cached if min_x <= x <= max_x and min_y <= y <= max_y]
+            for x, y in stale:
+                self.tiles.pop((layer, version, z, x, y), None)
+                self.unindex((layer, version, z, x, y))
+        for key in self.inflight:
+            if key[0] == layer:
+                min_x, min_y, max_x, max_y = tile_range(key[2], bounds)
+                if min_x <= key[3] <= max_x and min_y <= key[4] <= max_y:
+                    self.stale.add(key)
+
+    def stats(self) -> dict:
+        return dict(
+            tiles = len(self.tiles),
+            bytes = self.tiles.currsize,
+            maxbytes = self.tiles.maxsize,
+            hits = self.hits,
+            misses = self.misses,
+            inflight = len(self.inflight),
+            versions = dict(self.versions),
+        )
+
+tile_cache = TileCache(maxsize=env_int("TILECACHEBYTES", 64 * 1024 * 1024))
+
+
+async def get_tile(session:AsyncSession, layer:str, z:int, x:int, y:int) -> bytes:
+    # THE KEY IS TAKEN BEFORE THE QUERY, A WRITE DURING THE QUERY CANNOT LEAVE ITS OLD TILE CACHED AS CURRENT
+    key = tile_cache.key(layer, z, x, y)
+    tile = tile_cache.get(key)
+    if tile is None:
+        tile_cache.begin(key)
+        try:
+            result = await session.exec(tile_sql(layer).bindparams(z=z, x=x, y=y))
+            tile = bytes(result.scalar() or b"")
+        finally:
+            tile_cache.finish(key, tile)
+    return tile
+
+# EXTENT OF EVERY FEATURE OF A SUBSTATION, PER LAYER
+substation_extent_sql = text("""
+    SELECT 'substation' AS layer, ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+    FROM (SELECT ST_Extent(geom) AS e FROM gis.substation WHERE id = :substation_id) AS s
+    UNION ALL
+    SELECT 'nodes', ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+    FROM (SELECT ST_Extent(geom) AS e FROM gis.nodes WHERE substation_id = :substation_id) AS n
+    UNION ALL
+    SELECT 'primary_lines', ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+    FROM (SELECT ST_Extent(geom) AS e FROM gis.primary_lines WHERE substation_id = :substation_id) AS pl
+    UNION ALL
+    SELECT 'distribution_transformer', ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+    FROM (SELECT ST_Extent(geom) AS e FROM gis.distribution_transformer WHERE substation_id = :substation_id) AS dt
+    UNION ALL
+    SELECT 'line_bushing', ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+    FROM (SELECT ST_Extent(geom) AS e FROM gis.line_bushing WHERE substation_id = :substation_id) AS lb
+""")
+
+async def invalidate_substation_tiles(session:AsyncSession, substation_id:int):
+    '''A substation toggle changes the substation and everything node_is_active() cascades to'''
+    result = await session.exec(substation_extent_sql.bindparams(substation_id=substation_id))
+    for layer, xmin, ymin, xmax, ymax in result:
+        if xmin is not None:
+            tile_cache.invalidate_bounds(layer, (xmin, ymin, xmax, ymax))
@@ -0,0 +1,154 @@
+from sqlmodel import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order
+from typing import Optional
+import numpy as np
+import time
+
+# PRIMARY NODES, SEEDS ARE THE PRIMARY NODES ON A SUBSTATION (SAME RULE AS gis.update_nodes_substation_id)
+nodes_sql = text("""
+    SELECT n.id, n.node_name, n.substation_id
+    FROM gis.nodes AS n
+    WHERE n.description ILIKE '%primary%' AND n.node_name IS NOT NULL
+""")
+seeds_sql = text("""
+    SELECT DISTINCT ON (n.node_name) n.node_name, s.id
+    FROM gis.nodes AS n
+    JOIN gis.substation AS s ON ST_Intersects(s.geom, n.geom)
+    WHERE n.description ILIKE '%primary%' AND n.node_name IS NOT NULL
+    ORDER BY n.node_name, s.id
+""")
+lines_sql = text("SELECT id, from_node, to_node FROM gis.primary_lines")
+bushings_sql = text("""
+    SELECT id, primary_line_id, from_node_id, to_node_id, description
+    FROM gis.line_bushing
+""")
+transformers_sql = text("SELECT id, transformer_id FROM gis.distribution_transformer")
+
+
+class Topology:
+    '''Primary network as CSR arrays, node index i <-> node_names[i], edges from_node -> to_node of every line'''
+    def __init__(self, node_names:list[str], seeds:dict[str, int], lines:list[tuple]):
+        self.node_names = node_names
+        self.index = {name: i for i, name in enumerate(node_names)}
+        self.seeds = seeds
+        # LINE ARRAYS, -1 WHEN THE END HAS NO PRIMARY NODE
+        self.line_ids = np.array([line[0] for line in lines], dtype=np.int64)
+        self.line_from = np.array([self.index.get(line[1], -1) for line in lines], dtype=np.int64)
+        self.line_to = np.array([self.index.get(line[2], -1) for line in lines], dtype=np.int64)
+        connected = (self.line_from >= 0) & (self.line_to >= 0)
+        self.src = self.line_from[connected]
+        self.dst = self.line_to[connected]
+
+    def trace(self) -> np.ndarray:
+        '''Substation id of every node, -1 if no substation reaches it.
+        One multi source BFS, a virtual root points at every seed so each node takes the substation it is fewest hops from'''
+        size = len(self.node_names)
+        root = size
+        seeds = np.array([self.index[name] for name in self.seeds], dtype=np.int64)
+        src = np.concatenate([self.src, np.full(len(seeds), root)])
+        dst = np.concatenate([self.dst, seeds])
+        graph = csr_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(size + 1, size + 1))
+        labels = np.full(size + 1, -1, dtype=np.int64)
+        for name, substation_id in self.seeds.items():
+            labels[self.index[name]] = substation_id
+        order, predecessors = breadth_first_order(graph, root, directed=True, return_predecessors=True)
+        for node in order[1:]:
+            if labels[node] == -1:
+                labels[node] = labels[predecessors[node]]
+        return labels[:size]
+
+    def line_substations(self, labels:np.ndarray) -> np.ndarray:
+        '''A line is fed from its from_node'''
+        return np.where(self.line_from >= 0, labels[np.maximum(self.line_from, 0)], -1)
+
+
+async def load_topology(session:AsyncSession) -> tuple[Topology, list, list]:
+    nodes = (await session.exec(nodes_sql)).all()
+    seeds = {name: substation_id for name, substation_id in (await session.exec(seeds_sql)).all()}
+    lines = (await session.exec(lines_sql)).all()
+    names = [node[1] for node in nodes]
+    known = set(names)
+    # LINE ENDS WITHOUT A PRIMARY NODE ROW STILL CONNECT THE LINES THROUGH THEM
+    for line in lines:
+        for name in line[1:3]:
+            if name is not None and name not in known:
+                known.add(name)
+                names.append(name)
+    return Topology(names, seeds, lines), nodes, lines
+
+
+def as_id(value:int) -> Optional[int]:
+    return None if value < 0 else int(value)
+
+# ONE STATEMENT PER TABLE, ONLY ROWS WHOSE substation_id ACTUALLY CHANGES ARE WRITTEN (AND FIRE THEIR TRIGGERS)
+def bulk_update_sql(table:str):
+    return text(f"""
+        WITH updated AS (
+            UPDATE {table} AS t
+            SET substation_id = v.substation_id
+            FROM unnest(CAST(:ids AS int[]), CAST(:substations AS int[])) AS v(id, substation_id)
+            WHERE t.id = v.id AND t.substation_id IS DISTINCT FROM v.substation_id
+            RETURNING 1
+        )
+        SELECT count(*) FROM updated
+    """)
+
+async def bulk_update(session:AsyncSession, table:str, values:dict[int, Optional[int]]) -> int:
+    '''values is row id -> substation_id, rows the trace does not reach (None) keep the substation_id they have'''
+    values = {row_id: substation_id for row_id, substation_id in values.items() if substation_id is not None}
+    if not values:
+        return 0
+    result = await session.exec(bulk_update_sql(table).bindparams(
+        ids=list(values), substations=list(values.values())))
+    return result.scalar()
+
+async def trace_substations(session:AsyncSession, commit:bool = True) -> dict:
+    '''Assign substation_id to primary nodes, primary lines, line bushings and transformers from one graph trace'''
+    started = time.perf_counter()
+    topology, nodes, lines = await load_topology(session)
+    bushings = (await session.exec(bushings_sql)).all()
+    transformers = (await session.exec(transformers_sql)).all()
+    loaded = time.perf_counter()
+
+    labels = topology.trace()
+    line_labels = topology.line_substations(labels)
+    node_values = {node[0]: as_id(labels[topology.index[node[1]]]) for node in nodes}
+    line_values = {int(line_id): as_id(label) for line_id, label in zip(topology.line_ids, line_labels)}
+    # PRIMARY BUSHINGS HANG FROM A LINE AND FEED A TRANSFORMER, SECONDARY BUSHINGS LEAVE A TRANSFORMER
+    bushing_values, transformer_substation = {}, {}
+    for bushing_id, primary_line_id, from_node_id, to_node_id, description in bushings:
+        if description and "PRIMARY" in description.upper():
+            substation_id = line_values.get(primary_line_id)
+            bushing_values[bushing_id] = substation_id
+            if to_node_id is not None and substation_id is not None:
+                transformer_substation.setdefault(to_node_id, substation_id)
+    for bushing_id, primary_line_id, from_node_id, to_node_id, description in bushings:
+        if description and "SECONDARY" in description.upper():
+            bushing_values[bushing_id] = transformer_substation.get(from_node_id)
+    transformer_values = {row[0]: transformer_substation.get(row[1]) for row in transformers}
+    traced = time.perf_counter()
+
+    # THE SPATIAL BEFORE TRIGGERS ARE UPDATE OF geom AND DO NOT FIRE, THE TRACED VALUES ARE KEPT AS WRITTEN
+    updated = dict(
+        nodes = await bulk_update(session, "gis.nodes", node_values),
+        primary_lines = await bulk_update(session, "gis.primary_lines", line_values),
+        line_bushing = await bulk_update(session, "gis.line_bushing", bushing_values),
+        distribution_transformer = await bulk_update(session, "gis.distribution_transformer", transformer_values),
+    )
+    # THE BULK LOAD RUNS THE TRACE INSIDE ITS OWN TRANSACTION
+    if commit:
+        await session.commit()
+    written = time.perf_counter()
+    return dict(
+        nodes = len(topology.node_names),
+        lines = len(lines),
+        substations = len(set(topology.seeds.values())),
+        energized_nodes = int((labels >= 0).sum()),
+        energized_lines = int((line_labels >= 0).sum()),
+        updated = updated,
+        load_ms = round((loaded - started) * 1000, 1),
+        trace_ms = round((traced - loaded) * 1000, 1),
+        write_ms = round((written - traced) * 1000, 1),
+    )
@@ -0,0 +1,34 @@
+from typing import NamedTuple, Optional
+
+# LOWEST ZOOM EACH LAYER IS SENT AT, ONLY APPLIED WHEN THE CLIENT SENDS A ZOOM
+LAYER_MIN_ZOOM = dict(
+    substation = 0,
+    primary_lines = 0,
+    distribution_transformer = 13,
+)
+
+class Viewport(NamedTuple):
+    '''Map viewport of a client, bbox is (min_lon, min_lat, max_lon, max_lat) in EPSG:4326'''
+    bbox: Optional[tuple[float, float, float, float]] = None
+    zoom: Optional[int] = None
+
+def parse_viewport(bbox:Optional[str] = None, zoom:Optional[int] = None) -> Viewport:
+    '''Parse the "min_lon,min_lat,max_lon,max_lat" query value, raises ValueError if it is malformed'''
+    # A WEBSOCKET MESSAGE CAN SEND THE ZOOM AS A STRING, layer_visible COMPARES IT AS AN int
+    zoom = int(zoom) if zoom is not None else None
+    if zoom is not None and not 0 <= zoom <= 24:
+        raise ValueError("zoom must be between 0 and 24")
+    if not bbox:
+        return Viewport(None, zoom)
+    parts = [float(val) for val in bbox.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    min_lon, min_lat, max_lon, max_lat = parts
+    if min_lon >= max_lon or min_lat >= max_lat:
+        raise ValueError("bbox min values must be lower than max values")
+    return Viewport((min_lon, min_lat, max_lon, max_lat), zoom)
+
+def layer_visible(viewport:Viewport, layer:str) -> bool:
+    if viewport.zoom is None:
+        return True
+    return viewport.zoom >= LAYER_MIN_ZOOM.get(layer, 0)
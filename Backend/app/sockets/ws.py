@@ -1,29 +1,203 @@
 from fastapi import WebSocket, WebSocketDisconnect
 from geojson import FeatureCollection
+from typing import Optional
+from ..services.viewport import Viewport
+from ..services.deltas import RESYNC_REQUIRED, Change, in_viewport, delta_message, snapshot_message
+from ..services.subscriptions import Subscription, REGION_KEYS
+from ..db.sessesion import env_int
+import asyncio
+import json
+
+# PER CLIENT SEND QUEUE LENGTH AND SECONDS A SINGLE SEND MAY TAKE BEFORE THE CLIENT IS DROPPED
+QUEUE_SIZE = env_int("WSQUEUESIZE", 32)
+SEND_TIMEOUT = env_int("WSSENDTIMEOUT", 10)
+
+
+class Client:
+    '''One websocket with its own bounded queue, drained by its own writer task'''
+    def __init__(self, websocket: WebSocket, viewport: Viewport, delta: bool, subscription: Subscription):
+        self.websocket = websocket
+        self.viewport = viewport
+        self.delta = delta
+        self.subscription = subscription
+        # LAST DELTA seq SENT TO THIS CLIENT
+        self.seq = 0
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.sent = 0
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.clients: dict[WebSocket, Client] = {}
+        # SUBSCRIPTION INDEX, ("layer", name) OR (region, value) -> CONNECTIONS
+        # CONNECTIONS WITHOUT A LAYER OR REGION FILTER ARE KEPT IN any_layer / any_region
+        self.index: dict[tuple, set[WebSocket]] = {}
+        self.any_layer: set[WebSocket] = set()
+        self.any_region: set[WebSocket] = set()
+        self.dropped = 0
+        self.slow_disconnects = 0
+
+    @property
+    def active_connections(self) -> list[WebSocket]:
+        return list(self.clients)
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, viewport: Viewport = Viewport(), delta: bool = False,
+                      subscription: Subscription = Subscription()):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = Client(websocket, viewport, delta, subscription)
+        self.clients[websocket] = client
+        self.add_to_index(client)
+        client.task = asyncio.create_task(self.writer(client))
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        client = self.clients.pop(websocket, None)
+        if client is None:
+            return
+        self.remove_from_index(client)
+        if client.task and client.task is not asyncio.current_task():
+            client.task.cancel()
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
-    
-    async def broadcast_json(self, data):
-        disconnected = []
-        for connection in self.active_connections:
+    def add_to_index(self, client: Client):
+        for key in client.subscription.keys():
+            self.index.setdefault(key, set()).add(client.websocket)
+        if not client.subscription.layers:
+            self.any_layer.add(client.websocket)
+        if not client.subscription.regions():
+            self.any_region.add(client.websocket)
+
+    def remove_from_index(self, client: Client):
+        for key in client.subscription.keys():
+            connections = self.index.get(key)
+            if connections is not None:
+                connections.discard(client.websocket)
+                if not connections:
+                    del self.index[key]
+        self.any_layer.discard(client.websocket)
+        self.any_region.discard(client.websocket)
+
+    def subscribe(self, websocket: WebSocket, subscription: Subscription):
+        client = self.clients.get(websocket)
+        if client is None:
+            return
+        self.remove_from_index(client)
+        client.subscription = subscription
+        self.add_to_index(client)
+
+    def recipients(self, change: Change) -> set[WebSocket]:
+        '''Connections interested in the change, found through the index instead of scanning every client'''
+        layer_subscribers = self.index.get(("layer", change.layer), set())
+        if change.tags is None:
+            # REGION OF A DELETED ROW IS UNKNOWN, ONLY LAYER AND BBOX CAN ROUTE IT
+            candidates = self.any_layer | layer_subscribers
+        else:
+            candidates = set(self.any_region)
+            for key in REGION_KEYS:
+                value = change.tags.get(key)
+                if value is not None:
+                    candidates |= self.index.get((key, str(value) if key != "substation_id" else value), set())
+            candidates = {ws for ws in candidates if ws in self.any_layer or ws in layer_subscribers}
+        return {ws for ws in candidates if in_viewport(change, self.clients[ws].viewport)}
+
+    def route(self, changes: list[Change]) -> dict[WebSocket, list[Change]]:
+        routed: dict[WebSocket, list[Change]] = {}
+        for change in changes:
+            for websocket in self.recipients(change):
+                routed.setdefault(websocket, []).append(change)
+        return routed
+
+    def send_delta(self, websocket: WebSocket, version: int, layers: str):
+        client = self.clients.get(websocket)
+        if client is not None:
+            client.seq += 1
+            self.send(websocket, delta_message(client.seq, version, layers))
+
+    def send_snapshot(self, websocket: WebSocket, version: int, data: bytes):
+        client = self.clients.get(websocket)
+        if client is not None:
+            self.send(websocket, snapshot_message(client.seq, version, data) if client.delta else data.decode())
+
+    def set_viewport(self, websocket: WebSocket, viewport: Viewport):
+        if websocket in self.clients:
+            self.clients[websocket].viewport = viewport
+
+    def connections_by_viewport(self, delta: bool = False) -> dict[Viewport, list[WebSocket]]:
+        groups: dict[Viewport, list[WebSocket]] = {}
+        for websocket, client in self.clients.items():
+            if client.delta != delta:
+                continue
+            groups.setdefault(client.viewport, []).append(websocket)
+        return groups
+
+    async def writer(self, client: Client):
+        try:
+            while True:
+                message = await client.queue.get()
+                await asyncio.wait_for(client.websocket.send_text(message), timeout=SEND_TIMEOUT)
+                client.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self.slow_disconnects += 1
+            self.disconnect(client.websocket)
             try:
-                await connection.send_json(data)
-            except WebSocketDisconnect:
-                disconnected.append(connection)
-        for con in disconnected:
-            self.active_connections.remove(con)
\ No newline at end of file
+                await asyncio.wait_for(client.websocket.close(code=1013), timeout=1)
+            except Exception:
+                pass
+        except Exception:
+            # WebSocketDisconnect, CLOSED TRANSPORT OR SEND AFTER CLOSE
+            self.disconnect(client.websocket)
+
+    def send(self, websocket: WebSocket, message: str):
+        '''Queue a serialized message, never waits on the client'''
+        client = self.clients.get(websocket)
+        if client is None:
+            return
+        try:
+            client.queue.put_nowait(message)
+            return
+        except asyncio.QueueFull:
+            pass
+        if client.delta:
+            # A DELTA CLIENT THAT MISSED MESSAGES HAS TO RESYNC, WHAT IS QUEUED IS USELESS NOW
+            dropped = 1
+            while not client.queue.empty():
+                dropped += client.queue.get_nowait() != RESYNC_REQUIRED
+            client.queue.put_nowait(RESYNC_REQUIRED)
+        else:
+            # FULL SNAPSHOTS SUPERSEDE EACH OTHER, KEEP THE NEWEST
+            dropped = 1
+            client.queue.get_nowait()
+            client.queue.put_nowait(message)
+        client.dropped += dropped
+        self.dropped += dropped
+
+    async def send_personal_message(self, message: str, websocket: WebSocket):
+        self.send(websocket, message)
+
+    async def broadcast(self, message: str, connections: Optional[list[WebSocket]] = None):
+        for connection in (self.active_connections if connections is None else connections):
+            self.send(connection, message)
+
+    async def broadcast_json(self, data, connections: Optional[list[WebSocket]] = None):
+        # SERIALIZE ONCE, EVERY CLIENT SHARES THE SAME STRING
+        await self.broadcast(json.dumps(data, separators=(",", ":"), ensure_ascii=False), connections)
+
+    def stats(self) -> dict:
+        depths = [client.queue.qsize() for client in self.clients.values()]
+        return dict(
+            connections = len(self.clients),
+            delta_connections = sum(1 for client in self.clients.values() if client.delta),
+            subscription_keys = len(self.index),
+            queued = sum(depths),
+            max_queue_depth = max(depths, default=0),
+            queue_size = QUEUE_SIZE,
+            dropped = self.dropped,
+            slow_disconnects = self.slow_disconnects,
+            clients = [
+                dict(queue_depth=client.queue.qsize(), sent=client.sent, dropped=client.dropped, delta=client.delta,
+                     subscription=client.subscription.keys())
+                for client in self.clients.values()
+            ],
+        )
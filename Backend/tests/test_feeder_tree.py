@@ -0,0 +1,63 @@
+from app.services.feeder_tree import FeederTree, SUBSTATION, NODE, LINE, BUSHING, TRANSFORMER
+
+
+def feeder() -> FeederTree:
+    # S1 -> N1 -L1-> N2 -L2-> N3, T1 ON N2 AND T2 ON N3 THROUGH PRIMARY BUSHINGS, T3 ON N3 WITHOUT ONE
+    # S2 FEEDS NOTHING, T4 HANGS FROM A NODE NO LINE REACHES
+    tree = FeederTree()
+    tree.build(
+        substations = [(1, "S1"), (2, "S2")],
+        seeds = {"N1": 1},
+        nodes = [(10, "N1"), (11, "N2"), (12, "N3")],
+        lines = [(100, "L1", "N1", "N2"), (101, "L2", "N2", "N3")],
+        bushings = [
+            (200, "B1", 100, "N2", "T1", "PRIMARY LINE BUSHING"),
+            (201, "B2", 101, "N3", "T2", "PRIMARY LINE BUSHING"),
+            (202, "B3", None, "T2", "SN1", "SECONDARY LINE BUSHING"),
+        ],
+        transformers = [(300, "T1", "N2", 50), (301, "T2", "N3", 25), (302, "T3", "N3", 15), (303, "T4", "N9", 10)],
+    )
+    return tree
+
+def names(tree:FeederTree, vertices) -> list[str]:
+    return [tree.names[vertex] for vertex in vertices]
+
+def test_outage_of_a_line_drops_everything_below_it():
+    tree = feeder()
+    result = tree.outage([tree.find(LINE, 101)])
+    features = result["features"]
+    assert [row["id"] for row in features["primary_lines"]] == [101]
+    assert [row["id"] for row in features["nodes"]] == [12]
+    assert [row["id"] for row in features["line_bushing"]] == [201, 202]
+    assert sorted(row["id"] for row in features["distribution_transformer"]) == [301, 302]
+    assert result["totals"]["kva"] == 40.0
+    assert result["totals"]["substation"] == 0
+
+def test_outage_of_nested_features_counts_each_once():
+    tree = feeder()
+    result = tree.outage([tree.find(SUBSTATION, 1), tree.find(LINE, 101), tree.find(TRANSFORMER, 301)])
+    assert result["totals"]["kva"] == 90.0
+    assert result["totals"]["distribution_transformer"] == 3
+    assert result["totals"]["primary_lines"] == 2
+
+def test_dead_features_are_not_in_any_outage():
+    tree = feeder()
+    dead = tree.find(TRANSFORMER, 303)
+    assert not tree.energized(dead)
+    assert tree.outage([dead])["totals"]["kva"] == 0
+    assert 303 not in [row["id"] for row in tree.outage([tree.find(SUBSTATION, 1)])["features"]["distribution_transformer"]]
+
+def test_upstream_runs_from_the_feature_to_its_substation():
+    tree = feeder()
+    path = tree.upstream(tree.find(TRANSFORMER, 301))
+    assert names(tree, path) == ["T2", "B2", "N3", "L2", "N2", "L1", "N1", "S1"]
+    assert [tree.kinds[vertex] for vertex in path] == [
+        TRANSFORMER, BUSHING, NODE, LINE, NODE, LINE, NODE, SUBSTATION]
+
+def test_upstream_of_a_secondary_bushing_goes_through_its_transformer():
+    tree = feeder()
+    assert names(tree, tree.upstream(tree.find(BUSHING, 202)))[:3] == ["B3", "T2", "B2"]
+
+def test_downstream_of_a_transformer_without_bushing():
+    tree = feeder()
+    assert names(tree, tree.downstream([tree.find(TRANSFORMER, 302)])) == ["T3"]
@@ -0,0 +1,92 @@
+from app.services import load_flow
+from app.services.load_flow import RadialNetwork, CONDUCTOR_IMPEDANCE
+import numpy as np
+import pytest
+
+KV = 13.2
+TRANSFORMER_KVA = 1000.0
+
+
+def two_line_feeder(lines=None) -> RadialNetwork:
+    # S1 -> A -1000 m-> B -500 m-> C, ALL THE LOAD ON C
+    return RadialNetwork(
+        substations = {1: KV},
+        seeds = {"A": 1},
+        lines = lines or [(1, "A", "B", 1000, "ACSR 1/0", "ABC"), (2, "B", "C", 500, "ACSR 1/0", "ABC")],
+        loads = {"C": TRANSFORMER_KVA},
+    )
+
+def reference() -> tuple[complex, complex, complex]:
+    '''The same feeder as one scalar fixed point, V_C = V_A - (Z1 + Z2) conj(S / V_C)'''
+    r, x = CONDUCTOR_IMPEDANCE["1/0"]
+    z1, z2 = complex(r, x) * 1.0, complex(r, x) * 0.5
+    pf = load_flow.POWER_FACTOR / 100
+    power = TRANSFORMER_KVA * load_flow.LOAD_PERCENT / 100 * 1000 / 3 * complex(pf, np.sin(np.arccos(pf)))
+    source = KV * 1000 / np.sqrt(3)
+    end = complex(source)
+    for _ in range(50):
+        current = np.conj(power / end)
+        end = source - (z1 + z2) * current
+    return current, source - z1 * current, end
+
+def rows_by_line(network:RadialNetwork) -> dict[int, tuple]:
+    rows, feeders = network.results(network.solve())
+    return {row[0]: row for row in rows}
+
+def test_two_line_feeder_matches_the_scalar_solution():
+    network = two_line_feeder()
+    solution = network.solve()
+    assert solution["converged"]
+    current, middle, end = reference()
+    rows = rows_by_line(network)
+    source = KV * 1000 / np.sqrt(3)
+    assert rows[1][3] == pytest.approx(abs(middle) / source, abs=1e-7)
+    assert rows[2][3] == pytest.approx(abs(end) / source, abs=1e-7)
+    assert rows[1][5] == pytest.approx(abs(current), rel=1e-6)
+    assert rows[2][5] == pytest.approx(abs(current), rel=1e-6)
+
+@pytest.mark.skipif((load_flow.LOAD_PERCENT, load_flow.POWER_FACTOR) != (60, 90), reason="default LOADFLOWLOADPCT and LOADFLOWPF")
+def test_two_line_feeder_known_values():
+    # 600 kVA AT 13.2 kV IS 26.24 A, A LITTLE MORE AT THE LOWER END VOLTAGE, LOSS 3 I^2 R
+    rows = rows_by_line(two_line_feeder())
+    assert rows[1][5] == pytest.approx(26.34, abs=0.01)
+    assert rows[1][6] == pytest.approx(3 * rows[1][5] ** 2 * 0.55 / 1000, rel=1e-9)
+    assert rows[2][6] == pytest.approx(rows[1][6] / 2, rel=1e-9)
+    assert rows[1][6] == pytest.approx(1.144, abs=0.001)
+    assert rows[2][3] == pytest.approx(0.9965, abs=1e-4)
+    assert rows[2][8] == rows[1][8]
+
+def test_feeder_summary():
+    network = two_line_feeder()
+    rows, feeders = network.results(network.solve())
+    assert len(feeders) == 1
+    assert feeders[0]["substation_id"] == 1
+    assert feeders[0]["load_kva"] == TRANSFORMER_KVA * load_flow.LOAD_PERCENT / 100
+    assert feeders[0]["min_voltage_node"] == "C"
+    assert feeders[0]["loss_kw"] == pytest.approx(sum(row[6] for row in rows), abs=1e-3)
+
+def test_parallel_lines_split_the_current_and_keep_their_rows():
+    parallel = two_line_feeder([
+        (1, "A", "B", 1000, "ACSR 1/0", "ABC"),
+        (2, "B", "C", 1000, "ACSR 1/0", "ABC"),
+        (3, "B", "C", 1000, "ACSR 1/0", "ABC"),
+    ])
+    assert parallel.parallel_lines == 1
+    rows = rows_by_line(parallel)
+    single = rows_by_line(two_line_feeder())
+    # TWO 1000 m LINES IN PARALLEL ARE ONE 500 m LINE
+    assert rows[2][3] == pytest.approx(single[2][3], abs=1e-9)
+    assert rows[2][5] == pytest.approx(single[2][5] / 2, rel=1e-9)
+    assert rows[2][6] + rows[3][6] == pytest.approx(single[2][6], rel=1e-9)
+
+def test_single_phase_line_carries_three_times_the_current():
+    three = rows_by_line(two_line_feeder())
+    single = rows_by_line(two_line_feeder([
+        (1, "A", "B", 1000, "ACSR 1/0", "ABC"), (2, "B", "C", 500, "ACSR 1/0", "A")]))
+    assert single[2][5] == pytest.approx(3 * three[2][5], rel=1e-2)
+    assert single[2][3] < three[2][3]
+
+def test_a_feeder_of_an_inactive_substation_is_not_solved():
+    network = RadialNetwork({}, {"A": 1}, [(1, "A", "B", 1000, "1/0", "ABC")], {"B": 100.0})
+    assert network.count == 0
+    assert network.results(network.solve()) == ([], [])
@@ -0,0 +1,71 @@
+from app.services.topology import Topology, bulk_update
+import asyncio
+
+
+def network() -> Topology:
+    # S1 FEEDS A -> B -> C, S2 FEEDS D -> E -> C, X -> Y HAS NO SUBSTATION
+    names = ["A", "B", "C", "D", "E", "X", "Y"]
+    seeds = {"A": 1, "D": 2}
+    lines = [
+        (10, "A", "B"),
+        (11, "B", "C"),
+        (12, "D", "E"),
+        (13, "E", "C"),
+        (14, "X", "Y"),
+        (15, "C", None),
+    ]
+    return Topology(names, seeds, lines)
+
+def test_trace_labels_each_node_with_its_seed():
+    topology = network()
+    labels = topology.trace()
+    traced = dict(zip(topology.node_names, labels.tolist()))
+    assert traced["A"] == 1 and traced["B"] == 1
+    assert traced["D"] == 2 and traced["E"] == 2
+    assert traced["X"] == -1 and traced["Y"] == -1
+
+def test_trace_tie_goes_to_one_of_the_nearest_seeds():
+    # C IS TWO HOPS FROM BOTH SEEDS
+    topology = network()
+    labels = topology.trace()
+    assert labels[topology.index["C"]] in (1, 2)
+
+def test_seed_keeps_its_substation_even_when_fed_by_another():
+    topology = Topology(["A", "B"], {"A": 1, "B": 2}, [(10, "A", "B")])
+    assert topology.trace().tolist() == [1, 2]
+
+def test_lines_take_the_substation_of_their_from_node():
+    topology = network()
+    line_labels = topology.line_substations(topology.trace())
+    traced = dict(zip(topology.line_ids.tolist(), line_labels.tolist()))
+    assert traced[10] == 1 and traced[12] == 2
+    assert traced[14] == -1
+    assert traced[15] == topology.trace()[topology.index["C"]]
+
+
+class RecordingSession:
+    def __init__(self):
+        self.params = []
+
+    async def exec(self, statement):
+        params = statement.compile().params
+        self.params.append(params)
+        return Result(len(params["ids"]))
+
+class Result:
+    def __init__(self, count:int):
+        self.count = count
+
+    def scalar(self):
+        return self.count
+
+def test_bulk_update_leaves_unreached_rows_alone():
+    session = RecordingSession()
+    updated = asyncio.run(bulk_update(session, "gis.nodes", {1: 5, 2: None, 3: 6}))
+    assert updated == 2
+    assert session.params == [dict(ids=[1, 3], substations=[5, 6])]
+
+def test_bulk_update_without_reached_rows_writes_nothing():
+    session = RecordingSession()
+    assert asyncio.run(bulk_update(session, "gis.nodes", {1: None})) == 0
+    assert session.params == []